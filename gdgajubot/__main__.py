@@ -1,21 +1,20 @@
 import argparse
+import atexit
 import logging
 
 import os
 
-from gdgajubot import util
-from gdgajubot.bot import GDGAjuBot
+from gdgajubot import logs, startup, util
 
 
 def main():
-    log_format = os.environ.get('LOG_FORMAT', '%(asctime)s %(message)s')
-    log_datefmt = os.environ.get('LOG_DATE_FORMAT', '%m/%d/%Y %I:%M:%S %p')
-
-    # Configuring log
-    logging.basicConfig(
-        level=logging.INFO,
-        format=log_format, datefmt=log_datefmt
+    # Configuring log: LOG_FORMAT may be a format string or 'json'
+    listener = logs.setup(
+        log_format=os.environ.get('LOG_FORMAT'),
+        datefmt=os.environ.get('LOG_DATE_FORMAT'),
+        sample_rate=float(os.environ.get('LOG_SAMPLE_RATE', 1)),
     )
+    atexit.register(listener.stop)
 
     # Configuring bot parameters
     logging.info("Configurando parâmetros")
@@ -26,6 +25,9 @@ def main():
     parser.add_argument(
         '-t', '--telegram_token',
         help='Token da API do Telegram')
+    parser.add_argument(
+        '--telegram_base_url',
+        help='URL base da Bot API (para apontar para um servidor local de testes)')
     parser.add_argument(
         '-m', '--meetup_key',
         help='Key da API do Meetup')
@@ -40,11 +42,113 @@ def main():
         '-g', '--group_name',
         help='Grupo(s) do Meetup/Facebook, separados por vírgulas',
     )
+    parser.add_argument(
+        '--upstream_base_url',
+        help='URL base única para todos os serviços externos (para um servidor local de testes)')
+    parser.add_argument(
+        '--upstream_timeout',
+        help='Tempo limite, em segundos, das requisições aos serviços externos')
     parser.add_argument(
         '--url_shortener_key',
         help='Key da API do URL Shortener')
     parser.add_argument(
         '--events_source', choices=['meetup', 'facebook'])
+    parser.add_argument(
+        '--warmup_window',
+        help='Janela, em segundos, para distribuir o trabalho pendente na inicialização')
+    parser.add_argument(
+        '--stale_days',
+        help='Dias sem atividade para os estados de um chat saírem da memória')
+    parser.add_argument(
+        '--state_journal',
+        help='Arquivo de diário das alterações de estado, para não perdê-las entre despejos')
+    parser.add_argument(
+        '--journal_fsync', choices=['always', 'interval', 'never'],
+        help='Política de fsync do diário de estados')
+    parser.add_argument(
+        '--capture',
+        help='Grava as atualizações recebidas neste arquivo (.jsonl.gz) para reprodução')
+    parser.add_argument(
+        '--capture_anonymize',
+        help='Anonimiza usuários, chats e textos na captura', action='store_true')
+    parser.add_argument(
+        '--metrics_port',
+        help='Porta do endpoint HTTP /metrics (desativado se omitida)')
+    parser.add_argument(
+        '--watchdog_threshold',
+        help='Segundos a partir dos quais uma chamada de handler é denunciada como lenta (0 desativa)')
+    parser.add_argument(
+        '--profile_dir',
+        help='Diretório onde o comando /profile grava os resultados')
+    parser.add_argument(
+        '--webhook_url',
+        help='URL pública do bot; se informada, as atualizações são recebidas por webhook em vez de polling')
+    parser.add_argument(
+        '--webhook_listen',
+        help='Endereço host:porta do servidor do webhook (padrão 0.0.0.0:$PORT ou 0.0.0.0:8443)')
+    parser.add_argument(
+        '--webhook_secret',
+        help='Segredo do webhook, no caminho da URL e no cabeçalho (gerado a cada início se omitido)')
+    parser.add_argument(
+        '--webhook_workers',
+        help='Threads que atendem as requisições do webhook')
+    parser.add_argument(
+        '--webhook_max_body',
+        help='Tamanho máximo, em bytes, de uma requisição do webhook')
+    parser.add_argument(
+        '--catch_up', action='store_true',
+        help='Processa as atualizações pendentes na inicialização, em vez de descartá-las')
+    parser.add_argument(
+        '--catch_up_max_age',
+        help='Idade máxima, em segundos, das mensagens pendentes que ainda recebem resposta')
+    parser.add_argument(
+        '--flood_rate',
+        help='Comandos por segundo aceitos de cada chat após a rajada (0, o padrão, desativa o limite)')
+    parser.add_argument(
+        '--flood_burst',
+        help='Comandos seguidos aceitos de cada chat antes do limite')
+    parser.add_argument(
+        '--overload_queue',
+        help='Atualizações na fila a partir das quais o trabalho opcional é descartado (0 desativa)')
+    parser.add_argument(
+        '--overload_latency',
+        help='Espera média na fila, em segundos, a partir da qual o trabalho opcional é descartado (0 desativa)')
+    parser.add_argument(
+        '--startup_profile',
+        help='Informa no log a duração de cada fase da inicialização', action='store_true')
+    parser.add_argument(
+        '--broadcast_rate',
+        help='Mensagens por segundo, no total, no envio de avisos com /broadcast')
+    parser.add_argument(
+        '--broadcast_concurrency',
+        help='Envios simultâneos de avisos com /broadcast')
+    parser.add_argument(
+        '--retention_days',
+        help='Dias que as mensagens ficam no banco antes de arquivadas e removidas (0 mantém para sempre)')
+    parser.add_argument(
+        '--retention_chats',
+        help='Dias de retenção de chats específicos, como "-100123=30,-100456=0"')
+    parser.add_argument(
+        '--archive_dir',
+        help='Diretório dos arquivos com as mensagens removidas pela retenção')
+    parser.add_argument(
+        '--compact_after',
+        help='Mensagens removidas pela retenção que disparam um VACUUM no SQLite (0, o padrão, não compacta)')
+    parser.add_argument(
+        '--search_budget',
+        help='Tempo máximo (em segundos) de uma busca com /search antes de responder com resultados parciais')
+    parser.add_argument(
+        '--cluster_id',
+        help='Identificação deste worker; ativa o modo cluster, em que vários processos dividem os chats')
+    parser.add_argument(
+        '--cluster_url',
+        help='URL em que os outros workers alcançam o webhook deste (exige --webhook_secret, comum a todos)')
+    parser.add_argument(
+        '--cluster_lease',
+        help='Validade, em segundos, das concessões dos workers no banco')
+    parser.add_argument(
+        '--tenants',
+        help='Arquivo com as configurações de várias comunidades, atendidas por um único processo')
     parser.add_argument(
         '-d', '--dev',
         help='Indicador de Debug/Dev mode', action='store_true')
@@ -53,7 +157,16 @@ def main():
         help=argparse.SUPPRESS, dest='dev', action='store_false')
 
     # Parse command line args and get the config
-    _config = parser.parse_args()
+    with startup.phase('config'):
+        _config = parser.parse_args()
+
+    # Multi-tenant mode: each community has its own token and events source
+    if _config.tenants_file:
+        if _config.startup_profile:
+            startup.profile.import_heavy_modules()
+        from gdgajubot.tenants import TenantRuntime
+        TenantRuntime.from_file(_config.tenants_file).start()
+        return
 
     # Define the events source if needed
     if not _config.events_source:
@@ -64,6 +177,12 @@ def main():
         else:
             parser.error('an API key is needed to get events')
 
+    # The bot (and its dependencies) is imported only after the arguments are valid
+    if _config.startup_profile:
+        startup.profile.import_heavy_modules()
+    with startup.phase('import gdgajubot.bot'):
+        from gdgajubot.bot import GDGAjuBot
+
     # Starting bot
     gdgbot = GDGAjuBot(_config)
     gdgbot.start()
@@ -0,0 +1,348 @@
+"""Benchmark do GDGAjuBot com fluxos sintéticos de atualizações.
+
+O bot é construído com um `Bot` e um `Resources` de mentira, e as
+atualizações passam pelo `Dispatcher` real e por toda a cadeia de handlers.
+
+Uso::
+
+    $ python -m gdgajubot.bench --messages 5000 --chats 20 --save baseline.json
+    $ python -m gdgajubot.bench --messages 5000 --chats 20 --compare baseline.json
+"""
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import queue
+import random
+import sys
+import time
+import tracemalloc
+import weakref
+
+import telegram
+from telegram.ext import Dispatcher, JobQueue
+
+from gdgajubot import util
+from gdgajubot.bot import GDGAjuBot
+
+COMMANDS = ('/start', '/help', '/links', '/events', '/book', '/udemy', '/about')
+EASTER_EGGS = ('ruby', 'java', 'python')
+WORDS = ('bom', 'dia', 'pessoal', 'alguém', 'sabe', 'como', 'resolver', 'isso', 'evento', 'hoje', 'código', 'teste')
+
+
+class StubBot:
+    """Substituto do `telegram.Bot` que apenas conta as chamadas."""
+
+    def __init__(self):
+        self.me = telegram.User(1, 'GDGAjuBot', is_bot=True, username='gdgajubot')
+        self.username = self.me.username
+        self.calls = dict.fromkeys(('send_message', 'send_photo', 'get_chat'), 0)
+        self._ids = itertools.count(1)
+
+    def get_me(self):
+        return self.me
+
+    def get_chat(self, chat_id):
+        self.calls['get_chat'] += 1
+        return telegram.Chat(chat_id, telegram.Chat.SUPERGROUP, username='chat%d' % abs(chat_id))
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.calls['send_message'] += 1
+        return telegram.Message(next(self._ids), self.me, datetime.datetime.now(), telegram.Chat(chat_id, 'group'),
+                                text=text, bot=self)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self.calls['send_photo'] += 1
+        return telegram.Message(next(self._ids), self.me, datetime.datetime.now(), telegram.Chat(chat_id, 'group'),
+                                bot=self)
+
+
+class StubResources:
+    """Substituto do `Resources`, com dados estáticos e sem banco de dados."""
+
+    BOOK_URL = 'https://www.packtpub.com/packt/offers/free-learning'
+
+    EVENTS = [
+        {'name': 'Evento %d' % i, 'link': 'https://www.meetup.com/GDG-Aracaju/events/%d/' % i,
+         'time': datetime.datetime(2030, 1, 1 + i, 19, tzinfo=util.AJU_TZ)}
+        for i in range(5)
+    ]
+
+    def __init__(self):
+        self.logged = 0
+
+    def get_events(self, list_size=5):
+        return [dict(event) for event in self.EVENTS[:list_size]]
+
+    def get_packt_free_book(self):
+        return util.AttributeDict(
+            name='Benchmarking 101', summary='How to measure things', cover='//cover.jpg',
+            expires=time.time() + 12 * 3600,
+        )
+
+    def get_discounts(self):
+        return {'https://www.udemy.com/course/bench/?couponCode=FREE': 'Bench Course'}
+
+    def get_short_url(self, long_url):
+        return long_url
+
+    def get_group(self, group_id, group_name):
+        return util.AttributeDict(telegram_id=group_id, telegram_groupname=group_name, has_daily_book=True)
+
+    def set_group(self, group_id, group_name, **kwargs):
+        pass
+
+    def list_groups(self, daily_book=False):
+        return ()
+
+    def update_groups(self, groups):
+        pass
+
+    def load_states(self):
+        return util.MissingDict(
+            lambda state_id: util.MissingDict(
+                lambda chat_id: util.StateDict({'__memory__': {}}, dump_function=lambda state: None)
+            )
+        )
+
+    def update_states(self, states):
+        pass
+
+    def log_message(self, message, *args, **kwargs):
+        self.logged += 1
+
+    def backfill_rollups(self, batch_size=1000):
+        return 0
+
+    def rebuild_search_index(self, batch_size=1000):
+        return 0
+
+    def index_messages(self, batch_size=1000):
+        return 0
+
+    def flush_journal(self):
+        pass
+
+    def is_user_admin(self, user_id):
+        return False
+
+    def list_all_users(self):
+        return ()
+
+
+class Workload:
+    """Parâmetros do fluxo sintético de atualizações."""
+
+    def __init__(self, messages=2000, chats=10, users=50, rate=0.0, command_ratio=0.1,
+                 easter_egg_ratio=0.05, seed=0):
+        self.messages = messages
+        self.chats = chats
+        self.users = users
+        self.rate = rate  # mensagens por segundo; 0 para a velocidade máxima
+        self.command_ratio = command_ratio
+        self.easter_egg_ratio = easter_egg_ratio
+        self.seed = seed
+
+    def updates(self, bot):
+        """Gera as atualizações do fluxo, sempre as mesmas para a mesma semente."""
+        rnd = random.Random(self.seed)
+        chats = [telegram.Chat(-1000 - i, telegram.Chat.SUPERGROUP, username='chat%d' % i)
+                 for i in range(self.chats)]
+        users = [telegram.User(1000 + i, 'User %d' % i, is_bot=False, username='user%d' % i)
+                 for i in range(self.users)]
+
+        for n in range(1, self.messages + 1):
+            entities = None
+            draw = rnd.random()
+            if draw < self.command_ratio:
+                text = rnd.choice(COMMANDS)
+                entities = [telegram.MessageEntity(telegram.MessageEntity.BOT_COMMAND, 0, len(text))]
+            else:
+                words = rnd.choices(WORDS, k=rnd.randint(2, 12))
+                if draw < self.command_ratio + self.easter_egg_ratio:
+                    words.insert(rnd.randrange(len(words)), rnd.choice(EASTER_EGGS))
+                text = ' '.join(words)
+
+            # a few chats concentrate most of the traffic, as in real groups
+            chat = chats[min(int(rnd.paretovariate(1.2)) - 1, len(chats) - 1)]
+            message = telegram.Message(n, rnd.choice(users), datetime.datetime.now(), chat,
+                                       text=text, entities=entities, bot=bot)
+            yield telegram.Update(n, message=message)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def make_bot(config=None, bot=None, resources=None):
+    """Constrói um `GDGAjuBot` com handlers reais, mas sem conexão externa."""
+    if config is None:
+        # no flood control, so that baselines measure the handlers
+        config = util.BotConfig(group_name='Bench', flood_rate=0)
+    bot = bot or StubBot()
+    updater = util.AttributeDict(
+        bot=bot,
+        dispatcher=Dispatcher(bot, queue.Queue(), workers=0),
+        job_queue=JobQueue(bot),
+    )
+    return GDGAjuBot(config, bot, resources or StubResources(), updater=updater)
+
+
+# errors seen by each dispatcher, with the handler registered only once
+_errors = weakref.WeakKeyDictionary()
+
+
+def dispatcher_errors(dispatcher):
+    errors = _errors.get(dispatcher)
+    if errors is None:
+        errors = _errors[dispatcher] = []
+        dispatcher.add_error_handler(lambda bot, update, error: errors.append(error))
+    return errors
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def run(workload, allocations=True, g_bot=None, updates=None, offsets=None):
+    """Executa o fluxo e retorna um relatório com vazão, latências e alocações.
+
+    Com `offsets`, cada atualização é processada no instante indicado (em
+    segundos desde o início) em vez de seguir a taxa fixa do `workload`.
+    """
+    g_bot = g_bot or make_bot()
+    dispatcher = g_bot.updater.dispatcher
+    errors = dispatcher_errors(dispatcher)
+    errors_before = len(errors)
+
+    updates = list(updates if updates is not None else workload.updates(g_bot.bot))
+    interval = 1 / workload.rate if workload.rate else 0
+    latencies = []
+
+    start = time.perf_counter()
+    for i, update in enumerate(updates):
+        at = offsets[i] if offsets is not None else i * interval
+        if at:
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        t0 = time.perf_counter()
+        dispatcher.process_update(update)
+        latencies.append(time.perf_counter() - t0)
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    report = {
+        'workload': workload.to_dict(),
+        'messages': len(updates),
+        'errors': len(errors) - errors_before,
+        'duration_s': duration,
+        'messages_per_sec': len(updates) / duration if duration else 0.0,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': (latencies[-1] if latencies else 0) * 1000,
+        },
+        'bot_calls': dict(getattr(g_bot.bot, 'calls', {})),
+    }
+
+    # allocations are measured in a separate pass: tracemalloc slows everything down
+    if allocations and updates:
+        sample = updates[:min(len(updates), 1000)]
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for update in sample:
+            dispatcher.process_update(update)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        diff = after.compare_to(before, 'filename')
+        report['allocations'] = {
+            'blocks_per_message': sum(max(d.count_diff, 0) for d in diff) / len(sample),
+            'bytes_per_message': sum(max(d.size_diff, 0) for d in diff) / len(sample),
+            'peak_kb': peak / 1024,
+        }
+
+    return report
+
+
+def compare(report, baseline, tolerance=0.1):
+    """Lista as métricas que pioraram mais que `tolerance` em relação ao baseline."""
+    regressions = []
+
+    def check(name, current, previous, higher_is_better=False):
+        if not previous:
+            return
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append('%s: %.3f -> %.3f (%+.1f%%)' % (name, previous, current, change * 100))
+
+    check('messages_per_sec', report['messages_per_sec'], baseline['messages_per_sec'], higher_is_better=True)
+    for p in ('p50', 'p95', 'p99'):
+        check('latency_ms.' + p, report['latency_ms'][p], baseline['latency_ms'][p])
+    if 'allocations' in report and 'allocations' in baseline:
+        check('allocations.bytes_per_message', report['allocations']['bytes_per_message'],
+              baseline['allocations']['bytes_per_message'])
+
+    return regressions
+
+
+def format_report(report):
+    lines = [
+        '%(messages)d mensagens em %(duration_s).2fs: %(messages_per_sec).1f msg/s, %(errors)d erros' % report,
+        'latência (ms): p50=%(p50).3f p95=%(p95).3f p99=%(p99).3f max=%(max).3f' % report['latency_ms'],
+    ]
+    if 'allocations' in report:
+        lines.append('alocações por mensagem: %(blocks_per_message).1f blocos, %(bytes_per_message).0f bytes; '
+                     'pico %(peak_kb).1f KB' % report['allocations'])
+    lines.append('chamadas ao bot: %s' % report['bot_calls'])
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark do GDGAjuBot com atualizações sintéticas')
+    parser.add_argument('--messages', type=int, default=2000, help='Quantidade de mensagens')
+    parser.add_argument('--chats', type=int, default=10, help='Quantidade de chats')
+    parser.add_argument('--users', type=int, default=50, help='Quantidade de usuários')
+    parser.add_argument('--rate', type=float, default=0.0, help='Mensagens por segundo (0 para o máximo)')
+    parser.add_argument('--command_ratio', type=float, default=0.1, help='Proporção de comandos')
+    parser.add_argument('--easter_egg_ratio', type=float, default=0.05, help='Proporção de easter eggs')
+    parser.add_argument('--seed', type=int, default=0, help='Semente do gerador')
+    parser.add_argument('--no_allocations', action='store_true', help='Não mede alocações')
+    parser.add_argument('--save', help='Salva o resultado como baseline neste arquivo')
+    parser.add_argument('--compare', help='Compara o resultado com o baseline deste arquivo')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Piora tolerada na comparação')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Mostra os logs do bot')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    workload = Workload(
+        messages=args.messages, chats=args.chats, users=args.users, rate=args.rate,
+        command_ratio=args.command_ratio, easter_egg_ratio=args.easter_egg_ratio, seed=args.seed,
+    )
+    report = run(workload, allocations=not args.no_allocations)
+    print(format_report(report))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSÃO ' + regression)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,27 @@
 ﻿#!/usr/bin/env python3
 """Bot do GDG-Aracaju."""
+import atexit
 import datetime
 import functools
-import itertools
+import html
 import logging
 import random
 import re
 import textwrap
+import time
 from collections import OrderedDict
-from threading import RLock
+from threading import RLock, Thread
 
 import telegram
-from telegram.ext import CommandHandler, Updater
+from telegram.ext import CommandHandler, TypeHandler, Updater
 from telegram.ext.filters import BaseFilter
 
+from .data import analytics
+from .data.chats import ChatRegistry
 from .data.resources import Resources
+from . import (
+    broadcast, cluster, logs, memory, metrics, overload, profiler, retention, startup, util, watchdog, webhook,
+)
 from .decorators import *
 from .util import extract_command, AJU_TZ
 
@@ -50,12 +57,38 @@ def adapt_callback(cb, *args, **kwargs):
     return lambda _, u, *args, **kwargs: cb(u.message, *args, **kwargs)
 
 
+def bar(n, top, width=20):
+    return '█' * round(width * n / top) if top else ''
+
+
 ALREADY_ANSWERED_TEXTS = (
     "Ei, olhe, acabei de responder!",
     "Me reservo ao direito de não responder!",
     "Deixe de insistência!",
 )
 
+# no cluster, um livro diário enviado a um chat impede outro envio pelo novo dono durante este tempo (s)
+BOOK_CLAIM_TTL = 3 * 3600
+
+# período padrão (em dias) de /top e /activity, e o máximo aceito
+ACTIVITY_DAYS = 7
+ACTIVITY_MAX_DAYS = 365
+
+# backfill dos contadores de atividade e do índice de busca: mensagens por lote e tempo máximo (s)
+# por execução da task
+BACKFILL_BATCH = 1000
+BACKFILL_BUDGET = 2
+
+# resultados por página do /search e tamanho máximo do trecho de cada um
+SEARCH_PAGE_SIZE = 5
+SEARCH_SNIPPET = 200
+
+# intervalo (s) da indexação das mensagens novas para o /search
+SEARCH_INDEX_INTERVAL = 10
+
+# intervalo (s) da gravação do buffer do diário de estados, mesmo sem novas alterações
+JOURNAL_FLUSH_INTERVAL = 1
+
 TIME_LEFT = OrderedDict([
     (30, '30 segundos'),
     (60, '1 minuto'),
@@ -66,25 +99,60 @@ TIME_LEFT = OrderedDict([
 
 
 class GDGAjuBot:
-    def __init__(self, config, bot=None, resources=None):
+    def __init__(self, config, bot=None, resources=None, updater=None):
         self.config = config
+        self.metric_labels = dict(tenant=config.tenant) if config.tenant else {}
         self.resources = resources if resources else Resources(config)
         self.state_access = dict(
             count=0,
             lock=RLock()
         )
-        self.states = self.resources.load_states()
-        self.clear_stale_states(as_task=False)
+        with startup.phase('load states'):
+            self.states = self.resources.load_states()
+        self.chats = ChatRegistry(self.resources)
+        self.activity = util.ActivityIndex()
+        with startup.phase('index activity'):
+            self.__index_activity()
+        self.book_schedule = util.ChatSchedule()
+        self.book_sweep_stats = None
+        self.cluster = None
+        self.broadcaster = broadcast.Broadcaster(
+            lambda chat_id, text: self.bot.send_message(chat_id, text), self.resources,
+            concurrency=config.broadcast_concurrency, rate=config.broadcast_rate,
+        )
+        self.retention = retention.Retention(
+            self.resources, retention.RetentionPolicy(config.retention_days, config.retention_chats),
+            retention.Archive(config.archive_dir), compact_after=config.compact_after,
+        )
+        self.overload = overload.OverloadController(
+            command_rate=config.flood_rate,
+            command_burst=config.flood_burst,
+            queue_threshold=config.overload_queue,
+            latency_threshold=config.overload_latency,
+        )
 
         # O parâmetro bot só possui valor nos casos de teste, nesse caso,
         # encerra o __init__ aqui para não haver conexão ao Telegram.
-        if bot:
+        # Com um updater de mentira (benchmarks), os handlers são configurados.
+        if bot and not updater:
             self.bot = bot
             return
 
         # Conecta ao telegram com o token passado na configuração
-        self.updater = Updater(token=config.telegram_token)
+        with startup.phase('telegram updater'):
+            if updater:
+                self.updater = updater
+            else:
+                self.updater = Updater(token=config.telegram_token, base_url=config.telegram_base_url)
+                # Mede a espera das atualizações na fila, em qualquer modo de recebimento
+                webhook.install_timed_queue(self.updater, 'webhook' if config.webhook_url else 'polling',
+                                            **self.metric_labels)
         self.bot = self.updater.bot
+        self.webhook = None
+
+        # Mede a duração dos envios ao Telegram
+        for name in ('send_message', 'send_photo'):
+            setattr(self.bot, name, metrics.timed('telegram_send_seconds', method=name)(getattr(self.bot, name)))
 
         # Anexa uma função da API antiga para manter retrocompatibilidade
         self.bot.reply_to = lambda message, text, **kwargs: \
@@ -95,6 +163,38 @@ class GDGAjuBot:
 
         dispatcher = self.updater.dispatcher
 
+        # Sob sobrecarga, descarta os easter eggs e os logs de cada mensagem
+        self.overload.watch(dispatcher.update_queue)
+        self.overload.filter_log(logs.per_message)
+
+        # Grava as atualizações recebidas para reprodução posterior
+        self.recorder = None
+        if config.capture_file:
+            from .capture import UpdateRecorder
+            self.recorder = UpdateRecorder(config.capture_file, anonymize=config.capture_anonymize)
+            self.recorder.install(dispatcher)
+            # finalizes the gzip stream, or the capture ends truncated
+            atexit.register(self.recorder.close)
+            logging.info("Gravando atualizações em %s", config.capture_file)
+
+        # Registra passivamente os metadados de todo chat que enviar atualizações
+        dispatcher.add_handler(
+            TypeHandler(telegram.Update, lambda _, update: self.chats.observe(update.effective_chat)),
+            group=-1,
+        )
+
+        # Vários workers: cada um atende os chats que lhe cabem
+        if config.cluster_id:
+            self.cluster = cluster.Cluster(
+                self.resources, config.cluster_id, config.cluster_url, config.webhook_secret,
+                dispatcher.update_queue, ttl=config.cluster_lease,
+            )
+            self.cluster.on_change = self.rebalance
+
+        with startup.phase('handlers'):
+            self.__setup_handlers(dispatcher)
+
+    def __setup_handlers(self, dispatcher):
         # Configura os comandos aceitos pelo bot
         command.process(self)
 
@@ -122,15 +222,30 @@ class GDGAjuBot:
         logging.info(command)
         self.bot.reply_to(message, response_text)
 
+    def __index_activity(self):
+        states = self.states
+        for chat_id, stats in states['chat_stats'].items():
+            if 'last_activity' in stats:
+                self.activity.touch(chat_id, stats['last_activity'].timestamp())
+
+        # chats without activity are stale since ever
+        for chat_states in states.values():
+            for chat_id in chat_states:
+                self.activity.add(chat_id)
+
     def get_state(self, state_id, chat_id):
         state = self.states[state_id][chat_id]
+        self.activity.add(chat_id)
 
+        # never ask Telegram here: the chat registry is filled in background
         if 'chat' not in state:
-            state['chat'] = self.bot.get_chat(chat_id).username
+            chat = self.chats.get(chat_id)
+            if chat:
+                state['chat'] = chat.username
 
         return state
 
-    @command('/start')
+    @command('/start', essential=True)
     def send_welcome(self, message):
         """Mensagem de apresentação do bot."""
         logging.info("/start")
@@ -214,106 +329,255 @@ class GDGAjuBot:
 
     @on_message('.*')
     def chat_statistics(self, message):
-        stats = self.get_state('chat_stats', message.chat_id)
-        stats['last_activity'] = datetime.datetime.now(AJU_TZ)
+        self.__record_activity(message.chat_id, datetime.datetime.now(AJU_TZ))
+
+    def __record_activity(self, chat_id, when):
+        stats = self.get_state('chat_stats', chat_id)
+        last = stats.get('last_activity')
+        if last is None or when > last:
+            stats['last_activity'] = when
+            self.activity.touch(chat_id, when.timestamp())
 
-    @task(once=60)
     @on_message('.*')
-    def ensure_daily_book(self, message=None, as_job=False):
-        # without message, it dispatches the function for each chat state!
-        if not message:
-            if len(self.states['daily_book']) > 0:
-                new_message = functools.partial(telegram.Message, 0, self.get_me(), datetime.datetime.now())
-                for chat_id, state in self.states['daily_book'].items():
-                    self.ensure_daily_book(new_message(self.bot.get_chat(chat_id)), as_job=True)
-            return
+    def ensure_daily_book(self, message):
+        self.__count_book_messages(message.chat_id, message.chat.username)
 
-        group = self.resources.get_group(message.chat_id, message.chat.username)
+    def __count_book_messages(self, chat_id, username, n=1):
+        group = self.resources.get_group(chat_id, username)
         if not group.has_daily_book:
-            logging.warning("ensure_daily_book: disabled for @%s", message.chat.username)
+            logs.per_message.info("ensure_daily_book: disabled for @%s", username)
             return
 
-        state = self.get_state('daily_book', message.chat_id)
-        schedule_job = self.__daily_book_scheduler(state, message)
+        state = self.get_state('daily_book', chat_id)
+        count = state.get('messages_since', 0)
+        count += n
+        state['messages_since'] = count
+
+        logs.per_message.info("ensure_daily_book: %s count=%d last=%s", username, count, state.get('last_time'))
+
+        # first message seen from this chat: resume its persisted schedule
+        # or check the book on the next sweeps
+        if chat_id not in self.book_schedule:
+            when = state.get('next_check')
+            when = when.timestamp() if when else time.time() + 60
+            self.__schedule_book(chat_id, state, when)
+
+    def catch_up(self, batch_size=100, now=None):
+        """Processa as atualizações acumuladas enquanto o bot esteve parado.
+
+        As atualizações são lidas em lotes. As antigas contam apenas para o
+        trabalho passivo (registro das mensagens, estatísticas e contagem do
+        livro diário), aplicado de uma vez por lote; só as recentes, até
+        `catch_up_max_age` segundos, seguem para o dispatcher e recebem resposta.
+        """
+        totals = dict(updates=0, recent=0)
+        offset = None
+        while True:
+            updates = self.bot.get_updates(offset=offset, limit=batch_size, timeout=0)
+            if not updates:
+                break
+            for update in self.apply_backlog(updates, now):
+                self.updater.update_queue.put(update)
+                totals['recent'] += 1
+            totals['updates'] += len(updates)
+            offset = updates[-1].update_id + 1
+
+        # the last (empty) get_updates confirmed everything that was read
+        if offset is not None:
+            self.updater.last_update_id = offset
+        metrics.inc('catch_up_updates_total', totals['updates'] - totals['recent'], result='passive',
+                    **self.metric_labels)
+        metrics.inc('catch_up_updates_total', totals['recent'], result='dispatched', **self.metric_labels)
+        logging.info("Catch-up: %(updates)d pending updates, %(recent)d recent ones dispatched", totals)
+        return totals
+
+    def apply_backlog(self, updates, now=None):
+        """Aplica em lote o trabalho passivo das atualizações antigas; retorna as recentes."""
+        cutoff = (now or time.time()) - self.config.catch_up_max_age
+        recent, backlog = [], OrderedDict()
+
+        for update in updates:
+            self.chats.observe(update.effective_chat)
+            message = update.message
+            if message is not None and message.date.timestamp() >= cutoff:
+                recent.append(update)
+            elif message is not None and message.text:
+                backlog.setdefault(message.chat_id, []).append(message)
+
+        messages = [message for chat_messages in backlog.values() for message in chat_messages]
+        if messages:
+            self.resources.log_messages(messages)
+
+        for chat_id, chat_messages in backlog.items():
+            last = max(message.date.timestamp() for message in chat_messages)
+            self.__record_activity(chat_id, datetime.datetime.fromtimestamp(last, tz=AJU_TZ))
+            self.__count_book_messages(chat_id, chat_messages[0].chat.username, len(chat_messages))
+
+        return recent
+
+    def __schedule_book(self, chat_id, state, when):
+        # keep the next check in the state, so it's persisted with it
+        self.book_schedule.schedule(chat_id, when)
+        state['next_check'] = datetime.datetime.fromtimestamp(when, tz=AJU_TZ)
+
+    @task(once=1)
+    def warm_up(self):
+        """Trabalho de inicialização, executado em segundo plano após o bot começar a responder."""
+        logging.info("Warm-up: clearing stale states and resuming daily book schedules")
+        self.clear_stale_states(as_task=False)
+        self.chats.load()
 
-        # when function isn't called as a job, only count the message.
-        if not as_job:
-            count = state.get('messages_since', 0)
-            count += 1
-            state['messages_since'] = count
+        resumed, overdue = self.__resume_book_schedules(list(self.states['daily_book'].items()))
+        logging.info("Warm-up: %d daily book schedules resumed, %d spread over %ds",
+                     resumed, overdue, self.config.warmup_window)
 
-            logging.info("ensure_daily_book: %s count=%d last=%s", message.chat.username, count, state.get('last_time'))
+    def __resume_book_schedules(self, chat_states):
+        now = time.time()
+        resumed, overdue = 0, []
+        for chat_id, state in chat_states:
+            if chat_id in self.book_schedule:
+                continue
+            when = state.get('next_check')
+            if when and when.timestamp() > now:
+                self.book_schedule.schedule(chat_id, when.timestamp())
+                resumed += 1
+            else:
+                overdue.append((chat_id, state))
+
+        # spread overdue chats over the warm-up window, each one at a random
+        # point of its own slot, to avoid a burst of checks at boot
+        window = self.config.warmup_window
+        slot = window / len(overdue) if overdue else 0
+        for i, (chat_id, state) in enumerate(overdue):
+            self.__schedule_book(chat_id, state, now + i * slot + random.uniform(0, slot))
+        return resumed, len(overdue)
+
+    def rebalance(self):
+        """Mantém em memória só os chats deste worker, depois de uma mudança no cluster."""
+        owns = self.cluster.owns
+
+        # whatever leaves this worker is persisted first, for its new owner to load
+        self.dump_states()
+        dropped = 0
+        for chat_states in self.states.values():
+            for chat_id in [chat_id for chat_id in list(chat_states) if not owns(chat_id)]:
+                chat_states.pop(chat_id, None)
+                dropped += 1
+        for chat_id in list(self.book_schedule):
+            if not owns(chat_id):
+                self.book_schedule.unschedule(chat_id)
+
+        # the chats received from other workers are loaded from the database
+        gained = [chat_id for chat_id, _ in self.resources.list_groups(daily_book=True)
+                  if owns(chat_id) and chat_id not in self.book_schedule]
+        resumed, overdue = self.__resume_book_schedules(
+            [(chat_id, self.get_state('daily_book', chat_id)) for chat_id in gained]
+        )
+        logging.info("Rebalance: %d chat states dropped, %d daily book schedules taken over",
+                     dropped, resumed + overdue)
 
-            # the rest of the function is executed when called as a job
-            return
+    @task(each=60)
+    def daily_book_sweep(self, now=None):
+        """Verifica, em uma única passada, todos os chats com livro diário pendente."""
+        if now is None:
+            now = datetime.datetime.now(tz=AJU_TZ)
 
-        # when called as a job and is a dispatching, avoid duplicate
-        elif message.from_user == self.get_me() and 'first_call' not in state['__memory__']:
-            state['__memory__']['first_call'] = True
-            return
+        due = self.book_schedule.pop_due(now.timestamp())
+        sent = deferred = 0
 
-        # that is first message coming from this chat_id: reschedule a job to 3 hours from now
-        if 'last_time' not in state:
-            state['last_time'] = datetime.datetime.now(tz=AJU_TZ)
-            schedule_job(3 * 3600)
+        for chat_id in due:
+            try:
+                delay, has_sent = self.__check_daily_book(chat_id, now)
+            except Exception as e:
+                logging.exception(e)
+                delay, has_sent = 3600, False
 
-        # otherwise: make checks to send the book
-        else:
-            count = state['messages_since']
-            last = state['last_time']
-            now = datetime.datetime.now(tz=AJU_TZ)
-            passed = now - last
+            # daily book disabled: the chat is scheduled again on its next message
+            if delay is None:
+                continue
 
-            # how many hours in an interval to check the book again
-            def between(h1, h2):
-                return random.randint(h1, h2) * 3600
+            self.__schedule_book(chat_id, self.get_state('daily_book', chat_id), now.timestamp() + delay)
+            if has_sent:
+                sent += 1
+            else:
+                deferred += 1
 
-            # consider to send only if has passed at least 3 hours since last sent book
-            if passed.days == 0 and passed.seconds < 3 * 3600:
-                schedule_job(between(3, 12))  # reschedule a job to some hours from now
-                return
+        self.book_sweep_stats = util.AttributeDict(due=len(due), sent=sent, deferred=deferred)
+        for key, value in self.book_sweep_stats.items():
+            metrics.registry.set('daily_book_sweep_chats', value, result=key)
+        metrics.registry.set('daily_book_scheduled_chats', len(self.book_schedule))
+        if due:
+            logging.info("daily_book_sweep: due=%d sent=%d deferred=%d", len(due), sent, deferred)
 
-            should_send = (                                     # we should send if
-                passed.days >= 1                                # has passed 1 day or more since last book was sent
-                or count >= 25 and passed.seconds >= 12 * 3600  # passed 25 messages and 12 hours or more
-                or count >= 100 and passed.seconds >= 6 * 3600  # passed 100 messages and 6 hours or more
-                or count >= 300                                 # passed 300 messages and 3 hours or more
-            )
+        return self.book_sweep_stats
 
-            # book should be sent now
-            if should_send:
-                self.warn_auto_message(message.chat_id)
-                self.packtpub_free_learning(message, now, reply=False)
-                logging.info("ensure_daily_book: sent to %s", message.chat.username)
-                schedule_job(between(12, 24))  # reschedule a job to a bunch of hours from now
-            # or no sending at the moment
-            else:
-                hours = passed.seconds // 3600
-                schedule_job(between(1, 24 - hours))  # reschedule a job to a fair time
+    def __check_daily_book(self, chat_id, now):
+        state = self.get_state('daily_book', chat_id)
+        chat_name = state.get('chat')
 
-    def __daily_book_scheduler(self, state, message):
-        my = state['__memory__']
+        # the chat moved to another worker of the cluster
+        if self.cluster and not self.cluster.owns(chat_id):
+            return None, False
 
-        if 'schedule_fn' in my:
-            return my['schedule_fn']
+        group = self.resources.get_group(chat_id, chat_name)
+        if not group.has_daily_book:
+            return None, False
 
-        with self.state_access['lock']:
-            if 'schedule_fn' in my:  # avoiding possibility of duplicated work
-                return my['schedule_fn']
+        # how many hours in an interval to check the book again
+        def between(h1, h2):
+            return random.randint(h1, h2) * 3600
 
-            cb = lambda bot, job, msg=message: self.ensure_daily_book(msg, as_job=True)
+        # that is first check for this chat: check again 3 hours from now
+        if 'last_time' not in state:
+            state['last_time'] = now
+            return 3 * 3600, False
 
-            def schedule_job(seconds, to_log=True, job_callback=cb, chat_name=message.chat.username):
-                self.updater.job_queue.run_once(job_callback, when=seconds)
-                if to_log:
-                    logging.info("ensure_daily_book: %s scheduled to %d hours from now", chat_name, seconds // 3600)
+        count = state.get('messages_since', 0)
+        passed = now - state['last_time']
 
-            my['schedule_fn'] = schedule_job
+        # consider to send only if has passed at least 3 hours since last sent book
+        if passed.days == 0 and passed.seconds < 3 * 3600:
+            return between(3, 12), False
 
-            # there is no daily book job yet: schedule it now!
-            schedule_job(60, to_log=False)
+        should_send = (                                     # we should send if
+            passed.days >= 1                                # has passed 1 day or more since last book was sent
+            or count >= 25 and passed.seconds >= 12 * 3600  # passed 25 messages and 12 hours or more
+            or count >= 100 and passed.seconds >= 6 * 3600  # passed 100 messages and 6 hours or more
+            or count >= 300                                 # passed 300 messages and 3 hours or more
+        )
 
-            return schedule_job
+        # a previous owner of the chat has just sent it, with a state not yet saved
+        if should_send and self.cluster and not self.cluster.claim('daily_book:%d' % chat_id, BOOK_CLAIM_TTL):
+            state['last_time'] = now
+            return between(12, 24), False
+
+        # book should be sent now
+        if should_send:
+            self.warn_auto_message(chat_id)
+            chat_type = self.chats.chat_type(chat_id) or telegram.Chat.GROUP
+            message = telegram.Message(0, self.get_me(), now, telegram.Chat(chat_id, chat_type, username=chat_name))
+            self.packtpub_free_learning(message, now, reply=False)
+            logging.info("daily_book_sweep: sent to %s", chat_name)
+            return between(12, 24), True  # check again in a bunch of hours from now
+
+        # or no sending at the moment
+        hours = passed.seconds // 3600
+        return between(1, 24 - hours), False  # check again in a fair time
+
+    @task(each=300)
+    def refresh_chats(self):
+        # in a cluster, only the leader asks Telegram about the chats
+        refreshed = 0
+        if self.cluster is None or self.cluster.is_leader:
+            refreshed = self.chats.refresh(self.bot.get_chat)
+        saved = self.chats.flush()
+        if refreshed or saved:
+            logging.info("refresh_chats: %d refreshed, %d saved", refreshed, saved)
+
+    @task(each=3600, singleton=True)
+    def prune_leases(self):
+        if self.cluster:
+            self.cluster.prune()
 
     @task(daily=datetime.time(0, 0))
     def clear_stale_states(self, as_task=True):
@@ -321,25 +585,29 @@ class GDGAjuBot:
             logging.info("Clearing stale chats states")
             self.dump_states()
 
-        now = datetime.datetime.now(AJU_TZ)
-        all_stats = self.states['chat_stats']
-        staled_chats = set()
+        now = datetime.datetime.now(AJU_TZ).timestamp()
+        thresholds = self.config.stale_days
+        removed = 0
 
+        # the index gives the stale chats of each state kind without
+        # visiting the active ones
         for state_id, chat_states in self.states.items():
-            for chat_id in chat_states:
-                if chat_id in staled_chats:
-                    continue
+            days = thresholds.get(state_id, thresholds['default'])
+            for chat_id in self.activity.older_than(now - days * 86400):
+                if chat_states.pop(chat_id, None) is not None:
+                    removed += 1
 
-                if chat_id not in all_stats:
-                    staled_chats.add(chat_id)
-                    continue
+        # chats stale for every kind of state leave the index too
+        longest = max(thresholds.values())
+        for chat_id in self.activity.older_than(now - longest * 86400):
+            self.activity.discard(chat_id)
 
-                stats = all_stats[chat_id]
-                if 'last_activity' not in stats or (now - stats['last_activity']).days >= 1:
-                    staled_chats.add(chat_id)
+        if removed:
+            logging.info("clear_stale_states: %d chat states removed from memory", removed)
 
-        for chat_id, states in itertools.product(staled_chats, self.states.values()):
-            states.pop(chat_id, None)
+    @task(each=JOURNAL_FLUSH_INTERVAL)
+    def flush_journal(self):
+        self.resources.flush_journal()
 
     @task(each=600)
     @command('/dump_states', admin=True)
@@ -542,6 +810,281 @@ class GDGAjuBot:
         response = '\n'.join([str(user) for user in users])
         self.bot.send_message(message.chat.id, response)
 
+    @command('/stats', admin=True)
+    def stats(self, message):
+        """Resumo das métricas dos handlers, dos mais custosos aos menos."""
+        summary = sorted(metrics.registry.handler_summary(**self.metric_labels).values(), key=lambda h: -h['total'])
+        if not summary:
+            response = 'Nenhuma métrica registrada ainda.'
+        else:
+            lines = ['%-24s %7s %5s %9s %9s' % ('handler', 'calls', 'errs', 'avg ms', 'p95 ms')]
+            for h in summary[:20]:
+                lines.append('%-24s %7d %5d %9.1f %9.1f' % (
+                    '%s:%s' % (h['kind'], h['handler']), h['calls'], h['errors'], h['avg'] * 1000, h['p95'] * 1000,
+                ))
+            response = '<pre>%s</pre>' % '\n'.join(lines)
+        self.bot.send_message(message.chat.id, response, parse_mode='HTML')
+
+    def __activity_scope(self, message, args):
+        # in a private chat, the admin sees every chat together
+        try:
+            days = min(max(int(args[0]), 1), ACTIVITY_MAX_DAYS) if args else ACTIVITY_DAYS
+        except ValueError:
+            return None
+        chat_id = None if message.chat.type == telegram.Chat.PRIVATE else message.chat_id
+        since = datetime.datetime.now(AJU_TZ).date() - datetime.timedelta(days=days - 1)
+        return chat_id, since, days
+
+    @command('/top', pass_args=True, admin=True)
+    def top_users(self, message, args):
+        """Usuários com mais mensagens no chat nos últimos dias (em conversa privada, em todos os chats)."""
+        scope = self.__activity_scope(message, args)
+        if scope is None:
+            message.reply_html('<i>Modo de uso:</i>\n/top [dias]', quote=True)
+            return
+        chat_id, since, days = scope
+
+        top = self.resources.top_users(chat_id, since)
+        if not top:
+            response = 'Nenhuma mensagem nos últimos %d dias.' % days
+        else:
+            lines = ['%2d. %-24s %7d' % (i, name[:24], n) for i, (name, n) in enumerate(top, 1)]
+            response = '<b>Mais ativos nos últimos %d dias</b>\n<pre>%s</pre>' % (days, html.escape('\n'.join(lines)))
+        self.bot.send_message(message.chat.id, response, parse_mode='HTML')
+
+    @command('/activity', pass_args=True, admin=True)
+    def chat_activity(self, message, args):
+        """Mensagens por dia e por hora do dia no chat nos últimos dias (em conversa privada, em todos os chats)."""
+        scope = self.__activity_scope(message, args)
+        if scope is None:
+            message.reply_html('<i>Modo de uso:</i>\n/activity [dias]', quote=True)
+            return
+        chat_id, since, days = scope
+
+        per_day, per_hour = self.resources.chat_activity(chat_id, since)
+        total = sum(n for _, n in per_day)
+        if not total:
+            self.bot.send_message(message.chat.id, 'Nenhuma mensagem nos últimos %d dias.' % days)
+            return
+
+        top_day, top_hour = max(n for _, n in per_day), max(per_hour)
+        lines = ['%d mensagens nos últimos %d dias' % (total, days), '', 'Por dia:']
+        lines.extend('%s %6d %s' % (day.strftime('%d/%m'), n, bar(n, top_day)) for day, n in per_day)
+        lines.extend(['', 'Por hora:'])
+        lines.extend('%02dh %7d %s' % (hour, n, bar(n, top_hour)) for hour, n in enumerate(per_hour) if n)
+        self.bot.send_message(message.chat.id, '<pre>%s</pre>' % '\n'.join(lines), parse_mode='HTML')
+
+    @command('/search')
+    def search_messages(self, message):
+        """Busca nas mensagens registradas do chat (admins, em conversa privada, em todos os chats)."""
+        usage = '<i>Modo de uso:</i>\n' \
+                '/search [--pagina N] &lt;termos&gt; - mensagens com todos os termos'
+
+        is_admin = self.resources.is_user_admin(message.from_user.id)
+        private = message.chat.type == telegram.Chat.PRIVATE
+        if not is_admin and not self.get_state('search', message.chat_id).get('open'):
+            message.reply_text("A busca neste chat é restrita aos admins", quote=True)
+            return
+
+        parts = (message.text or '').split(None, 1)
+        text, page = parts[1].strip() if len(parts) > 1 else '', 1
+        match = re.match(r'--pagina\s+(\d+)\s*', text)
+        if match:
+            text, page = text[match.end():], max(int(match.group(1)), 1)
+        if not text:
+            message.reply_html(usage, quote=True)
+            return
+
+        found = self.resources.search_messages(
+            text, None if private and is_admin else message.chat_id, page=page, page_size=SEARCH_PAGE_SIZE,
+            budget=self.config.search_budget,
+        )
+        if not found.total:
+            message.reply_html('Nenhuma mensagem com <i>%s</i>' % html.escape(text), quote=True)
+            return
+
+        pages = -(-found.total // SEARCH_PAGE_SIZE)
+        lines = ['<b>%d resultados</b> para <i>%s</i> (página %d de %d)' % (
+            found.total, html.escape(text), min(page, pages), pages)]
+        for result in found.results:
+            lines.append('\n<b>%s</b>, %s\n%s' % (
+                html.escape(result.sent_by), analytics.local_time(result.sent_at).strftime('%d/%m/%Y %Hh%M'),
+                html.escape(textwrap.shorten(result.text, SEARCH_SNIPPET, placeholder=' …'))))
+        if page < pages:
+            lines.append('\nPróxima página: <code>/search --pagina %d %s</code>' % (page + 1, html.escape(text)))
+        if found.partial:
+            lines.append('\n<i>Resultado parcial: termos muito comuns ou busca demorada.</i>')
+        message.reply_html('\n'.join(lines), quote=True, disable_web_page_preview=True)
+
+    @command('/search_mode', pass_args=True, admin=True)
+    def search_mode(self, message, args):
+        usage = '<i>Modo de uso:</i>\n' \
+                '/search_mode on|off - liberar/restringir aos admins o /search neste chat'
+
+        def friendly_status(status, help=False):
+            adverb = 'liberada a todos' if status else 'restrita aos admins'
+            suffix = '\n\n' + usage if help else ''
+            return 'Busca <b>%s</b>%s' % (adverb, suffix)
+
+        state = self.get_state('search', message.chat_id)
+        if len(args) == 0:
+            message.reply_html(friendly_status(state.get('open', False), help=True), quote=True)
+
+        elif args[0].lower() not in ('on', 'off'):
+            message.reply_html('Argumento <code>%s</code> inválido!!!\n\n%s' % (args[0], usage), quote=True)
+
+        else:
+            state['open'] = args[0].lower() == 'on'
+            message.reply_html(friendly_status(state['open']), quote=True)
+
+    @command('/search_rebuild', admin=True)
+    def search_rebuild(self, message):
+        """Reconstrói em segundo plano o índice de busca de todas as mensagens registradas."""
+        last = self.resources.start_search_rebuild()
+        message.reply_html('Reconstrução do índice agendada, até a mensagem <b>#%d</b>' % last, quote=True)
+
+    @task(each=30, singleton=True)
+    def backfill_messages(self):
+        """Processa em lotes as mensagens pendentes dos contadores de atividade e do índice de busca."""
+        if self.overload.overloaded():
+            return
+        deadline = time.monotonic() + BACKFILL_BUDGET
+        for job in (self.resources.backfill_rollups, self.resources.rebuild_search_index):
+            processed = self.__run_batches(job, deadline)
+            if processed:
+                logging.info("%s: %d mensagens processadas", job.__name__, processed)
+
+    @task(each=SEARCH_INDEX_INTERVAL, singleton=True)
+    def index_messages(self):
+        """Indexa para o /search, em lotes, as mensagens registradas desde a última execução."""
+        if self.overload.overloaded():
+            return
+        processed = self.__run_batches(self.resources.index_messages, time.monotonic() + BACKFILL_BUDGET)
+        if processed:
+            logs.per_message.info("index_messages: %d mensagens indexadas", processed)
+
+    @staticmethod
+    def __run_batches(job, deadline):
+        processed = 0
+        while time.monotonic() < deadline:
+            n = job(BACKFILL_BATCH)
+            if not n:
+                break
+            processed += n
+        return processed
+
+    @task(daily=datetime.time(3, 0), singleton=True)
+    def apply_retention(self):
+        """Arquiva e remove as mensagens vencidas, em segundo plano."""
+        if self.retention.start(should_wait=self.overload.overloaded):
+            logging.info("Retenção das mensagens iniciada")
+
+    @command('/broadcast', admin=True)
+    def send_broadcast(self, message):
+        """Envia um aviso aos grupos com livro diário ou, com --todos, a todos os grupos conhecidos."""
+        usage = '<i>Modo de uso:</i>\n' \
+                '/broadcast &lt;texto&gt; - envia aos grupos com livro diário\n' \
+                '/broadcast --todos &lt;texto&gt; - envia a todos os grupos'
+
+        # the text keeps its line breaks, which the command arguments would lose
+        parts = (message.text or '').split(None, 1)
+        text = parts[1].strip() if len(parts) > 1 else ''
+        audience = 'daily_book'
+        if text.startswith('--todos'):
+            audience, text = 'all', text[len('--todos'):].strip()
+        if not text:
+            message.reply_html(usage, quote=True)
+            return
+
+        broadcast_id = self.broadcaster.start(
+            text, audience, created_by=message.from_user.name, report_to=message.chat_id,
+            on_done=self.broadcast_report,
+        )
+        message.reply_html('Aviso <b>#%d</b> em envio' % broadcast_id, quote=True)
+
+    def broadcast_report(self, report):
+        if report.finished and report.report_to:
+            self.bot.send_message(
+                report.report_to, 'Aviso #%d enviado: %d entregues, %d falhas em %.1fs' % (
+                    report.id, report.delivered, report.failed, report.elapsed),
+            )
+
+    @task(each=60, singleton=True)
+    def resume_broadcasts(self):
+        self.broadcaster.resume(on_done=self.broadcast_report)
+
+    @command('/profile', pass_args=True, admin=True)
+    def profile(self, message, args):
+        """Amostra os handlers em execução por alguns segundos e responde com as funções mais custosas."""
+        usage = '<i>Modo de uso:</i>\n/profile &lt;segundos&gt; - até %d segundos' % profiler.MAX_SECONDS
+        try:
+            seconds = float(args[0])
+        except (IndexError, ValueError):
+            message.reply_html(usage, quote=True)
+            return
+        if not 0 < seconds <= profiler.MAX_SECONDS:
+            message.reply_html(usage, quote=True)
+            return
+
+        chat_id = message.chat_id
+
+        def report(result, path):
+            logging.info("Profiling salvo em %s", path)
+            self.bot.send_message(
+                chat_id,
+                '<pre>%s</pre>\n%d amostras em %.0fs, salvas em <code>%s</code>' % (
+                    html.escape(result.format_top()), result.samples, result.duration, path),
+                parse_mode='HTML',
+            )
+
+        if profiler.session.start(seconds, self.config.profile_dir, report):
+            message.reply_html('Profiling iniciado por %gs' % seconds, quote=True)
+        else:
+            message.reply_html('Já há um profiling em andamento', quote=True)
+
+    @command('/memory', pass_args=True, admin=True)
+    def memory_report(self, message, args):
+        """Entradas e bytes estimados das estruturas do bot.
+
+        Com `start`, `diff` e `stop`, controla a comparação de alocações do tracemalloc.
+        """
+        action = args[0].lower() if args else None
+
+        if action == 'start':
+            memory.tracker.start()
+            response = 'Rastreamento de alocações iniciado. Use <code>/memory diff</code> para comparar.'
+        elif action == 'diff':
+            if not memory.tracker.active:
+                response = 'Rastreamento inativo. Use <code>/memory start</code> antes.'
+            else:
+                lines = ['%10s %8s  %s' % ('bytes', 'blocos', 'linha')]
+                for stat in memory.tracker.diff():
+                    frame = stat.traceback[0]
+                    lines.append('%+10d %+8d  %s:%d' % (
+                        stat.size_diff, stat.count_diff, frame.filename.rsplit('/', 1)[-1], frame.lineno))
+                response = '<pre>%s</pre>' % html.escape('\n'.join(lines))
+        elif action == 'stop':
+            memory.tracker.stop()
+            response = 'Rastreamento de alocações encerrado.'
+        else:
+            rows = memory.report(self)
+            memory.publish(rows)
+            lines = ['%-28s %8s %10s' % ('estrutura', 'entradas', 'tamanho')]
+            for name, entries, size in sorted(rows, key=lambda row: -row[2]):
+                lines.append('%-28s %8d %10s' % (name[:28], entries, memory.format_size(size)))
+            rss = memory.process_rss()
+            if rss is not None:
+                lines.append('\nRSS do processo: %s' % memory.format_size(rss))
+            response = '<pre>%s</pre>' % html.escape('\n'.join(lines))
+
+        self.bot.send_message(message.chat.id, response, parse_mode='HTML')
+
+    @task(each=300)
+    def publish_memory_metrics(self):
+        # only useful when there is an endpoint to collect the metrics
+        if self.config.metrics_port:
+            memory.publish(memory.report(self))
+
     @easter_egg(r"(?i)\bRUBY\b")
     def love_ruby(self, message):
         """Easter Egg com o Ruby."""
@@ -564,6 +1107,43 @@ class GDGAjuBot:
         logging.info("%s: %s", message.from_user.name, "python")
         self.bot.send_message(message.chat.id, "import antigravity")
 
+    def __start_webhook(self):
+        config = self.config
+        secret = config.webhook_secret or webhook.new_secret()
+        host, _, port = config.webhook_listen.rpartition(':')
+        self.webhook = webhook.WebhookServer(
+            self.bot, self.updater.update_queue, secret, host or '0.0.0.0', int(port),
+            workers=config.webhook_workers, max_body=config.webhook_max_body,
+            router=self.cluster.route if self.cluster else None,
+        )
+
+        # No cluster, entra antes das tasks, que só devem ver os chats deste worker
+        if self.cluster:
+            self.cluster.heartbeat()
+        # As pendências só podem ser lidas com o webhook desativado
+        elif config.catch_up:
+            self.bot.delete_webhook()
+            self.catch_up()
+
+        # Sem o polling, o dispatcher e as tasks são iniciados aqui
+        self.updater.running = True
+        self.updater.job_queue.start()
+        Thread(target=self.updater.dispatcher.start, name='dispatcher').start()
+        self.webhook.start()
+
+        if config.webhook_url:
+            # the secret goes only in the path: set_webhook has no secret_token in python-telegram-bot 10
+            self.bot.set_webhook(url=config.webhook_url.rstrip('/') + self.webhook.path)
+            logging.info("Recebendo atualizações por webhook em %s", config.webhook_listen)
+        else:
+            # only the leader polls; the other workers receive what is theirs on the webhook server
+            self.cluster.poll(self.bot)
+            logging.info("Recebendo atualizações do líder do cluster em %s", config.webhook_listen)
+
+        if self.cluster:
+            self.cluster.start()
+            logging.info("Worker %s no cluster com %s", self.cluster.worker_id, ', '.join(sorted(self.cluster.members)))
+
     def get_me(self):
         try:
             return self.__get_me
@@ -572,8 +1152,23 @@ class GDGAjuBot:
             return self.__get_me
 
     def start(self):
-        self.updater.start_polling(clean=True)
+        if self.config.webhook_url or self.cluster:
+            with startup.phase('start webhook'):
+                self.__start_webhook()
+        else:
+            with startup.phase('start polling'):
+                if self.config.catch_up:
+                    self.catch_up()
+                self.updater.start_polling(clean=not self.config.catch_up)
+        if self.config.metrics_port:
+            metrics.MetricsServer(self.config.metrics_port).start()
+            logging.info("Métricas disponíveis em :%d/metrics", self.config.metrics_port)
+        if self.config.watchdog_threshold:
+            watchdog.monitor.threshold = self.config.watchdog_threshold
+            watchdog.monitor.start()
         logging.info("GDGAjuBot iniciado")
+        if self.config.startup_profile:
+            logging.info("Duração da inicialização:\n%s", startup.profile.report())
         logging.info("Este é o bot do %s", self.config.group_name)
         if self.config.debug_mode:
             logging.info("Modo do desenvolvedor ativado")
@@ -0,0 +1,193 @@
+"""Envio de avisos a muitos chats de uma vez.
+
+Os destinatários são lidos da tabela `Group` em páginas, na ordem dos ids, e
+enviados por um número limitado de threads, sob um limite global de
+mensagens por segundo (o Telegram aceita cerca de 30). Ao fim de cada página
+o progresso é gravado no banco: um envio interrompido é retomado a partir da
+última página concluída, repetindo no máximo uma página.
+
+Quem envia um aviso detém no banco uma concessão (`Lease`) dele, renovada a
+cada página, para um aviso nunca ser enviado por dois processos ao mesmo
+tempo. No modo multi-tenant, cada aviso vai só para os grupos do tenant que
+o criou e só é retomado por ele.
+"""
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+import telegram
+
+from gdgajubot import metrics, util
+from gdgajubot.overload import TokenBucket
+
+# públicos aceitos: os grupos com livro diário ou todos os grupos conhecidos
+AUDIENCES = ('daily_book', 'all')
+
+# tentativas de envio a um chat antes de contá-lo como falha
+MAX_ATTEMPTS = 3
+
+# prefixo das concessões dos avisos em envio
+LEASE_PREFIX = 'broadcast:'
+
+# validade, em segundos, da concessão de um aviso, renovada a cada página
+LEASE_TTL = 300
+
+# erros em que uma nova tentativa não adianta (bot bloqueado ou removido, chat inexistente)
+PERMANENT_ERRORS = (telegram.error.BadRequest, telegram.error.Unauthorized, telegram.error.ChatMigrated)
+
+
+class RateLimiter:
+    """Libera no máximo `rate` chamadas por segundo, somadas entre as threads."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._bucket = TokenBucket(burst, time.monotonic())
+        self._paused_until = 0
+        self._lock = Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._bucket.take(self.rate, self.burst, now):
+                    return
+                else:
+                    delay = (1 - self._bucket.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Suspende todas as chamadas por `seconds` (pedido de espera do Telegram)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    """
+    :param send: função com a assinatura de `bot.send_message`
+    :param concurrency: envios simultâneos
+    :param rate: mensagens por segundo, no total
+    :param page_size: chats lidos do banco (e gravados no progresso) por vez
+    :param lease_ttl: validade, em segundos, da concessão de cada aviso em envio
+    """
+
+    def __init__(self, send, resources, concurrency=8, rate=25, page_size=100, lease_ttl=LEASE_TTL):
+        self.send = send
+        self.resources = resources
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.page_size = page_size
+        self.lease_ttl = lease_ttl
+        # unique per process (and tenant), as the holder of the leases
+        self.holder = uuid.uuid4().hex
+        self._running = set()
+        self._lock = Lock()
+
+    def start(self, text, audience='daily_book', created_by=None, report_to=None, on_done=None):
+        """Registra o aviso e o envia em segundo plano; retorna o id do aviso."""
+        if audience not in AUDIENCES:
+            raise ValueError("público inválido: %s" % audience)
+        broadcast_id = self.resources.create_broadcast(text, audience, created_by, report_to)
+        self.spawn(broadcast_id, on_done)
+        return broadcast_id
+
+    def resume(self, on_done=None):
+        """Retoma os avisos interrompidos; retorna os ids retomados."""
+        pending = [broadcast_id for broadcast_id in self.resources.pending_broadcasts()
+                   if self.spawn(broadcast_id, on_done)]
+        if pending:
+            logging.info("Broadcast: retomando os avisos %s", pending)
+        return pending
+
+    def spawn(self, broadcast_id, on_done=None):
+        with self._lock:
+            if broadcast_id in self._running:
+                return False
+            self._running.add(broadcast_id)
+        # another process is sending it
+        if not self.acquire(broadcast_id):
+            with self._lock:
+                self._running.discard(broadcast_id)
+            return False
+
+        def run():
+            try:
+                report = self.run(broadcast_id)
+                if on_done is not None:
+                    on_done(report)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                with self._lock:
+                    self._running.discard(broadcast_id)
+
+        Thread(target=run, name='Broadcast-%d' % broadcast_id, daemon=True).start()
+        return True
+
+    def run(self, broadcast_id):
+        """Envia o aviso a partir do último progresso gravado e retorna o relatório final."""
+        resources = self.resources
+        broadcast = resources.get_broadcast(broadcast_id)
+        delivered, failed, after = broadcast.delivered, broadcast.failed, broadcast.last_chat_id
+        elapsed, start = broadcast.elapsed, time.perf_counter()
+
+        finished = True
+        try:
+            with ThreadPoolExecutor(self.concurrency, thread_name_prefix='broadcast') as pool:
+                while True:
+                    # the lease expired and another process took over the broadcast
+                    if not self.acquire(broadcast_id):
+                        logging.warning("Broadcast #%d: assumido por outro processo", broadcast_id)
+                        finished = False
+                        break
+                    page = resources.broadcast_recipients(broadcast.audience, after, self.page_size)
+                    if not page:
+                        break
+                    results = list(pool.map(lambda chat_id: self.deliver(chat_id, broadcast.text), page))
+                    delivered += sum(results)
+                    failed += len(results) - sum(results)
+                    after = page[-1]
+                    resources.checkpoint_broadcast(broadcast_id, after, delivered, failed,
+                                                   elapsed + time.perf_counter() - start)
+
+            elapsed += time.perf_counter() - start
+            if finished:
+                resources.checkpoint_broadcast(broadcast_id, after, delivered, failed, elapsed, finished=True)
+                metrics.observe('broadcast_seconds', elapsed)
+                logging.info("Broadcast #%d: %d entregues, %d falhas em %.1fs",
+                             broadcast_id, delivered, failed, elapsed)
+        finally:
+            resources.release_lease(LEASE_PREFIX + str(broadcast_id), self.holder)
+        return util.AttributeDict(id=broadcast_id, report_to=broadcast.report_to, finished=finished,
+                                  delivered=delivered, failed=failed, elapsed=elapsed)
+
+    def acquire(self, broadcast_id):
+        return self.resources.acquire_lease(LEASE_PREFIX + str(broadcast_id), self.holder, self.lease_ttl)
+
+    def deliver(self, chat_id, text):
+        """Envia a um chat, respeitando o limite e os pedidos de espera do Telegram."""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.limiter.wait()
+            try:
+                self.send(chat_id, text)
+                metrics.inc('broadcast_messages_total', result='delivered')
+                return True
+            except telegram.error.RetryAfter as e:
+                self.limiter.pause(e.retry_after)
+            except PERMANENT_ERRORS as e:
+                # blocked, kicked or gone: trying again won't help
+                logging.info("Broadcast: chat %s recusou o aviso: %s", chat_id, e)
+                break
+            except telegram.error.TelegramError as e:
+                if attempt == MAX_ATTEMPTS:
+                    logging.warning("Broadcast: falha ao enviar para %s: %s", chat_id, e)
+        metrics.inc('broadcast_messages_total', result='failed')
+        return False
+
+
+metrics.registry.describe('broadcast_messages_total', 'Mensagens de avisos enviadas, por resultado')
+metrics.registry.describe('broadcast_seconds', 'Duração total dos envios de avisos')
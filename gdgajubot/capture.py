@@ -0,0 +1,189 @@
+"""Captura de atualizações do Telegram e reprodução em escala de tempo.
+
+A captura grava cada atualização recebida como uma linha JSON em um arquivo
+gzip, opcionalmente anonimizando usuários, chats e textos. A reprodução
+passa a captura pelo `Dispatcher` de um bot de mentira (ver `bench`)::
+
+    $ python -m gdgajubot.capture captura.jsonl.gz --speed 10
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+from threading import RLock
+
+import telegram
+from telegram.ext import TypeHandler
+
+# palavras preservadas na anonimização, para as capturas ainda
+# acionarem os easter eggs
+KEPT_WORDS = re.compile(r'(?i)^(ruby|java|python)$')
+
+# campos que identificam pessoas ou chats
+ID_FIELDS = ('from', 'chat', 'user', 'forward_from', 'forward_from_chat', 'left_chat_member')
+NAME_FIELDS = ('username', 'first_name', 'last_name', 'title')
+
+
+class Anonymizer:
+    """Substitui identificadores e textos de forma determinística para um mesmo `salt`."""
+
+    def __init__(self, salt=None):
+        self.salt = salt.encode() if isinstance(salt, str) else (salt or os.urandom(16))
+
+    def hash_id(self, value):
+        digest = hashlib.blake2b(str(value).encode(), key=self.salt, digest_size=6).digest()
+        hashed = int.from_bytes(digest, 'big') or 1
+        return -hashed if value < 0 else hashed
+
+    def hash_name(self, value):
+        return 'anon_' + hashlib.blake2b(value.encode(), key=self.salt, digest_size=4).hexdigest()
+
+    @staticmethod
+    def mask_text(text):
+        # keeps commands, kept words and word lengths (entity offsets stay valid)
+        def mask(match):
+            word = match.group(0)
+            if word.startswith('/') or KEPT_WORDS.match(word):
+                return word
+            return 'x' * len(word)
+        return re.sub(r'\S+', mask, text)
+
+    def __call__(self, data):
+        if isinstance(data, list):
+            return [self(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+
+        result = {}
+        for key, value in data.items():
+            if key in ID_FIELDS and isinstance(value, dict):
+                value = dict(value)
+                if 'id' in value:
+                    value['id'] = self.hash_id(value['id'])
+                for name in NAME_FIELDS:
+                    if value.get(name):
+                        value[name] = self.hash_name(value[name])
+                result[key] = value
+            elif key in ('text', 'caption') and isinstance(value, str):
+                result[key] = self.mask_text(value)
+            else:
+                result[key] = self(value)
+        return result
+
+
+class UpdateRecorder:
+    """Grava as atualizações recebidas em um arquivo JSONL compactado."""
+
+    # a compressão é descarregada no arquivo a cada tantas atualizações
+    FLUSH_EVERY = 100
+
+    def __init__(self, path, anonymize=False, salt=None):
+        self.path = path
+        self.anonymize = Anonymizer(salt) if anonymize else None
+        self.count = 0
+        self._lock = RLock()
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+
+    def install(self, dispatcher):
+        """Registra o gravador antes de todos os outros handlers."""
+        dispatcher.add_handler(TypeHandler(telegram.Update, lambda _, update: self.record(update)), group=-2)
+
+    def record(self, update):
+        data = update.to_dict()
+        if self.anonymize:
+            data = self.anonymize(data)
+        line = json.dumps({'t': time.time(), 'u': data}, ensure_ascii=False) + '\n'
+
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line)
+            self.count += 1
+            if self.count % self.FLUSH_EVERY == 0:
+                self._file.flush()
+
+    def close(self):
+        """Finaliza o arquivo; as atualizações seguintes são ignoradas."""
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def read_capture(path):
+    """Gera pares (timestamp, dados da atualização) de uma captura.
+
+    Uma captura de um bot que não fechou o gravador termina no meio do gzip:
+    a leitura para na última linha completa.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as capture:
+        while True:
+            try:
+                line = capture.readline()
+            except (EOFError, OSError) as e:
+                logging.warning("Captura truncada, lida até a última linha completa: %s", e)
+                return
+            if not line:
+                return
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the capture may end in a partial line if the bot was killed
+                logging.warning("Linha corrompida na captura, ignorada")
+                continue
+            yield record['t'], record['u']
+
+
+def replay(path, speed=1.0, allocations=False, g_bot=None):
+    """Reproduz a captura contra um bot de mentira.
+
+    :param speed: fator de aceleração sobre os intervalos originais;
+        0 reproduz na velocidade máxima.
+    """
+    from gdgajubot import bench
+
+    g_bot = g_bot or bench.make_bot()
+    records = list(read_capture(path))
+    updates = [telegram.Update.de_json(data, g_bot.bot) for _, data in records]
+
+    offsets = None
+    if speed and records:
+        first = records[0][0]
+        offsets = [(t - first) / speed for t, _ in records]
+
+    workload = bench.Workload(messages=len(updates))
+    report = bench.run(workload, allocations=allocations, g_bot=g_bot, updates=updates, offsets=offsets)
+    report['workload'] = {'capture': path, 'speed': speed or 'max'}
+    return report
+
+
+def main(argv=None):
+    from gdgajubot import bench
+
+    parser = argparse.ArgumentParser(description='Reproduz uma captura de atualizações do GDGAjuBot')
+    parser.add_argument('capture', help='Arquivo de captura (.jsonl.gz)')
+    parser.add_argument('--speed', default='1', help="Aceleração: 1, 10, ... ou 'max'")
+    parser.add_argument('--allocations', action='store_true', help='Mede também as alocações')
+    parser.add_argument('--save', help='Salva o resultado neste arquivo')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Mostra os logs do bot')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    speed = 0 if args.speed == 'max' else float(args.speed)
+    report = replay(args.capture, speed=speed, allocations=args.allocations)
+    print(bench.format_report(report))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""Vários processos (workers) do mesmo bot, cada um atendendo parte dos chats.
+
+Cada worker mantém no banco uma concessão (`Lease`) com o próprio endereço e
+a renova periodicamente; os workers com concessão válida formam o cluster.
+Cada chat pertence a um único worker, escolhido por hashing de rendezvous
+sobre os membros, de modo que a saída ou entrada de um worker só move os
+chats dele. Os estados em memória e a agenda do livro diário de um chat
+ficam apenas no worker dono.
+
+O Telegram só aceita um consumidor de `getUpdates` por token: no modo
+polling, apenas o líder (detentor da concessão `leader`) busca as
+atualizações. Em qualquer modo, o worker que recebe a atualização de um chat
+que não é seu a repassa ao webhook do dono. Quando um worker para de renovar
+a concessão, os outros assumem os chats dele e, se era o líder, um deles
+passa a buscar as atualizações.
+
+Ações que não podem se repetir na troca de dono, como o envio do livro
+diário, são protegidas por `claim`: uma concessão por chat que só o worker
+que enviou pode renovar até expirar.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import urllib.request
+from threading import Event, Thread
+
+from gdgajubot import metrics
+from gdgajubot.webhook import FORWARDED_HEADER, SECRET_HEADER
+
+LEADER = 'leader'
+MEMBER_PREFIX = 'worker:'
+
+# tempo limite (em segundos) do repasse de uma atualização a outro worker
+FORWARD_TIMEOUT = 5
+
+
+def rendezvous(key, members):
+    """Membro com o maior peso para `key`; cada chave escolhe seu dono de forma independente."""
+    return max(members, key=lambda member: hashlib.sha1(('%s:%s' % (member, key)).encode()).digest())
+
+
+class Cluster:
+    """
+    :param worker_id: identificação única do worker
+    :param url: endereço em que os outros workers alcançam o webhook deste
+    :param secret: segredo do webhook, comum a todos os workers
+    :param local_queue: fila do dispatcher deste worker
+    :param ttl: validade, em segundos, das concessões de membro e de líder
+    """
+
+    def __init__(self, resources, worker_id, url, secret, local_queue, ttl=30):
+        if not (url and secret):
+            raise ValueError("o modo cluster exige cluster_url e webhook_secret")
+        self.resources = resources
+        self.worker_id = worker_id
+        self.url = url
+        self.secret = secret
+        self.local_queue = local_queue
+        self.ttl = ttl
+        self.members = {worker_id: url}
+        self.is_leader = False
+        # called with no arguments when the members change
+        self.on_change = None
+        self._stop = Event()
+        self._threads = []
+
+    def heartbeat(self, now=None):
+        """Renova as concessões deste worker e atualiza a lista de membros."""
+        resources = self.resources
+        resources.acquire_lease(MEMBER_PREFIX + self.worker_id, self.worker_id, self.ttl, info=self.url, now=now)
+
+        leader = resources.acquire_lease(LEADER, self.worker_id, self.ttl, now=now)
+        if leader != self.is_leader:
+            logging.info("Cluster: %s %s o líder", self.worker_id, 'passou a ser' if leader else 'deixou de ser')
+        self.is_leader = leader
+
+        members = resources.live_leases(MEMBER_PREFIX, now=now)
+        members[self.worker_id] = self.url
+        metrics.registry.set('cluster_members', len(members))
+        metrics.registry.set('cluster_leader', int(leader))
+        changed = members.keys() != self.members.keys()
+        self.members = members
+        if changed:
+            logging.info("Cluster: membros %s", ', '.join(sorted(members)))
+            if self.on_change is not None:
+                self.on_change()
+
+    def owner(self, chat_id):
+        return rendezvous(chat_id, sorted(self.members))
+
+    def owns(self, chat_id):
+        return self.owner(chat_id) == self.worker_id
+
+    def claim(self, name, ttl):
+        """Reserva uma ação única por `ttl` segundos; False se outro worker a fez antes."""
+        claimed = self.resources.acquire_lease(name, self.worker_id, ttl)
+        if not claimed:
+            metrics.inc('cluster_claims_lost_total')
+        return claimed
+
+    def route(self, update):
+        """Processa a atualização aqui ou a repassa ao worker dono do chat."""
+        chat = update.effective_chat
+        owner = self.worker_id if chat is None else self.owner(chat.id)
+        if owner != self.worker_id:
+            try:
+                self.forward(self.members[owner], update)
+                metrics.inc('cluster_forwarded_updates_total', result='ok')
+                return
+            except (OSError, KeyError) as e:
+                # better answered by the wrong worker than not at all
+                logging.warning("Cluster: falha ao repassar a atualização a %s: %s", owner, e)
+                metrics.inc('cluster_forwarded_updates_total', result='error')
+        self.local_queue.put(update)
+
+    def forward(self, url, update):
+        request = urllib.request.Request(
+            url, data=json.dumps(update.to_dict()).encode('utf-8'), method='POST',
+            headers={'Content-Type': 'application/json', SECRET_HEADER: self.secret, FORWARDED_HEADER: '1'},
+        )
+        with urllib.request.urlopen(request, timeout=FORWARD_TIMEOUT):
+            pass
+
+    def start(self, interval=None):
+        """Inicia a renovação periódica das concessões."""
+        interval = interval or self.ttl / 3
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logging.exception(e)
+
+        self._spawn(run, 'ClusterHeartbeat')
+        return self
+
+    def poll(self, bot, timeout=10, idle=1.0):
+        """Busca as atualizações no Telegram enquanto este worker for o líder."""
+        def run():
+            offset, leading = None, False
+            while not self._stop.is_set():
+                if not self.is_leader:
+                    offset, leading = None, False
+                    self._stop.wait(idle)
+                    continue
+                try:
+                    # getUpdates is refused while a webhook is set
+                    if not leading:
+                        bot.delete_webhook()
+                        leading = True
+                    updates = bot.get_updates(offset=offset, timeout=timeout)
+                except Exception as e:
+                    logging.warning("Cluster: falha ao buscar atualizações: %s", e)
+                    self._stop.wait(idle)
+                    continue
+                # the offset confirmed to Telegram is where the next leader resumes
+                for update in updates:
+                    self.route(update)
+                    offset = update.update_id + 1
+
+        self._spawn(run, 'ClusterPolling')
+        return self
+
+    def _spawn(self, target, name):
+        thread = Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        """Para as threads e libera as concessões, para os outros assumirem logo."""
+        self._stop.set()
+        self.resources.release_lease(LEADER, self.worker_id)
+        self.resources.release_lease(MEMBER_PREFIX + self.worker_id, self.worker_id)
+
+    def prune(self, age=86400):
+        """Remove as concessões expiradas há mais de `age` segundos."""
+        return self.resources.prune_leases(datetime.datetime.utcnow() - datetime.timedelta(seconds=age))
+
+
+metrics.registry.describe('cluster_members', 'Workers ativos no cluster')
+metrics.registry.describe('cluster_leader', 'Indica se este worker é o líder do cluster')
+metrics.registry.describe('cluster_forwarded_updates_total', 'Atualizações repassadas ao worker dono do chat')
+metrics.registry.describe('cluster_claims_lost_total', 'Ações únicas já feitas por outro worker')
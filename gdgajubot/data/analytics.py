@@ -0,0 +1,44 @@
+"""Contadores de atividade (mensagens por chat, por usuário e por hora).
+
+Os contadores são somados na mesma transação que registra as mensagens, de
+modo que `/top` e `/activity` leem poucas linhas já agregadas em vez de
+percorrer a tabela `Message`. Os dias e horas são os do fuso de Aracaju.
+"""
+import datetime
+from collections import Counter
+
+from gdgajubot.util import AJU_TZ
+
+# chat ao qual são atribuídas as mensagens registradas antes de a tabela
+# `Message` guardar o chat de origem
+HISTORY_CHAT = 0
+
+# descrição do estado (no chat 0) com o progresso do backfill
+BACKFILL_STATE = 'rollup:backfill'
+
+
+def message_chat(chat_id):
+    return HISTORY_CHAT if chat_id is None else chat_id
+
+
+def local_time(sent_at):
+    # the database gives back UTC datetimes without tzinfo
+    if sent_at.tzinfo is None:
+        sent_at = sent_at.replace(tzinfo=datetime.timezone.utc)
+    return sent_at.astimezone(AJU_TZ)
+
+
+class Rollup:
+    """Contagens acumuladas em memória, gravadas de uma vez no banco."""
+
+    def __init__(self):
+        # (chat_id, day, hour) -> messages
+        self.chats = Counter()
+        # (chat_id, user_id, day) -> messages
+        self.users = Counter()
+
+    def add(self, chat_id, user_id, sent_at, n=1):
+        local = local_time(sent_at)
+        day = local.date()
+        self.chats[chat_id, day, local.hour] += n
+        self.users[chat_id, user_id, day] += n
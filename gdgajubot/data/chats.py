@@ -0,0 +1,138 @@
+import logging
+import time
+from threading import RLock
+
+import telegram
+
+from gdgajubot.util import AttributeDict
+
+
+class ChatRegistry:
+    """Metadados dos chats (username, título e tipo) servidos da memória.
+
+    O registro é preenchido passivamente a partir de `message.chat` e, para
+    os grupos e canais, persistido na tabela `Group`; os chats privados ficam
+    só na memória, para não receberem os avisos dos grupos. Entradas desconhecidas ou antigas são
+    atualizadas em lotes por `refresh`, fora dos handlers de mensagens.
+    """
+
+    # tempo (em segundos) para uma entrada ser considerada antiga
+    TTL = 24 * 3600
+
+    # quantidade máxima de chats consultados por passada de `refresh`
+    BATCH_SIZE = 50
+
+    def __init__(self, resources):
+        self.resources = resources
+        self._chats = {}
+        self._dirty = set()
+        self._wanted = set()
+        self._lock = RLock()
+
+    def load(self):
+        """Carrega os nomes de chats já persistidos."""
+        with self._lock:
+            for chat_id, username in self.resources.list_groups():
+                if chat_id not in self._chats:
+                    self._chats[chat_id] = self._entry(
+                        username=username, title=None,
+                        type=None if chat_id < 0 else telegram.Chat.PRIVATE,
+                        refreshed=0,
+                    )
+        return len(self._chats)
+
+    def observe(self, chat):
+        """Registra um `telegram.Chat` recebido em uma atualização."""
+        if chat is None:
+            return
+
+        entry = self._chats.get(chat.id)
+        if entry and entry.username == chat.username and entry.title == chat.title and entry.type == chat.type:
+            entry.refreshed = time.time()
+            return
+
+        with self._lock:
+            self._chats[chat.id] = self._entry(
+                username=chat.username, title=chat.title, type=chat.type, refreshed=time.time(),
+            )
+            self._dirty.add(chat.id)
+            self._wanted.discard(chat.id)
+
+    def get(self, chat_id):
+        """Retorna os metadados do chat, sem nunca consultar o Telegram.
+
+        Chats desconhecidos retornam `None` e são marcados para a próxima
+        passada de `refresh`.
+        """
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            with self._lock:
+                self._wanted.add(chat_id)
+        return entry
+
+    def username(self, chat_id):
+        entry = self.get(chat_id)
+        return entry.username if entry else None
+
+    def chat_type(self, chat_id):
+        entry = self.get(chat_id)
+        return entry.type if entry else None
+
+    def refresh(self, get_chat, now=None):
+        """Consulta no Telegram um lote de chats desconhecidos ou antigos."""
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            batch = list(self._wanted)[:self.BATCH_SIZE]
+            if len(batch) < self.BATCH_SIZE:
+                stale = sorted(
+                    (entry.refreshed, chat_id) for chat_id, entry in self._chats.items()
+                    if now - entry.refreshed >= self.TTL and chat_id not in self._wanted
+                )
+                batch += [chat_id for _, chat_id in stale[:self.BATCH_SIZE - len(batch)]]
+
+        refreshed = 0
+        for chat_id in batch:
+            try:
+                self.observe(get_chat(chat_id))
+                refreshed += 1
+            except telegram.error.TelegramError as e:
+                logging.warning("ChatRegistry: could not refresh chat %s: %s", chat_id, e)
+                # avoid asking again for an inaccessible chat before TTL
+                with self._lock:
+                    self._wanted.discard(chat_id)
+                    entry = self._chats.get(chat_id)
+                    if entry:
+                        entry.refreshed = now
+
+        return refreshed
+
+    def flush(self):
+        """Persiste na tabela `Group` os grupos alterados desde a última chamada.
+
+        Se a gravação falha, os grupos ficam para a próxima chamada.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            # private chats have positive ids
+            groups = {chat_id: self._chats[chat_id].username for chat_id in dirty if chat_id < 0}
+
+        if groups:
+            try:
+                self.resources.update_groups(groups)
+            except Exception:
+                with self._lock:
+                    self._dirty.update(groups)
+                raise
+        return len(groups)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._chats
+
+    def __len__(self):
+        return len(self._chats)
+
+    @staticmethod
+    def _entry(**kwargs):
+        return AttributeDict(kwargs)
@@ -1,10 +1,21 @@
+import hashlib
 from collections.abc import Mapping
-from datetime import datetime
+from datetime import date, datetime
 from pony import orm
 from pony.utils import throw
 
 db = orm.Database()
 
+# tabela com a versão do esquema já criado no banco
+SCHEMA_TABLE = 'gdgajubot_schema'
+
+# colunas (entidade, atributo) acrescentadas a tabelas que já existiam: o Pony
+# só cria tabelas inteiras, então elas são adicionadas antes da verificação
+ADDED_COLUMNS = (
+    ('Broadcast', 'tenant'),
+    ('Message', 'chat_id'),
+)
+
 
 class Choice(orm.Required):
     __slots__ = ('__choices',)
@@ -75,6 +86,8 @@ class Message(db.Entity):
     text = orm.Required(str)
     sent_at = orm.Required(datetime)
     sent_by = orm.Required(User)
+    # empty in the messages logged before the column existed
+    chat_id = orm.Optional(int, size=64)
 
     def __str__(self):
         return 'Message - {} @ {}: {}'.format(
@@ -101,3 +114,145 @@ class State(db.Entity):
 
     def __str__(self):
         return 'State - "{}" : {}'.format(self.description, self.info)
+
+
+class ChatActivity(db.Entity):
+    chat_id = orm.Required(int, size=64)
+    day = orm.Required(date)
+    hour = orm.Required(int)
+    messages = orm.Required(int, default=0)
+    orm.PrimaryKey(chat_id, day, hour)
+
+    def __str__(self):
+        return 'ChatActivity - {} @ {} {}h: {}'.format(self.chat_id, self.day, self.hour, self.messages)
+
+
+class UserActivity(db.Entity):
+    chat_id = orm.Required(int, size=64)
+    user_id = orm.Required(int, size=64)
+    day = orm.Required(date)
+    messages = orm.Required(int, default=0)
+    orm.PrimaryKey(chat_id, user_id, day)
+
+    def __str__(self):
+        return 'UserActivity - {} in {} @ {}: {}'.format(self.user_id, self.chat_id, self.day, self.messages)
+
+
+class SearchDocument(db.Entity):
+    message_id = orm.PrimaryKey(int)
+    chat_id = orm.Required(int, size=64)
+    terms = orm.Required(int)
+
+    def __str__(self):
+        return 'SearchDocument - {} in {}: {} terms'.format(self.message_id, self.chat_id, self.terms)
+
+
+class SearchTerm(db.Entity):
+    term = orm.Required(str, 32)
+    chat_id = orm.Required(int, size=64)
+    message_id = orm.Required(int, index=True)
+    hits = orm.Required(int)
+    orm.PrimaryKey(term, chat_id, message_id)
+
+    def __str__(self):
+        return 'SearchTerm - "{}" in {}: {}'.format(self.term, self.message_id, self.hits)
+
+
+class Broadcast(db.Entity):
+    # in multi-tenant mode, sent only to the groups of this tenant
+    tenant = orm.Optional(str, nullable=True)
+    text = orm.Required(str)
+    audience = orm.Required(str)
+    created_by = orm.Optional(str)
+    created_at = orm.Required(datetime)
+    report_to = orm.Optional(int, size=64)
+    # checkpoint: chats are sent in ascending id order
+    last_chat_id = orm.Optional(int, size=64)
+    delivered = orm.Required(int, default=0)
+    failed = orm.Required(int, default=0)
+    elapsed = orm.Required(float, default=0)
+    finished_at = orm.Optional(datetime)
+
+    def __str__(self):
+        return 'Broadcast - #{} ({}): {}'.format(self.id, self.audience, self.text)
+
+
+class TenantGroup(db.Entity):
+    tenant = orm.Required(str)
+    chat_id = orm.Required(int, size=64)
+    orm.PrimaryKey(tenant, chat_id)
+
+    def __str__(self):
+        return 'TenantGroup - {} @ {}'.format(self.chat_id, self.tenant)
+
+
+class Lease(db.Entity):
+    name = orm.PrimaryKey(str)
+    holder = orm.Required(str)
+    info = orm.Optional(str)
+    expires_at = orm.Required(datetime)
+
+    def __str__(self):
+        return 'Lease - {} @ {} until {}'.format(self.name, self.holder, self.expires_at)
+
+
+def schema_version():
+    """Hash da definição das entidades, que muda sempre que o esquema muda."""
+    parts = []
+    for name, entity in sorted(db.entities.items()):
+        parts.append(name + ':' + ','.join(attr.name for attr in entity._pk_attrs_))
+        for attr in entity._new_attrs_:
+            py_type = attr.py_type if isinstance(attr.py_type, str) else attr.py_type.__name__
+            options = sorted((k, v) for k, v in attr.kwargs.items() if not callable(v))
+            parts.append('%s.%s:%s:%s:%r' % (name, attr.name, type(attr).__name__, py_type, options))
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+def stored_schema_version():
+    """Versão do esquema gravada no banco, ou None se não houver."""
+    try:
+        with orm.db_session:
+            rows = db.select('SELECT version FROM %s' % SCHEMA_TABLE)
+    except orm.dbapiprovider.DBException:
+        return None
+    return rows[0] if rows else None
+
+
+def store_schema_version(version):
+    with orm.db_session:
+        db.execute('CREATE TABLE IF NOT EXISTS %s (version VARCHAR(64) NOT NULL)' % SCHEMA_TABLE)
+        db.execute('DELETE FROM %s' % SCHEMA_TABLE)
+        db.execute('INSERT INTO %s (version) VALUES ($version)' % SCHEMA_TABLE)
+
+
+def generate_mapping():
+    """Mapeia as entidades, verificando e criando as tabelas só se o esquema mudou."""
+    version = schema_version()
+    if stored_schema_version() == version:
+        db.generate_mapping(create_tables=False, check_tables=False)
+        return False
+
+    db.generate_mapping(create_tables=False, check_tables=False)
+    add_missing_columns()
+    db.create_tables(check_tables=True)
+    store_schema_version(version)
+    return True
+
+
+def add_missing_columns():
+    """Acrescenta às tabelas existentes as colunas de `ADDED_COLUMNS` que faltam nelas."""
+    provider = db.provider
+    with orm.db_session:
+        connection = db.get_connection()
+        for entity_name, attr_name in ADDED_COLUMNS:
+            entity = db.entities[entity_name]
+            attr = entity._adict_[attr_name]
+            table = entity._table_
+            if not provider.table_exists(connection, table):
+                continue
+            cursor = db.execute('SELECT * FROM %s WHERE 1 = 0' % provider.quote_name(table))
+            if attr.column.lower() in {column[0].lower() for column in cursor.description}:
+                continue
+            # nullable, for the rows already in the table
+            db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                provider.quote_name(table), provider.quote_name(attr.column), attr.converters[0].get_sql_type()))
@@ -0,0 +1,128 @@
+import logging
+import os
+import shutil
+import time
+from threading import RLock
+
+from gdgajubot.data.resources import json_decode, json_encode
+
+
+class StateJournal:
+    """Diário append-only das alterações nos estados dos chats.
+
+    Cada alteração em um `StateDict` vira uma linha JSON no arquivo. Na
+    inicialização o diário é reaplicado sobre a tabela `State`, e após cada
+    despejo completo dos estados (checkpoint) ele é compactado.
+
+    Políticas de fsync:
+
+    - ``always``: fsync a cada alteração;
+    - ``interval``: fsync no máximo a cada `fsync_interval` segundos;
+    - ``never``: deixa o sistema operacional decidir.
+
+    As linhas ficam em um buffer, repassado ao sistema operacional junto com o
+    fsync: a cada alteração em ``always`` e, nas outras políticas, a cada
+    `fsync_interval` segundos, nas alterações e em `flush`. A queda do
+    processo perde no máximo as alterações do último intervalo.
+    """
+
+    FSYNC_POLICIES = ('always', 'interval', 'never')
+
+    def __init__(self, path, fsync='interval', fsync_interval=1.0):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("fsync policy must be one of %s: got %r" % (self.FSYNC_POLICIES, fsync))
+
+        self.path = path
+        self.old_path = path + '.old'
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._lock = RLock()
+        self._last_sync = time.monotonic()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def append(self, state_id, chat_id, key, value=None, deleted=False):
+        record = {'s': state_id, 'c': chat_id, 'k': key}
+        if deleted:
+            record['d'] = True
+        else:
+            record['v'] = value
+        line = json_encode(record) + '\n'
+
+        with self._lock:
+            self._file.write(line)
+            if self.fsync == 'always':
+                self._sync()
+            else:
+                self._flush_due()
+
+    def flush(self):
+        """Repassa o buffer ao sistema operacional se o intervalo já passou, mesmo sem novas alterações."""
+        with self._lock:
+            self._flush_due()
+
+    def replay(self):
+        """Gera os registros do diário, incluindo os de um checkpoint interrompido."""
+        for path in (self.old_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as journal:
+                for n, line in enumerate(journal, 1):
+                    try:
+                        yield json_decode(line)
+                    except ValueError:
+                        # a partial line is expected only at the end, after a crash
+                        logging.warning("StateJournal: skipping corrupted line %d of %s", n, path)
+
+    def apply(self, states):
+        """Reaplica o diário sobre `states`; retorna a quantidade de registros aplicados."""
+        count = 0
+        for record in self.replay():
+            chat_state = states[record['s']][record['c']]
+            if record.get('d'):
+                dict.pop(chat_state, record['k'], None)
+            else:
+                dict.__setitem__(chat_state, record['k'], record['v'])
+            count += 1
+        return count
+
+    def rotate(self):
+        """Inicia um checkpoint: as próximas alterações vão para um novo arquivo."""
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+            # a previous checkpoint failed: keep its records before the current ones
+            if os.path.exists(self.old_path):
+                with open(self.old_path, 'a', encoding='utf-8') as old, \
+                        open(self.path, encoding='utf-8') as current:
+                    shutil.copyfileobj(current, old)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.old_path)
+
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def compact(self):
+        """Conclui um checkpoint bem sucedido, descartando os registros já persistidos."""
+        with self._lock:
+            if os.path.exists(self.old_path):
+                os.remove(self.old_path)
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def _flush_due(self):
+        if time.monotonic() - self._last_sync < self.fsync_interval:
+            return
+        if self.fsync == 'never':
+            self._file.flush()
+            self._last_sync = time.monotonic()
+        else:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
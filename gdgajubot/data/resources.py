@@ -1,22 +1,64 @@
-﻿import datetime
+﻿import atexit
+import datetime
 import json
 import logging
+import re
+import time
+from collections import OrderedDict
 from typing import Dict
 
 import threading
 
-import requests
-import requests.exceptions
-
 from beaker.cache import CacheManager
 from beaker.util import parse_cache_config_options
-from bs4 import BeautifulSoup
 
-from gdgajubot import util
-from gdgajubot.data.database import db, orm, Message, User, Choice, ChoiceConverter, State, Group
+from gdgajubot import logs, metrics, startup, util
+from gdgajubot.data import analytics, search
+from gdgajubot.data.database import (
+    db, orm, generate_mapping, Message, User, Choice, ChoiceConverter, State, Group, Lease, Broadcast,
+    ChatActivity, UserActivity, SearchDocument, SearchTerm, TenantGroup,
+)
 from gdgajubot.util import StateDict, MissingDict
 
 
+def db_session(func):
+    """`orm.db_session` que registra a duração da sessão nas métricas."""
+    return metrics.timed('db_session_seconds', op=func.__name__)(orm.db_session(func))
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# utc offset of an ISO date, with the colon that strptime doesn't accept before Python 3.7
+ISO_OFFSET = re.compile(r'([+-]\d\d):(\d\d)$')
+
+
+def parse_datetime(text):
+    """Data e hora no formato de `isoformat`, com ou sem fuso, frações de segundo e o `T`."""
+    text = ISO_OFFSET.sub(r'\1\2', text.replace(' ', 'T', 1))
+    date_format = '%Y-%m-%dT%H:%M:%S'
+    if '.' in text:
+        date_format += '.%f'
+    if re.search(r'[+-]\d{4}$', text):
+        date_format += '%z'
+    return datetime.datetime.strptime(text, date_format)
+
+
+def naive_utc(value):
+    """Data e hora em UTC sem fuso, como as colunas do banco guardam.
+
+    Aceita também o texto com fuso que o SQLite devolve das mensagens gravadas
+    com a data do Telegram, que tem fuso.
+    """
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
 def json_encode(info):
     return JSONCodec().encode(info)
 
@@ -33,28 +75,77 @@ class Resources:
                       "Chrome/51.0.2704.79 Safari/537.36"
     }
 
+    # URLs base dos serviços externos, substituíveis pela configuração
+    UPSTREAMS = {
+        'meetup': "https://api.meetup.com",
+        'facebook': "https://graph.facebook.com",
+        'packt_services': "https://services.packtpub.com",
+        'packt_cdn': "https://static.packt-cdn.com",
+        'discountsglobal': "http://udemycoupon.discountsglobal.com",
+        'learnviral': "https://udemycoupon.learnviral.com",
+        'onlinetutorials': "https://onlinetutorials.org",
+    }
+
     # Configuring cache
     cache = CacheManager(
         **parse_cache_config_options({'cache.type': 'memory'}))
 
     def __init__(self, config):
         self.config = config
+        self.upstreams = dict(self.UPSTREAMS)
+        if config.upstream_base_url:
+            base = config.upstream_base_url.rstrip('/')
+            self.upstreams.update((name, base + '/' + name) for name in self.UPSTREAMS)
+        self.upstreams.update(config.upstreams or {})
+        self.timeout = config.upstream_timeout
         self.db = self.__initialize_database(**config.database)
+        # in multi-tenant mode, the states of each community are kept apart
+        self.state_prefix = config.tenant + ':' if config.tenant else ''
+        # groups already registered as served by this tenant
+        self.tenant_groups = set()
+        # communities with the same events source and groups share the cached events
+        self.events_key = '%s:%s' % (','.join(config.events_source or ()), ','.join(config.group_name or ()))
+        self.journal = None
+        if config.state_journal:
+            from gdgajubot.data.journal import StateJournal
+            self.journal = StateJournal(config.state_journal, fsync=config.journal_fsync)
+            # the journal buffers its lines: write them out at exit
+            atexit.register(self.journal.close)
 
         # create delegate method based on choice
-        if 'meetup' in config.events_source:
+        if 'meetup' in (config.events_source or ()):
             self.generate_events = self.meetup_events
         else:
             self.generate_events = self.facebook_events
 
+    def upstream_url(self, upstream, path=''):
+        return self.upstreams[upstream] + path
+
+    def http_get(self, upstream, path='', **kwargs):
+        import requests
+
+        with metrics.timer('upstream_request_seconds', upstream=upstream):
+            return requests.get(self.upstream_url(upstream, path), timeout=self.timeout, **kwargs)
+
     def __initialize_database(self, **config):
-        db.bind(**config)
-        db.provider.converter_classes.append((Choice, ChoiceConverter))
-        db.generate_mapping(create_tables=True)
+        # the database (and its connection pool) is shared by all tenants of the process
+        if db.provider is not None:
+            return db
+
+        with startup.phase('database bind'):
+            db.bind(**config)
+            db.provider.converter_classes.append((Choice, ChoiceConverter))
+        with startup.phase('database schema'):
+            if generate_mapping():
+                logging.info("Esquema do banco verificado e atualizado")
+        self.__prepare_backfill()
         return db
 
-    @cache.cache('get_events', expire=60)
     def get_events(self, list_size=5):
+        return self.fetch_events(self.events_key, list_size)
+
+    @cache.cache('get_events', expire=60)
+    def fetch_events(self, events_key, list_size):
         return list(self.generate_events(list_size))
 
     def meetup_events(self, n):
@@ -62,12 +153,12 @@ class Resources:
         # api v3 base url
         all_events = []
         for group in self.config.group_name:
-            url = "https://api.meetup.com/{group}/events".format(
+            path = "/{group}/events".format(
                 group=group
             )
 
             # response for the events
-            r = requests.get(url, params={
+            r = self.http_get('meetup', path, params={
                 'key': self.config.meetup_key,
                 'status': 'upcoming',
                 'only': 'name,time,link',  # filter response to these fields
@@ -92,10 +183,10 @@ class Resources:
         all_events = []
         for group in self.config.group_name:
             # api v2.8 base url
-            url = "https://graph.facebook.com/v2.8/%s/events" % group
+            path = "/v2.8/%s/events" % group
 
             # response for the events
-            r = requests.get(url, params={
+            r = self.http_get('facebook', path, params={
                 'access_token': self.config.facebook_key,
                 'since': 'today',
                 'fields': 'name,start_time',  # filter response to these fields
@@ -153,9 +244,10 @@ class Resources:
 
     # função de coleta 1
     def __get_all_discountsglobal_links(self): 
-        url = "http://udemycoupon.discountsglobal.com/coupon-category/free-2/"
+        from bs4 import BeautifulSoup
+
         try:
-            r = requests.get(url,headers=self.HEADERS)
+            r = self.http_get('discountsglobal', "/coupon-category/free-2/", headers=self.HEADERS)
             soup = BeautifulSoup(r.text,'html5lib')
             for div in soup.findAll('div',{'class':'item-panel'})[:7]:
                 name = div.find('h3').find('a').text 
@@ -165,13 +257,14 @@ class Resources:
                 url = div.find('div',{'class':'link-holder'}).find('a').get('href') 
                 self.__coupon_results.update({url:name})
         except Exception as e:
-            print('get_all_discountsglobal_links',e)      
+            logging.warning("get_all_discountsglobal_links: %s", e)
 
     # função de coleta 2
     def __get_all_learnviral_links(self): 
-        url = "https://udemycoupon.learnviral.com/coupon-category/free100-discount/"
+        from bs4 import BeautifulSoup
+
         try:
-            r = requests.get(url,headers=self.HEADERS)
+            r = self.http_get('learnviral', "/coupon-category/free100-discount/", headers=self.HEADERS)
             soup = BeautifulSoup(r.text,'html5lib')
             titles = [
                 title.text.replace('[Free]','') for title in \
@@ -183,13 +276,14 @@ class Resources:
             ]
             self.__coupon_results.update({url:name for (url,name) in zip(urls[:7],titles[:7])})
         except Exception as e:
-            print('get_all_learnviral_links',e)      
+            logging.warning("get_all_learnviral_links: %s", e)
 
     # função de coleta 3
     def __get_all_onlinetutorials_links(self): 
-        url = "https://onlinetutorials.org"
+        from bs4 import BeautifulSoup
+
         try:
-            r = requests.get(url,headers=self.HEADERS)
+            r = self.http_get('onlinetutorials', headers=self.HEADERS)
             soup = BeautifulSoup(r.text,'html5lib')
             titles = [
                 title.find('a').text for title in \
@@ -201,7 +295,7 @@ class Resources:
             ]
             self.__coupon_results.update({url:name for (url,name) in zip(urls[:7],titles[:7])})
         except Exception as e:
-            print('get_all_onlinetutorials_links',e)  
+            logging.warning("get_all_onlinetutorials_links: %s", e)
 
     @cache.cache('get_packt_free_book', expire=600)
     def get_packt_free_book(self):
@@ -209,8 +303,8 @@ class Resources:
         date_to = date_from + datetime.timedelta(days=1)
 
         # Primeira requisição obtém o ID do livro do dia
-        r = requests.get(
-            url="https://services.packtpub.com/free-learning-v1/offers",
+        r = self.http_get(
+            'packt_services', "/free-learning-v1/offers",
             params={
                 "dateFrom": date_from.strftime("%Y-%m-%dT00:00:00.000Z"),
                 "dateTo": date_to.strftime("%Y-%m-%dT00:00:00.000Z")
@@ -219,7 +313,7 @@ class Resources:
         book_id = r.json()['data'][0]['productId']
 
         # Segunda requisição obtém as informações do livro do dia
-        r = requests.get(url="https://static.packt-cdn.com/products/%s/summary" % book_id)
+        r = self.http_get('packt_cdn', "/products/%s/summary" % book_id)
         data = r.json()
 
         book = util.AttributeDict()
@@ -234,6 +328,7 @@ class Resources:
     def get_short_url(self, long_url):
         # Faz a requisição da URL curta somente se houver uma key configurada
         if self.config.url_shortener_key:
+            import requests
             r = requests.post(
                 "https://www.googleapis.com/urlshortener/v1/url",
                 params={
@@ -252,35 +347,61 @@ class Resources:
 
     ChatState = dict
 
-    @orm.db_session
+    @db_session
     def set_state(self, state_id: str, chat_id: int, chat_state: ChatState):
         # to not dump memory-only state
         chat_state = chat_state.copy()
         chat_state.pop('__memory__', None)
 
+        description = self.state_prefix + state_id
         try:
-            state = State[chat_id, state_id]
+            state = State[chat_id, description]
             info = json_decode(state.info)
             info.update(chat_state)
             state.info = json_encode(info)
         except orm.ObjectNotFound:
-            State(telegram_id=chat_id, description=state_id, info=json_encode(chat_state))
+            State(telegram_id=chat_id, description=description, info=json_encode(chat_state))
 
-    @orm.db_session
+    @db_session
     def get_state(self, state_id: str, chat_id: int) -> ChatState:
-        state = State.get(telegram_id=chat_id, description=state_id)
+        state = State.get(telegram_id=chat_id, description=self.state_prefix + state_id)
         if state:
             return json_decode(state.info)
         return {}
 
-    @orm.db_session
+    def flush_journal(self):
+        if self.journal:
+            self.journal.flush()
+
     def update_states(self, states: Dict[str, Dict[int, ChatState]]):
+        # checkpoint: changes made from now on go to a new journal file,
+        # and the previous one is discarded only after the commit
+        if self.journal:
+            self.journal.rotate()
+
+        self.__update_states(states)
+
+        if self.journal:
+            self.journal.compact()
+
+    @db_session
+    def __update_states(self, states):
         for state_id, data in states.items():
             for chat_id, chat_state in data.items():
                 self.set_state(state_id, chat_id, chat_state)
 
-    @orm.db_session
     def load_states(self) -> Dict[str, Dict[int, ChatState]]:
+        states = self.__load_states()
+
+        # reapply changes made after the last checkpoint
+        if self.journal:
+            count = self.journal.apply(states)
+            logging.info("Replayed %d state changes from the journal", count)
+
+        return states
+
+    @db_session
+    def __load_states(self):
         states = MissingDict(
             lambda state_id: MissingDict(
                 lambda chat_id: self.__state_dict(state_id, chat_id,
@@ -288,8 +409,15 @@ class Resources:
             )
         )
 
-        for state in State.select():
+        # only the states of this tenant (or, without tenant, the ones of no tenant)
+        prefix = self.state_prefix
+        query = State.select(lambda s: s.description.startswith(prefix)) if prefix else State.select()
+        for state in query:
             state_id, chat_id, info = state.description, state.telegram_id, state.info
+            if prefix:
+                state_id = state_id[len(prefix):]
+            elif ':' in state_id:
+                continue
             states[state_id][chat_id] = self.__state_dict(state_id, chat_id, json_decode(info))
 
         return states
@@ -299,22 +427,48 @@ class Resources:
         if '__memory__' not in data:
             data['__memory__'] = {}
 
+        journal_function = None
+        if self.journal:
+            def journal_function(key, value=None, deleted=False):
+                self.journal.append(state_id, chat_id, key, value, deleted)
+
         return StateDict(
-            data, dump_function=lambda state: self.set_state(state_id, chat_id, state)
+            data, dump_function=lambda state: self.set_state(state_id, chat_id, state),
+            journal_function=journal_function,
         )
 
-    @cache.cache('db.get_group', expire=600)
-    @orm.db_session
     def get_group(self, group_id: int, group_name: str) -> Group:
+        if self.config.tenant and group_id not in self.tenant_groups:
+            self.join_group(group_id)
+        return self.fetch_group(group_id, group_name)
+
+    @cache.cache('db.get_group', expire=600)
+    @db_session
+    def fetch_group(self, group_id: int, group_name: str) -> Group:
         return self.__get_group(group_id, group_name)
 
     def __get_group(self, group_id, group_name):
         try:
             return Group[group_id]
         except orm.ObjectNotFound:
-            return Group(telegram_id=group_id, telegram_groupname=group_name)
+            # chats without a username still get a row
+            return Group(telegram_id=group_id, telegram_groupname=group_name or '')
 
-    @orm.db_session
+    def join_group(self, group_id):
+        """Registra o grupo entre os atendidos por este tenant, que recebem os avisos dele."""
+        try:
+            self.__join_group(group_id)
+        except orm.TransactionError:
+            # another process registered it first
+            pass
+        self.tenant_groups.add(group_id)
+
+    @db_session
+    def __join_group(self, group_id):
+        if not TenantGroup.exists(tenant=self.config.tenant, chat_id=group_id):
+            TenantGroup(tenant=self.config.tenant, chat_id=group_id)
+
+    @db_session
     def set_group(self, group_id: int, group_name: str, **kwargs):
         if not kwargs:
             return
@@ -323,30 +477,417 @@ class Resources:
         for k, v in kwargs.items():
             setattr(group, k, v)
 
-        self.cache.invalidate(self.get_group, "db.get_group")
+        self.cache.invalidate(self.fetch_group, "db.get_group")
+        if self.config.tenant:
+            self.join_group(group_id)
+
+    @db_session
+    def list_groups(self, daily_book=False):
+        if daily_book:
+            return tuple(orm.select((g.telegram_id, g.telegram_groupname) for g in Group if g.has_daily_book))
+        return tuple(orm.select((g.telegram_id, g.telegram_groupname) for g in Group))
+
+    @db_session
+    def update_groups(self, groups: Dict[int, str]):
+        for group_id, group_name in groups.items():
+            group = self.__get_group(group_id, group_name)
+            group.telegram_groupname = group_name or ''
+
+        self.cache.invalidate(self.fetch_group, "db.get_group")
+        if self.config.tenant:
+            for group_id in groups:
+                self.join_group(group_id)
+
+    @db_session
+    def create_broadcast(self, text, audience, created_by=None, report_to=None):
+        broadcast = Broadcast(tenant=self.config.tenant, text=text, audience=audience, created_by=created_by or '',
+                              created_at=datetime.datetime.now(), report_to=report_to)
+        broadcast.flush()
+        return broadcast.id
+
+    @db_session
+    def get_broadcast(self, broadcast_id):
+        return util.AttributeDict(Broadcast[broadcast_id].to_dict())
+
+    @db_session
+    def pending_broadcasts(self):
+        """Avisos interrompidos deste tenant (ou, sem tenant, os sem tenant)."""
+        tenant = self.config.tenant
+        query = Broadcast.select(lambda b: b.finished_at is None)
+        if tenant:
+            query = query.filter(lambda b: b.tenant == tenant)
+        else:
+            query = query.filter(lambda b: b.tenant is None)
+        return tuple(b.id for b in query.order_by(Broadcast.id))
+
+    @db_session
+    def broadcast_recipients(self, audience, after=None, limit=100):
+        """Próximos `limit` chats do público, em ordem de id, a partir de `after` (exclusive)."""
+        if after is None:
+            after = -2 ** 63
+        query = Group.select(lambda g: g.telegram_id > after)
+        if audience == 'daily_book':
+            query = query.filter(lambda g: g.has_daily_book)
+        # in multi-tenant mode, only the groups served by this tenant
+        tenant = self.config.tenant
+        if tenant:
+            query = query.filter(lambda g: orm.exists(
+                t for t in TenantGroup if t.tenant == tenant and t.chat_id == g.telegram_id))
+        return [g.telegram_id for g in query.order_by(Group.telegram_id)[:limit]]
+
+    @db_session
+    def checkpoint_broadcast(self, broadcast_id, last_chat_id, delivered, failed, elapsed, finished=False):
+        Broadcast[broadcast_id].set(
+            last_chat_id=last_chat_id, delivered=delivered, failed=failed, elapsed=elapsed,
+            finished_at=datetime.datetime.now() if finished else None,
+        )
 
-    @orm.db_session
-    def log_message(self, message, *args, **kwargs):
+    def acquire_lease(self, name, holder, ttl, info='', now=None):
+        """Obtém ou renova a concessão `name` por `ttl` segundos.
+
+        Retorna False se ela pertence a outro detentor e ainda não expirou, ou
+        se outro processo a alterou ao mesmo tempo.
+        """
         try:
-            user = User[message.from_user.id]
-        except orm.ObjectNotFound:
-            user = User(
-                telegram_id=message.from_user.id,
-                telegram_username=message.from_user.name,
+            return self.__acquire_lease(name, holder, ttl, info, now or datetime.datetime.utcnow())
+        except orm.TransactionError:
+            return False
+
+    @db_session
+    def __acquire_lease(self, name, holder, ttl, info, now):
+        expires_at = now + datetime.timedelta(seconds=ttl)
+        lease = Lease.get(name=name)
+        if lease is None:
+            Lease(name=name, holder=holder, info=info, expires_at=expires_at)
+            return True
+        if lease.holder != holder and lease.expires_at > now:
+            return False
+        lease.set(holder=holder, info=info, expires_at=expires_at)
+        return True
+
+    @db_session
+    def release_lease(self, name, holder):
+        lease = Lease.get(name=name)
+        if lease is not None and lease.holder == holder:
+            lease.delete()
+
+    @db_session
+    def live_leases(self, prefix, now=None):
+        """Concessões ainda válidas cujo nome começa com `prefix`, como {detentor: info}."""
+        now = now or datetime.datetime.utcnow()
+        return {
+            holder: info for holder, info in orm.select(
+                (l.holder, l.info) for l in Lease if l.name.startswith(prefix) and l.expires_at > now
             )
-        message = Message(
-            sent_by=user, text=message.text, sent_at=message.date,
-        )
-        print(
-            'Logging message: {}'.format(message),
-        )
+        }
+
+    @db_session
+    def prune_leases(self, before):
+        """Remove as concessões expiradas antes de `before`."""
+        return orm.delete(l for l in Lease if l.expires_at < before)
+
+    def log_messages(self, messages):
+        """Registra várias mensagens em uma única transação."""
+        for attempt in range(ROLLUP_RETRIES):
+            try:
+                return self.__log_messages(messages)
+            except orm.TransactionError:
+                # another process created or updated the same counters first
+                if attempt == ROLLUP_RETRIES - 1:
+                    raise
 
-    @orm.db_session
+    def log_message(self, message, *args, **kwargs):
+        self.log_messages((message,))
+
+    @db_session
+    def __log_messages(self, messages):
+        rollup = analytics.Rollup()
+        for message in messages:
+            try:
+                user = User[message.from_user.id]
+            except orm.ObjectNotFound:
+                user = User(
+                    telegram_id=message.from_user.id,
+                    telegram_username=message.from_user.name,
+                )
+            entry = Message(
+                sent_by=user, text=message.text, sent_at=naive_utc(message.date), chat_id=message.chat_id,
+            )
+            rollup.add(message.chat_id, user.telegram_id, message.date)
+            logs.per_message.info("Logging message: %s", entry)
+        self.__apply_rollup(rollup)
+
+    def __apply_rollup(self, rollup):
+        for (chat_id, day, hour), n in rollup.chats.items():
+            row = ChatActivity.get(chat_id=chat_id, day=day, hour=hour)
+            if row is None:
+                ChatActivity(chat_id=chat_id, day=day, hour=hour, messages=n)
+            else:
+                row.messages += n
+        for (chat_id, user_id, day), n in rollup.users.items():
+            row = UserActivity.get(chat_id=chat_id, user_id=user_id, day=day)
+            if row is None:
+                UserActivity(chat_id=chat_id, user_id=user_id, day=day, messages=n)
+            else:
+                row.messages += n
+
+    def __index_message(self, message_id, chat_id, text):
+        terms = search.tokenize(text)
+        SearchDocument(message_id=message_id, chat_id=chat_id, terms=sum(terms.values()))
+        for term, hits in terms.items():
+            SearchTerm(term=term, chat_id=chat_id, message_id=message_id, hits=hits)
+
+    @db_session
+    def top_users(self, chat_id=None, since=None, limit=10):
+        """Usuários com mais mensagens desde o dia `since`, como [(nome, mensagens)].
+
+        Sem `chat_id`, soma todos os chats.
+        """
+        since = since or datetime.date.min
+        if chat_id is None:
+            query = orm.select((a.user_id, orm.sum(a.messages)) for a in UserActivity if a.day >= since)
+        else:
+            query = orm.select((a.user_id, orm.sum(a.messages)) for a in UserActivity
+                               if a.chat_id == chat_id and a.day >= since)
+        top = query.order_by(orm.desc(2))[:limit]
+        user_ids = [user_id for user_id, _ in top]
+        names = dict(orm.select((u.telegram_id, u.telegram_username) for u in User if u.telegram_id in user_ids))
+        return [(names.get(user_id, str(user_id)), n) for user_id, n in top]
+
+    @db_session
+    def chat_activity(self, chat_id=None, since=None):
+        """Mensagens por dia ([(dia, mensagens)], em ordem) e por hora do dia (lista de 24) desde `since`.
+
+        Sem `chat_id`, soma todos os chats.
+        """
+        since = since or datetime.date.min
+        if chat_id is None:
+            rows = orm.select((a.day, a.hour, a.messages) for a in ChatActivity if a.day >= since)
+        else:
+            rows = orm.select((a.day, a.hour, a.messages) for a in ChatActivity
+                              if a.chat_id == chat_id and a.day >= since)
+        days, hours = OrderedDict(), [0] * 24
+        # at most 24 rows a day for each chat
+        for day, hour, n in rows.order_by(1):
+            days[day] = days.get(day, 0) + n
+            hours[hour] += n
+        return list(days.items()), hours
+
+    def search_messages(self, text, chat_id=None, page=1, page_size=5, budget=1.0):
+        """Mensagens com todos os termos de `text`, das mais relevantes para as menos.
+
+        Sem `chat_id`, busca em todos os chats. Se a busca passar de `budget`
+        segundos, ou o termo mais raro tiver mensagens demais, o resultado é
+        parcial (`partial`).
+        """
+        with metrics.timer('search_seconds'):
+            return self.__search_messages(search.query_terms(text), chat_id, page, page_size, budget)
+
+    @db_session
+    def __search_messages(self, terms, chat_id, page, page_size, budget):
+        deadline = time.perf_counter() + budget
+        result = util.AttributeDict(terms=terms, total=0, results=[], partial=False)
+
+        def postings(term, message_ids=None):
+            query = SearchTerm.select(lambda s: s.term == term)
+            if chat_id is not None:
+                query = query.filter(lambda s: s.chat_id == chat_id)
+            if message_ids is not None:
+                query = query.filter(lambda s: s.message_id in message_ids)
+            return query
+
+        df = {term: postings(term).count() for term in terms}
+        if not terms or not all(df.values()):
+            return result
+
+        # the rarest term gives the candidates, the others only narrow them down
+        terms = sorted(terms, key=df.get)
+        first = postings(terms[0]).order_by(orm.desc(SearchTerm.message_id))[:search.MAX_CANDIDATES + 1]
+        result.partial = len(first) > search.MAX_CANDIDATES
+        hits = {s.message_id: {terms[0]: s.hits} for s in first[:search.MAX_CANDIDATES]}
+        for term in terms[1:]:
+            if time.perf_counter() > deadline:
+                result.partial = True
+                break
+            found = {}
+            for chunk in chunks(list(hits), SQL_CHUNK):
+                for s in postings(term, chunk):
+                    found[s.message_id] = dict(hits[s.message_id], **{term: s.hits})
+            hits = found
+
+        documents, avg_length = self.search_stats()
+        lengths = {}
+        for chunk in chunks(list(hits), SQL_CHUNK):
+            lengths.update(orm.select((d.message_id, d.terms) for d in SearchDocument if d.message_id in chunk))
+        scores = {
+            message_id: sum(search.bm25(n, lengths.get(message_id, 1), df[term], documents, avg_length)
+                            for term, n in message_hits.items())
+            for message_id, message_hits in hits.items()
+        }
+        ranked = sorted(scores, key=lambda message_id: (-scores[message_id], -message_id))
+        result.total = len(ranked)
+
+        page_ids = ranked[(page - 1) * page_size:page * page_size]
+        found = {m.id: m for m in Message.select(lambda m: m.id in page_ids)}
+        result.results = [
+            util.AttributeDict(id=message_id, text=found[message_id].text, sent_at=naive_utc(found[message_id].sent_at),
+                               sent_by=found[message_id].sent_by.telegram_username, score=scores[message_id])
+            for message_id in page_ids if message_id in found
+        ]
+        return result
+
+    @cache.cache('db.search_stats', expire=300)
+    @db_session
+    def search_stats(self):
+        """Total de mensagens indexadas e a média de termos por mensagem."""
+        return orm.count(d for d in SearchDocument), orm.avg(d.terms for d in SearchDocument) or 0.0
+
+    def __prepare_backfill(self):
+        # the messages logged up to now have no counters nor index entries
+        self.__start_backfill(analytics.BACKFILL_STATE)
+        self.__start_backfill(search.REBUILD_STATE)
+        # the new ones are indexed from here on
+        self.__start_backfill(search.INDEX_STATE, from_last=True)
+
+    def __start_backfill(self, description, reset=False, from_last=False):
+        try:
+            with orm.db_session:
+                until = orm.max(m.id for m in Message) or 0
+                progress = json_encode({'after': until if from_last else 0, 'until': until})
+                state = State.get(telegram_id=analytics.HISTORY_CHAT, description=description)
+                if state is None:
+                    State(telegram_id=analytics.HISTORY_CHAT, description=description, info=progress)
+                elif reset:
+                    state.info = progress
+                return until
+        except orm.TransactionError:
+            return 0  # created by another process
+
+    def backfill_rollups(self, batch_size=1000):
+        """Soma aos contadores um lote das mensagens registradas antes deles.
+
+        Retorna quantas mensagens foram processadas; 0 quando não há o que
+        fazer ou quando outro processo processou o mesmo lote.
+        """
+        return self.__backfill(analytics.BACKFILL_STATE, batch_size, self.__rollup_batch)
+
+    def start_search_rebuild(self):
+        """Agenda a reindexação de todas as mensagens registradas até agora; retorna o id da última."""
+        return self.__start_backfill(search.REBUILD_STATE, reset=True)
+
+    def rebuild_search_index(self, batch_size=1000):
+        """Reindexa um lote das mensagens pendentes da reconstrução do índice de busca.
+
+        Retorna quantas mensagens foram processadas, como `backfill_rollups`.
+        """
+        return self.__backfill(search.REBUILD_STATE, batch_size, self.__index_batch)
+
+    def __rollup_batch(self, rows, after, last):
+        rollup = analytics.Rollup()
+        for message_id, chat_id, user_id, sent_at, text in rows:
+            rollup.add(analytics.message_chat(chat_id), user_id, naive_utc(sent_at))
+        self.__apply_rollup(rollup)
+
+    def index_messages(self, batch_size=1000):
+        """Indexa para a busca um lote das mensagens registradas desde a última indexação.
+
+        Retorna quantas mensagens foram indexadas, como `backfill_rollups`.
+        """
+        return self.__backfill(search.INDEX_STATE, batch_size, self.__index_batch, follow=True)
+
+    def __index_batch(self, rows, after, last):
+        # messages logged before Message had a chat only have it in their previous index entry
+        chats = dict(orm.select((d.message_id, d.chat_id) for d in SearchDocument
+                                if d.message_id > after and d.message_id <= last))
+        SearchTerm.select(lambda s: s.message_id > after and s.message_id <= last).delete(bulk=True)
+        SearchDocument.select(lambda d: d.message_id > after and d.message_id <= last).delete(bulk=True)
+        for message_id, chat_id, user_id, sent_at, text in rows:
+            if chat_id is None:
+                chat_id = chats.get(message_id)
+            self.__index_message(message_id, analytics.message_chat(chat_id), text)
+
+    def __backfill(self, description, batch_size, process, follow=False):
+        try:
+            return self.__backfill_batch(description, batch_size, process, follow)
+        except orm.TransactionError:
+            return 0
+
+    @db_session
+    def __backfill_batch(self, description, batch_size, process, follow):
+        state = State.get(telegram_id=analytics.HISTORY_CHAT, description=description)
+        if state is None:
+            return 0
+        progress = json_decode(state.info)
+        if follow:
+            # only up to the newest message seen by the previous call: one with a lower id
+            # than the newest may still be committing, and would be skipped for good
+            progress['until'] = max(progress['until'], progress.get('latest', 0))
+            progress['latest'] = orm.max(m.id for m in Message) or 0
+        if progress['after'] >= progress['until']:
+            if follow:
+                state.info = json_encode(progress)
+            return 0
+
+        rows = orm.select(
+            (m.id, m.chat_id, m.sent_by.telegram_id, m.sent_at, m.text) for m in Message
+            if m.id > progress['after'] and m.id <= progress['until']
+        ).order_by(1)[:batch_size]
+        last = rows[-1][0] if rows else progress['until']
+        process(rows, progress['after'], last)
+
+        # the optimistic check on the state keeps two processes from taking the same batch
+        progress['after'] = last
+        state.info = json_encode(progress)
+        if progress['after'] >= progress['until'] and not follow:
+            logging.info("Backfill %s concluído", description)
+        return len(rows)
+
+    @db_session
+    def retention_candidates(self, before, after=0, limit=500):
+        """Próximas `limit` mensagens enviadas antes de `before`, em ordem de id a partir de `after` (exclusive).
+
+        Cada mensagem vem com o chat dela; as registradas antes de o chat ser guardado vêm sem chat.
+        """
+        rows = orm.select(
+            (m.id, m.chat_id, m.sent_by.telegram_id, m.sent_by.telegram_username, m.sent_at, m.text) for m in Message
+            if m.id > after and m.sent_at < before
+        ).order_by(1)[:limit]
+        return [
+            util.AttributeDict(id=message_id, chat_id=analytics.message_chat(chat_id), user_id=user_id,
+                               username=username, sent_at=naive_utc(sent_at), text=text)
+            for message_id, chat_id, user_id, username, sent_at, text in rows
+        ]
+
+    @db_session
+    def delete_messages(self, message_ids):
+        """Remove as mensagens e as entradas delas no índice de busca."""
+        for chunk in chunks(list(message_ids), SQL_CHUNK):
+            SearchTerm.select(lambda s: s.message_id in chunk).delete(bulk=True)
+            SearchDocument.select(lambda d: d.message_id in chunk).delete(bulk=True)
+            Message.select(lambda m: m.id in chunk).delete(bulk=True)
+
+    @db_session
+    def prune_users(self):
+        """Remove os usuários sem mensagens registradas, exceto os admins."""
+        return User.select(lambda u: not u.is_bot_admin and not u.messages).delete(bulk=True)
+
+    def compact(self):
+        """Devolve ao sistema o espaço livre do banco; só no SQLite, nos outros o próprio banco cuida disso."""
+        if db.provider_name != 'sqlite':
+            return False
+        # VACUUM can't run inside a transaction, so it goes straight to the connection
+        with orm.db_session:
+            connection = db.get_connection()
+            connection.commit()
+            connection.execute('VACUUM')
+        return True
+
+    @db_session
     def list_all_users(self):
         users = User.select().order_by(User.telegram_username)[:]
         return tuple(users)
 
-    @orm.db_session
+    @db_session
     def is_user_admin(self, user_id):
         try:
             user = User[user_id]
@@ -355,6 +896,12 @@ class Resources:
         return user.is_bot_admin
 
 
+# ids por consulta com `in`, abaixo do limite de parâmetros do SQLite
+SQL_CHUNK = 500
+
+# tentativas de registrar mensagens quando os contadores colidem com outro processo
+ROLLUP_RETRIES = 3
+
 DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%z'
 
 
@@ -0,0 +1,71 @@
+"""Busca textual nas mensagens registradas, com um índice invertido próprio.
+
+O índice fica em duas tabelas comuns, para funcionar em qualquer banco
+suportado pelo Pony: `SearchTerm` guarda, para cada termo, as mensagens em
+que ele aparece (e quantas vezes), e `SearchDocument` guarda o chat e o
+número de termos de cada mensagem indexada. As mensagens são indexadas em
+lotes por uma task, logo depois de registradas, fora do caminho de cada
+mensagem.
+
+Os resultados precisam conter todos os termos e são ordenados pelo BM25 e,
+no empate, das mais recentes para as mais antigas.
+"""
+import math
+import re
+import unicodedata
+from collections import Counter
+
+from gdgajubot import metrics
+
+# descrição do estado (no chat 0) com o progresso da reconstrução do índice
+REBUILD_STATE = 'search:rebuild'
+
+# descrição do estado (no chat 0) com a última mensagem nova indexada
+INDEX_STATE = 'search:index'
+
+# termos mais curtos ou mais longos não são indexados
+MIN_TERM = 2
+MAX_TERM = 32
+
+# termos considerados em uma busca
+MAX_QUERY_TERMS = 8
+
+# mensagens lidas do termo mais raro, das mais recentes para as mais antigas;
+# além disso, a busca é parcial
+MAX_CANDIDATES = 2000
+
+# parâmetros do BM25
+K1 = 1.2
+B = 0.75
+
+STOPWORDS = frozenset('''
+    a ao aos as com da das de do dos e em na nas no nos o os ou para pela pelo por que se um uma
+'''.split())
+
+WORD = re.compile(r'\w+')
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """Termos do texto, sem acentos e sem palavras comuns, com o número de ocorrências."""
+    return Counter(
+        term for term in WORD.findall(normalize(text or ''))
+        if MIN_TERM <= len(term) <= MAX_TERM and term not in STOPWORDS
+    )
+
+
+def query_terms(text):
+    return list(tokenize(text))[:MAX_QUERY_TERMS]
+
+
+def bm25(hits, length, df, documents, avg_length):
+    """Pontuação de um termo que aparece `hits` vezes em uma mensagem de `length` termos."""
+    idf = math.log(1 + (documents - df + 0.5) / (df + 0.5))
+    return idf * hits * (K1 + 1) / (hits + K1 * (1 - B + B * length / (avg_length or 1)))
+
+
+metrics.registry.describe('search_seconds', 'Duração das buscas com /search')
@@ -0,0 +1,314 @@
+"""Exportação e importação dos dados do bot em JSONL comprimido.
+
+Cada tabela vai para um arquivo ``<Tabela>.jsonl.gz`` no diretório dado, um
+registro por linha. A leitura é feita em lotes pela chave primária (o Pony
+não expõe cursores do servidor), cada lote em uma transação própria, e a
+escrita é contínua: a memória usada não cresce com o tamanho das tabelas.
+
+A importação segue a ordem das dependências (usuários antes das mensagens),
+insere um lote por transação e pula os registros cuja chave já existe, então
+pode ser repetida depois de uma falha. Os ids das mensagens são mantidos, e
+os contadores de atividade e o índice de busca das mensagens importadas são
+refeitos depois pelas tasks de backfill do bot. Cada lote de mensagens
+inclui, na mesma transação, os ids inseridos no backfill dos contadores, que
+conta só as mensagens importadas, mesmo num banco que já tinha outras.
+
+Uso::
+
+    $ python -m gdgajubot.data.transfer export dump/ --database_url sqlite:///database.sqlite
+    $ python -m gdgajubot.data.transfer import dump/ --database_url postgres://...
+"""
+import abc
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+
+from gdgajubot import util
+from gdgajubot.data import analytics, search
+from gdgajubot.data.database import db, orm, Group, Message, State, User
+from gdgajubot.data.resources import (
+    Resources, SQL_CHUNK, chunks, json_decode, json_encode, naive_utc, parse_datetime,
+)
+
+DEFAULT_BATCH_SIZE = 1000
+
+# estados internos do banco de origem, recriados no destino
+INTERNAL_STATES = (analytics.BACKFILL_STATE, search.REBUILD_STATE, search.INDEX_STATE)
+
+
+class Table(abc.ABC):
+    """Leitura em lotes, serialização e inserção dos registros de uma entidade."""
+
+    entity = None
+
+    @property
+    def name(self):
+        return self.entity.__name__
+
+    def path(self, directory):
+        return os.path.join(directory, self.name + '.jsonl.gz')
+
+    @abc.abstractmethod
+    def page(self, after, limit):
+        """Até `limit` registros seguintes ao cursor `after` (None no início), em ordem de chave."""
+
+    @abc.abstractmethod
+    def cursor(self, row):
+        """Chave do registro, na forma do cursor de `page`."""
+
+    @abc.abstractmethod
+    def existing(self, rows):
+        """Cursores, entre os de `rows`, dos registros que já estão no banco."""
+
+    def encode(self, row):
+        return row
+
+    def insert(self, row):
+        self.entity(**row)
+
+    def inserted(self, rows):
+        """Chamado na transação do lote, com os registros inseridos."""
+
+
+class Users(Table):
+    entity = User
+
+    def page(self, after, limit):
+        query = User.select() if after is None else User.select(lambda u: u.telegram_id > after)
+        return [dict(telegram_id=u.telegram_id, telegram_username=u.telegram_username, is_bot_admin=u.is_bot_admin)
+                for u in query.order_by(User.telegram_id)[:limit]]
+
+    def cursor(self, row):
+        return row['telegram_id']
+
+    def existing(self, rows):
+        found = set()
+        for chunk in chunks([row['telegram_id'] for row in rows], SQL_CHUNK):
+            found.update(orm.select(u.telegram_id for u in User if u.telegram_id in chunk))
+        return found
+
+
+class Messages(Table):
+    entity = Message
+
+    def page(self, after, limit):
+        query = orm.select((m.id, m.chat_id, m.text, m.sent_at, m.sent_by.telegram_id)
+                           for m in Message if m.id > (after or 0))
+        return [dict(id=message_id, chat_id=chat_id, text=text, sent_at=sent_at, sent_by=sent_by)
+                for message_id, chat_id, text, sent_at, sent_by in query.order_by(1)[:limit]]
+
+    def cursor(self, row):
+        return row['id']
+
+    def existing(self, rows):
+        found = set()
+        for chunk in chunks([row['id'] for row in rows], SQL_CHUNK):
+            found.update(orm.select(m.id for m in Message if m.id in chunk))
+        return found
+
+    def encode(self, row):
+        return dict(row, sent_at=naive_utc(row['sent_at']).isoformat())
+
+    def insert(self, row):
+        Message(**dict(row, sent_at=parse_datetime(row['sent_at'])))
+
+    def inserted(self, rows):
+        # the imported messages skip log_messages, so only the backfill counts them
+        ids = [row['id'] for row in rows]
+        if ids:
+            schedule_rollup_backfill(min(ids), max(ids))
+
+
+class Groups(Table):
+    entity = Group
+
+    def page(self, after, limit):
+        query = Group.select() if after is None else Group.select(lambda g: g.telegram_id > after)
+        return [dict(telegram_id=g.telegram_id, telegram_groupname=g.telegram_groupname,
+                     has_daily_book=g.has_daily_book)
+                for g in query.order_by(Group.telegram_id)[:limit]]
+
+    def cursor(self, row):
+        return row['telegram_id']
+
+    def existing(self, rows):
+        found = set()
+        for chunk in chunks([row['telegram_id'] for row in rows], SQL_CHUNK):
+            found.update(orm.select(g.telegram_id for g in Group if g.telegram_id in chunk))
+        return found
+
+
+class States(Table):
+    entity = State
+
+    def page(self, after, limit):
+        if after is None:
+            query = State.select()
+        else:
+            chat_id, description = after
+            query = State.select(lambda s: s.telegram_id > chat_id or
+                                 (s.telegram_id == chat_id and s.description > description))
+        return [dict(telegram_id=s.telegram_id, description=s.description, info=s.info)
+                for s in query.order_by(State.telegram_id, State.description)[:limit]]
+
+    def cursor(self, row):
+        return row['telegram_id'], row['description']
+
+    def existing(self, rows):
+        found = set()
+        for chunk in chunks(sorted({row['telegram_id'] for row in rows}), SQL_CHUNK):
+            found.update(orm.select((s.telegram_id, s.description) for s in State if s.telegram_id in chunk))
+        return found
+
+    def encode(self, row):
+        # the progress of the backfills only makes sense in the source database
+        if row['telegram_id'] == analytics.HISTORY_CHAT and row['description'] in INTERNAL_STATES:
+            return None
+        return row
+
+
+def schedule_rollup_backfill(first, last):
+    """Inclui as mensagens de `first` a `last` no backfill dos contadores.
+
+    Um backfill já concluído é reiniciado só com elas; um em andamento é
+    estendido até `last`, já que os lotes são importados em ordem de id.
+    """
+    state = State.get(telegram_id=analytics.HISTORY_CHAT, description=analytics.BACKFILL_STATE)
+    progress = {'after': first - 1, 'until': last}
+    if state is None:
+        State(telegram_id=analytics.HISTORY_CHAT, description=analytics.BACKFILL_STATE, info=json_encode(progress))
+        return
+    current = json_decode(state.info)
+    if current['after'] < current['until']:
+        progress = {'after': min(current['after'], first - 1), 'until': max(current['until'], last)}
+    state.info = json_encode(progress)
+
+
+# in dependency order: the messages refer to the users
+TABLES = (Users(), Messages(), Groups(), States())
+
+
+def export_data(directory, tables=TABLES, batch_size=DEFAULT_BATCH_SIZE):
+    """Grava as tabelas em `directory`; retorna, por tabela, os registros e a duração."""
+    os.makedirs(directory, exist_ok=True)
+    report = []
+    for table in tables:
+        start, rows, after = time.perf_counter(), 0, None
+        with gzip.open(table.path(directory), 'wt', encoding='utf-8', compresslevel=6) as output:
+            while True:
+                with orm.db_session:
+                    page = table.page(after, batch_size)
+                if not page:
+                    break
+                after = table.cursor(page[-1])
+                for row in page:
+                    row = table.encode(row)
+                    if row is not None:
+                        output.write(json.dumps(row, ensure_ascii=False))
+                        output.write('\n')
+                        rows += 1
+        report.append(util.AttributeDict(table=table.name, rows=rows, seconds=time.perf_counter() - start))
+    return report
+
+
+def read_rows(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def import_data(directory, tables=TABLES, batch_size=DEFAULT_BATCH_SIZE):
+    """Insere os registros dos arquivos de `directory`, pulando os que já existem.
+
+    Retorna, por tabela, os registros inseridos, os pulados e a duração.
+    """
+    report = []
+    for table in tables:
+        path = table.path(directory)
+        if not os.path.exists(path):
+            continue
+        start, inserted, skipped = time.perf_counter(), 0, 0
+        batch = []
+        for row in read_rows(path):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                inserted, skipped = _insert_batch(table, batch, inserted, skipped)
+                batch = []
+        if batch:
+            inserted, skipped = _insert_batch(table, batch, inserted, skipped)
+        report.append(util.AttributeDict(table=table.name, rows=inserted, skipped=skipped,
+                                         seconds=time.perf_counter() - start))
+    _reset_sequences()
+    return report
+
+
+def _insert_batch(table, batch, inserted, skipped):
+    with orm.db_session:
+        existing = table.existing(batch)
+        rows = [row for row in batch if table.cursor(row) not in existing]
+        for row in rows:
+            table.insert(row)
+        table.inserted(rows)
+    return inserted + len(rows), skipped + len(batch) - len(rows)
+
+
+def _reset_sequences():
+    # PostgreSQL doesn't move the id sequence past ids inserted explicitly
+    if db.provider_name == 'postgres':
+        with orm.db_session:
+            db.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), COALESCE(MAX(id), 1)) FROM %s"
+                       % (Message._table_, Message._table_))
+
+
+def format_report(report):
+    lines = ['%-10s %10s %10s %12s' % ('tabela', 'registros', 'segundos', 'registros/s')]
+    for item in report:
+        rate = item.rows / item.seconds if item.seconds else 0.0
+        lines.append('%-10s %10d %10.1f %12.0f' % (item.table, item.rows, item.seconds, rate))
+        if item.get('skipped'):
+            lines.append('%-10s %10d já existentes' % ('', item.skipped))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Exporta ou importa os dados do GDGAjuBot em JSONL comprimido')
+    parser.add_argument('command', choices=('export', 'import'), help='Operação')
+    parser.add_argument('directory', help='Diretório dos arquivos .jsonl.gz')
+    parser.add_argument('-db', '--database_url', default=os.environ.get('DATABASE_URL'), help='URL do banco')
+    parser.add_argument('-c', '--config_file', help='Arquivo de configuração, para usar o banco definido nele')
+    parser.add_argument('--tables', help='Tabelas, separadas por vírgula (padrão: %s)' % ','.join(
+        table.name for table in TABLES))
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE, help='Registros por transação')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    tables = TABLES
+    if args.tables:
+        names = args.tables.split(',')
+        tables = [table for table in TABLES if table.name in names]
+        unknown = set(names) - {table.name for table in tables}
+        if unknown:
+            parser.error('tabelas desconhecidas: %s' % ', '.join(sorted(unknown)))
+
+    config = util.BotConfig(database_url=args.database_url, config_file=args.config_file)
+    resources = Resources(config)
+
+    if args.command == 'export':
+        report = export_data(args.directory, tables, args.batch_size)
+    else:
+        report = import_data(args.directory, tables, args.batch_size)
+        if any(item.table == Message.__name__ and item.rows for item in report):
+            last = resources.start_search_rebuild()
+            logging.info("O bot vai indexar as mensagens importadas, até a #%d", last)
+    print(format_report(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
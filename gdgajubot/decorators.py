@@ -5,11 +5,29 @@ from collections import defaultdict
 
 from telegram.ext import CommandHandler, MessageHandler, Filters
 
+from gdgajubot import metrics, watchdog
 from gdgajubot.util import BotDecorator, bot_callback, bot_callback_with_args
 
 __all__ = ('do_not_spam', 'command', 'on_message', 'task', 'easter_egg')
 
 
+def instrument(target, kind, name, method):
+    # in multi-tenant mode, every metric of the call is labeled with the tenant
+    tenant = getattr(target.config, 'tenant', None)
+    context = dict(tenant=tenant) if tenant else {}
+    return watchdog.guard(kind, name, metrics.instrument(kind, name, method, **context))
+
+
+def flood_gate(target, name, method):
+    """Descarta o comando quando o chat estourou o limite de comandos."""
+    @functools.wraps(method)
+    def wrapper(message, *args):
+        if target.overload.allow_command(message.chat_id, name):
+            return method(message, *args)
+
+    return wrapper
+
+
 def do_not_spam(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -21,12 +39,16 @@ def do_not_spam(func):
 
 class command(BotDecorator):
     _arguments_ = (1, ...)
-    _keywords_ = (0, 2)
+    _keywords_ = (0, 3)
 
     @classmethod
     def do_process(cls, target, method, dispatcher, *args, **kwargs):
         names = [(k[1:] if k[0] == '/' else k)
                  for k in args]
+        method = instrument(target, 'command', names[0], method)
+        # admin commands are always essential
+        if not kwargs.get('essential', kwargs.get('admin', False)):
+            method = flood_gate(target, names[0], method)
 
         if kwargs.get('pass_args'):
             handler = CommandHandler(names, bot_callback_with_args(method), pass_args=True)
@@ -55,7 +77,8 @@ class on_message(BotDecorator):
         if not to_spam:
             search = do_not_spam(search)
 
-        action = (search, method)
+        kind = 'on_message' if to_spam else 'easter_egg'
+        action = (search, instrument(target, kind, method.__name__, method))
 
         try:
             instance['actions'] += (action,)
@@ -74,7 +97,8 @@ class on_message(BotDecorator):
                         func(update.message)
                 for search, func in no_spam.get('actions', ()):
                     if search(update.message.text):
-                        func(update.message)
+                        if target.overload.allow_optional('easter_egg', func.__name__):
+                            func(update.message)
                         return
 
             dispatcher.add_handler(
@@ -89,14 +113,27 @@ class on_message(BotDecorator):
 easter_egg = functools.partial(on_message, to_spam=False)
 
 
+def leader_only(target, method):
+    """Executa a task só no líder, quando o bot faz parte de um cluster."""
+    @functools.wraps(method)
+    def wrapper(*args):
+        if target.cluster is None or target.cluster.is_leader:
+            return method(*args)
+
+    return wrapper
+
+
 class task(BotDecorator):
     _arguments_ = 0
-    _keywords_ = 1
+    _keywords_ = (1, 2)
 
     @classmethod
     def do_process(cls, target, method, dispatcher, **kwargs):
 
         scheduler = target.updater.job_queue
+        method = instrument(target, 'task', method.__name__, method)
+        if kwargs.pop('singleton', False):
+            method = leader_only(target, method)
         # repeating task
         if 'each' in kwargs:
             kwargs['interval'] = kwargs.pop('each')
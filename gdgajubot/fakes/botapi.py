@@ -0,0 +1,313 @@
+"""Servidor local que imita a Bot API do Telegram, para testes de carga.
+
+Implementa getUpdates, sendMessage, sendPhoto, getChat e getMe, com injeção
+de respostas 429, latência e erros. O bot deve apontar para ele com
+`--telegram_base_url`::
+
+    $ python -m gdgajubot.fakes.botapi --port 8081 --rate 20 --messages 1000
+    $ gdgajubot -t 123456:FAKE --telegram_base_url http://127.0.0.1:8081/bot
+
+Ao final da carga é informada a latência entre a entrega de cada
+atualização e a resposta do bot.
+"""
+import argparse
+import email.parser
+import itertools
+import json
+import logging
+import random
+import re
+import sys
+import time
+from collections import defaultdict, deque
+from threading import Condition
+from urllib.parse import parse_qsl
+
+from gdgajubot.fakes.server import FakeServer, Faults
+
+METHOD_PATH = re.compile(r'^/bot(?P<token>[^/]+)/(?P<method>\w+)$')
+
+
+def parse_params(query, body, content_type):
+    """Extrai os parâmetros de uma chamada à Bot API (query, JSON, form ou multipart)."""
+    params = dict(parse_qsl(query))
+    content_type = content_type or ''
+
+    if content_type.startswith('application/json') and body:
+        params.update(json.loads(body.decode('utf-8')))
+    elif content_type.startswith('application/x-www-form-urlencoded'):
+        params.update(parse_qsl(body.decode('utf-8')))
+    elif content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body
+        )
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                params[name] = '<file %s>' % part.get_filename()
+            else:
+                params[name] = part.get_payload(decode=True).decode('utf-8')
+
+    return params
+
+
+class FakeBotAPI(FakeServer):
+    """Imitação da Bot API.
+
+    :param rate_limit_rate: probabilidade de responder 429 a um envio
+    :param enforce_limits: aplica os limites reais do Telegram
+        (1 mensagem/s por chat e 30 mensagens/s no total), respondendo 429
+    """
+
+    BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+    def __init__(self, host='127.0.0.1', port=0, faults=None, rate_limit_rate=0.0, retry_after=1,
+                 enforce_limits=False):
+        super().__init__(host, port, faults)
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.enforce_limits = enforce_limits
+
+        self.chats = {}
+        self.webhook = None
+        self.replies = []
+        self.latencies = []
+        self.polling = False
+
+        self._updates = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._pending = defaultdict(dict)  # chat_id -> {message_id: injected_at}
+        self._sent = defaultdict(deque)     # chat_id -> send times (for limits)
+        self._sent_all = deque()
+        self._cond = Condition()
+
+    @property
+    def base_url(self):
+        return self.address + '/bot'
+
+    # Injeção de atualizações
+
+    def push_message(self, chat, user, text, entities=None, date=None):
+        """Enfileira uma mensagem de `user` em `chat` para o próximo getUpdates."""
+        self.chats[chat['id']] = chat
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(date or time.time()),
+            'chat': chat,
+            'from': user,
+            'text': text,
+        }
+        if entities:
+            message['entities'] = entities
+
+        with self._cond:
+            self._updates.append({'update_id': next(self._update_ids), 'message': message})
+            self._pending[chat['id']][message['message_id']] = time.perf_counter()
+            self._cond.notify_all()
+        return message['message_id']
+
+    def wait_polling(self, timeout=None):
+        """Aguarda o bot iniciar o long polling."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.polling, timeout)
+
+    # Bot API
+
+    def handle(self, method, path, query, body, headers):
+        match = METHOD_PATH.match(path)
+        if not match:
+            return self.api_error(404, 'Not Found')
+
+        name = match.group('method')
+        params = parse_params(query, body, headers.get('Content-Type'))
+        api_method = getattr(self, 'api_' + name, None)
+        if api_method is None:
+            # methods without interest for the load tests just succeed
+            return self.ok(True)
+        return api_method(params)
+
+    def api_getMe(self, params):
+        return self.ok(self.BOT_USER)
+
+    def api_getMyCommands(self, params):
+        return self.ok([])
+
+    def api_setWebhook(self, params):
+        self.webhook = params
+        return self.ok(True)
+
+    def api_getChat(self, params):
+        chat_id = int(params['chat_id'])
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return self.api_error(400, 'Bad Request: chat not found')
+        return self.ok(chat)
+
+    def api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            if timeout and not self.polling:
+                self.polling = True
+                self._cond.notify_all()
+
+            # confirmed updates are forgotten
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+
+            updates = list(itertools.islice(self._updates, limit))
+
+        return self.ok(updates)
+
+    def api_sendMessage(self, params):
+        return self.send(params, text=params.get('text', ''))
+
+    def api_sendPhoto(self, params):
+        return self.send(params, photo=[{'file_id': 'fake', 'width': 1, 'height': 1}],
+                         caption=params.get('caption'))
+
+    def send(self, params, **content):
+        chat_id = int(params['chat_id'])
+
+        with self._cond:
+            limited = self.rate_limited(chat_id)
+        if limited or self.faults.draw(self.rate_limit_rate):
+            self.count('rate_limited')
+            return self.api_error(429, 'Too Many Requests: retry after %d' % self.retry_after,
+                                  parameters={'retry_after': self.retry_after})
+
+        now = time.perf_counter()
+        reply_to = params.get('reply_to_message_id')
+
+        # the reply refers to the message it answers, or to the oldest unanswered one
+        with self._cond:
+            pending = self._pending[chat_id]
+            delivered = pending.pop(int(reply_to), None) if reply_to else None
+            if delivered is None and pending:
+                delivered = pending.pop(min(pending))
+            if delivered is not None:
+                self.latencies.append(now - delivered)
+
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': self.chats.get(chat_id, {'id': chat_id, 'type': 'private'}),
+            'from': self.BOT_USER,
+        }
+        message.update((k, v) for k, v in content.items() if v is not None)
+        self.replies.append(message)
+        self.count('sent')
+        return self.ok(message)
+
+    def rate_limited(self, chat_id):
+        if not self.enforce_limits:
+            return False
+
+        now = time.monotonic()
+        sent, sent_all = self._sent[chat_id], self._sent_all
+        for times in (sent, sent_all):
+            while times and now - times[0] >= 1:
+                times.popleft()
+
+        if len(sent) >= 1 or len(sent_all) >= 30:
+            return True
+
+        sent.append(now)
+        sent_all.append(now)
+        return False
+
+    def ok(self, result):
+        return self.json({'ok': True, 'result': result})
+
+    def api_error(self, status, description, **extra):
+        return self.json(dict({'ok': False, 'error_code': status, 'description': description}, **extra), status)
+
+    error = api_error
+
+    def report(self):
+        from gdgajubot.bench import percentile
+
+        latencies = sorted(self.latencies)
+        unanswered = sum(len(pending) for pending in self._pending.values())
+        return dict(self.stats, answered=len(latencies), unanswered=unanswered, latency_ms={
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+        })
+
+
+class LoadGenerator:
+    """Injeta mensagens sintéticas (ver `bench.Workload`) no servidor a uma taxa fixa."""
+
+    def __init__(self, server, workload):
+        self.server = server
+        self.workload = workload
+
+    def run(self):
+        interval = 1 / self.workload.rate if self.workload.rate else 0
+        start = time.perf_counter()
+
+        for i, update in enumerate(self.workload.updates(bot=None)):
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            data = update.message.to_dict()
+            self.server.push_message(data['chat'], data['from'], data['text'], data.get('entities'))
+
+
+def main(argv=None):
+    from gdgajubot.bench import Workload
+
+    parser = argparse.ArgumentParser(description='Bot API de mentira para testes de carga do GDGAjuBot')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='Latência das respostas, em segundos')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Probabilidade de erro 500')
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0, help='Probabilidade de 429 nos envios')
+    parser.add_argument('--enforce_limits', action='store_true', help='Aplica os limites reais do Telegram')
+    parser.add_argument('--messages', type=int, default=0, help='Mensagens a injetar (0 apenas serve)')
+    parser.add_argument('--rate', type=float, default=10.0, help='Mensagens injetadas por segundo')
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--command_ratio', type=float, default=0.2)
+    parser.add_argument('--drain', type=float, default=5.0, help='Segundos de espera pelas últimas respostas')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    faults = Faults(latency=args.latency, error_rate=args.error_rate)
+    server = FakeBotAPI(args.host, args.port, faults, rate_limit_rate=args.rate_limit_rate,
+                        enforce_limits=args.enforce_limits).start()
+    logging.info("Bot API de mentira em %s", server.base_url)
+
+    try:
+        if not args.messages:
+            while True:
+                time.sleep(3600)
+
+        logging.info("Aguardando o bot iniciar o polling...")
+        server.wait_polling()
+
+        workload = Workload(messages=args.messages, chats=args.chats, rate=args.rate,
+                            command_ratio=args.command_ratio, seed=random.randrange(1 << 30))
+        LoadGenerator(server, workload).run()
+        time.sleep(args.drain)
+
+        print(json.dumps(server.report(), indent=2))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
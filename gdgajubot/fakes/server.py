@@ -0,0 +1,133 @@
+import abc
+import json
+import logging
+import random
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+
+
+class Faults:
+    """Falhas injetadas nas respostas de um servidor de mentira.
+
+    :param latency: atraso em segundos, fixo ou um par (mínimo, máximo)
+    :param error_rate: probabilidade de responder com erro 500
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self._lock = Lock()
+
+    def delay(self):
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            with self._lock:
+                latency = self.random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def draw(self, probability):
+        if not probability:
+            return False
+        with self._lock:
+            return self.random.random() < probability
+
+    def should_fail(self):
+        return self.draw(self.error_rate)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeServer(abc.ABC):
+    """Base dos servidores HTTP de mentira, executados em uma thread própria.
+
+    Subclasses implementam `handle`, que recebe o método, o caminho, a query
+    string, o corpo e os cabeçalhos da requisição, e retorna uma tupla
+    ``(status, corpo, content_type)``.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, faults=None):
+        self.faults = faults or Faults()
+        self.stats = {'requests': 0, 'errors_injected': 0}
+        self._stats_lock = Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._serve('GET')
+
+            def do_POST(self):
+                self._serve('POST')
+
+            def _serve(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                path, _, query = self.path.partition('?')
+                status, payload, content_type = server.respond(method, path, query, body, self.headers)
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logging.debug("%s: %s", server.__class__.__name__, format % args)
+
+        self.httpd = _ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = Thread(target=self.httpd.serve_forever, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def respond(self, method, path, query, body, headers):
+        self.count('requests')
+        self.faults.delay()
+        if self.faults.should_fail():
+            self.count('errors_injected')
+            return self.error(500, 'Internal Server Error (injected)')
+        try:
+            return self.handle(method, path, query, body, headers)
+        except Exception as e:
+            logging.exception(e)
+            return self.error(500, str(e))
+
+    @abc.abstractmethod
+    def handle(self, method, path, query, body, headers):
+        """Responde à requisição com ``(status, corpo, content_type)``."""
+
+    @staticmethod
+    def json(data, status=200):
+        return status, json.dumps(data).encode('utf-8'), 'application/json'
+
+    def error(self, status, description):
+        return self.json({'error': description}, status)
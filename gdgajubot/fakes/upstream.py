@@ -0,0 +1,215 @@
+"""Servidor local que imita os serviços externos consultados pelo `Resources`.
+
+Serve respostas gravadas (ou geradas) do Meetup, Facebook, Packt e dos sites
+de cupons, com latência, taxa de erros e tamanho das respostas ajustáveis.
+Cada serviço fica sob um prefixo com o seu nome, então basta apontar o bot
+com `--upstream_base_url`::
+
+    $ python -m gdgajubot.fakes.upstream --port 8082 --latency 0.2
+    $ gdgajubot ... --upstream_base_url http://127.0.0.1:8082
+
+Com `--bench N`, mede N vezes os caminhos frios e quentes (com cache) de
+`/events`, `/book` e `/udemy`.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+from urllib.parse import parse_qsl
+
+from gdgajubot.fakes.server import FakeServer, Faults
+
+class FakeUpstreams(FakeServer):
+    """Imitação dos serviços externos.
+
+    :param fixtures_dir: diretório com respostas gravadas, organizadas como
+        ``<serviço>/<caminho>[.json|.html]``; caminhos sem arquivo usam
+        respostas geradas
+    :param scale: multiplica a quantidade de itens das respostas geradas
+    :param padding: bytes extras em cada resposta gerada
+    :param upstream_faults: falhas específicas por serviço, além das globais
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, faults=None, fixtures_dir=None, scale=1, padding=0,
+                 upstream_faults=None):
+        super().__init__(host, port, faults)
+        self.fixtures_dir = fixtures_dir
+        self.scale = scale
+        self.padding = padding
+        self.upstream_faults = upstream_faults or {}
+
+    def handle(self, method, path, query, body, headers):
+        _, upstream, path = path.split('/', 2) if path.count('/') >= 2 else ('', path.strip('/'), '')
+        path = '/' + path
+        self.count(upstream)
+
+        faults = self.upstream_faults.get(upstream)
+        if faults:
+            faults.delay()
+            if faults.should_fail():
+                self.count('errors_injected')
+                return self.error(500, 'Internal Server Error (injected)')
+
+        recorded = self.recorded(upstream, path)
+        if recorded:
+            return recorded
+
+        generate = getattr(self, 'generate_' + upstream, None)
+        if generate is None:
+            return self.error(404, 'Unknown upstream %r' % upstream)
+        return generate(path, dict(parse_qsl(query)))
+
+    def recorded(self, upstream, path):
+        if not self.fixtures_dir:
+            return None
+
+        base = os.path.join(self.fixtures_dir, upstream, path.strip('/') or 'index')
+        for filename, content_type in ((base, 'text/html'), (base + '.json', 'application/json'),
+                                       (base + '.html', 'text/html')):
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    return 200, f.read(), content_type
+        return None
+
+    # Respostas geradas
+
+    def items(self, limit=None):
+        # like the real APIs, a requested limit wins over the scale
+        return range(int(limit) if limit else 5 * self.scale)
+
+    def pad(self):
+        return 'x' * self.padding
+
+    def generate_meetup(self, path, params):
+        now = time.time()
+        return self.json([
+            {'name': 'Evento %d' % i, 'time': int((now + (i + 1) * 86400) * 1000),
+             'link': 'https://www.meetup.com/GDG-Aracaju/events/%d/' % i, 'padding': self.pad()}
+            for i in self.items(params.get('page'))
+        ])
+
+    def generate_facebook(self, path, params):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self.json({'data': [
+            {'id': str(1000 + i), 'name': 'Evento %d' % i, 'padding': self.pad(),
+             'start_time': (now + datetime.timedelta(days=i + 1)).strftime('%Y-%m-%dT%H:%M:%S%z')}
+            for i in self.items(params.get('limit'))
+        ]})
+
+    def generate_packt_services(self, path, params):
+        return self.json({'data': [{'productId': '9781788000000', 'padding': self.pad()}]})
+
+    def generate_packt_cdn(self, path, params):
+        return self.json({
+            'title': 'Fake Book', 'oneLiner': 'A book served by the fixture server. ' + self.pad(),
+            'coverImage': 'https://static.packt-cdn.com/products/9781788000000/cover/smaller',
+        })
+
+    def html(self, body):
+        return 200, ('<html><body>%s<!-- %s --></body></html>' % (body, self.pad())).encode('utf-8'), 'text/html'
+
+    def generate_discountsglobal(self, path, params):
+        return self.html(''.join(
+            '<div class="item-panel"><h3><a>Discount: 100%% off – Curso %d</a></h3>'
+            '<div class="link-holder"><a href="https://www.udemy.com/course/dg-%d/?couponCode=FREE">Get</a>'
+            '</div></div>' % (i, i)
+            for i in self.items()
+        ))
+
+    def generate_learnviral(self, path, params):
+        return self.html(''.join(
+            '<h3 class="entry-title">[Free]Curso LV %d</h3>'
+            '<a class="coupon-code-link btn promotion" href="https://www.udemy.com/course/lv-%d/?couponCode=FREE">'
+            'Get</a>' % (i, i)
+            for i in self.items()
+        ))
+
+    def generate_onlinetutorials(self, path, params):
+        return self.html(''.join(
+            '<h3 class="entry-title"><a>Curso OT %d</a></h3>'
+            '<a class="coupon-code-link button promotion" href="https://www.udemy.com/course/ot-%d/?couponCode=FREE">'
+            'Get</a>' % (i, i)
+            for i in self.items()
+        ))
+
+
+def bench_paths(resources, rounds=10):
+    """Mede as consultas de `/events`, `/book` e `/udemy` com o cache frio e quente."""
+    from gdgajubot.bench import percentile
+    from gdgajubot.data.resources import Resources
+
+    paths = {
+        'events': (Resources.fetch_events, lambda: resources.get_events(5)),
+        'book': (Resources.get_packt_free_book, resources.get_packt_free_book),
+        'udemy': (Resources.get_discounts, resources.get_discounts),
+    }
+
+    report = {}
+    for name, (cached, call) in paths.items():
+        timings = {'cold': [], 'warm': []}
+        errors = 0
+        for _ in range(rounds):
+            Resources.cache.get_cache(cached._arg_namespace).clear()
+            for phase in ('cold', 'warm'):
+                t0 = time.perf_counter()
+                try:
+                    call()
+                except Exception:
+                    errors += 1
+                timings[phase].append(time.perf_counter() - t0)
+
+        report[name] = {'errors': errors}
+        for phase, values in timings.items():
+            values.sort()
+            report[name][phase + '_ms'] = {
+                'p50': percentile(values, 50) * 1000,
+                'p95': percentile(values, 95) * 1000,
+            }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serviços externos de mentira para benchmarks do GDGAjuBot')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--fixtures', help='Diretório com respostas gravadas')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latência das respostas, em segundos')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Probabilidade de erro 500')
+    parser.add_argument('--scale', type=int, default=1, help='Multiplicador da quantidade de itens')
+    parser.add_argument('--padding', type=int, default=0, help='Bytes extras em cada resposta')
+    parser.add_argument('--seed', type=int, default=None, help='Semente das falhas injetadas')
+    parser.add_argument('--bench', type=int, default=0, help='Rodadas de benchmark (0 apenas serve)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    faults = Faults(latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    server = FakeUpstreams(args.host, args.port, faults, fixtures_dir=args.fixtures, scale=args.scale,
+                           padding=args.padding).start()
+    logging.info("Serviços externos de mentira em %s", server.address)
+
+    try:
+        if not args.bench:
+            while True:
+                time.sleep(3600)
+
+        from gdgajubot.data.resources import Resources
+        from gdgajubot.util import BotConfig
+
+        config = BotConfig(meetup_key='fake', group_name='GDG-Aracaju', events_source='meetup',
+                           upstream_base_url=server.address)
+        config.database = {'provider': 'sqlite', 'filename': ':memory:'}
+        print(json.dumps(bench_paths(Resources(config), args.bench), indent=2))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""Configuração do log do bot.
+
+Os registros passam por uma fila e são escritos por uma thread própria, para
+que os handlers não esperem pela escrita no terminal. Cada registro recebe o
+chat e o handler em execução (atributos `chat_id` e `handler`), que podem ser
+usados no `LOG_FORMAT` ou aparecem como campos com `LOG_FORMAT=json`.
+
+Os logs de cada mensagem recebida usam o logger `per_message` e podem ser
+amostrados com `LOG_SAMPLE_RATE` (por exemplo, 0.01 mantém 1%); avisos e
+erros nunca são descartados.
+"""
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+
+from gdgajubot import metrics, watchdog
+
+DEFAULT_FORMAT = '%(asctime)s %(message)s'
+DEFAULT_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+# logger dos registros emitidos a cada mensagem recebida
+per_message = logging.getLogger('gdgajubot.messages')
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Enfileira os registros deixando a formatação para a thread de escrita."""
+
+    def prepare(self, record):
+        # only merges the arguments, which may change after the call
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_exception_formatter = logging.Formatter()
+
+
+class ContextFilter(logging.Filter):
+    """Anota os registros com o chat e o handler em execução na thread."""
+
+    def filter(self, record):
+        invocation = watchdog.monitor.current()
+        if invocation is None:
+            record.chat_id = record.handler = None
+        else:
+            record.chat_id = invocation.chat_id
+            record.handler = '%s:%s' % (invocation.kind, invocation.handler)
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Mantém apenas a fração `rate` dos registros abaixo de WARNING."""
+
+    def __init__(self, rate, seed=None):
+        super().__init__()
+        self.rate = rate
+        self.random = random.Random(seed)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.random.random() < self.rate:
+            return True
+        metrics.inc('log_records_sampled_out_total', logger=record.name)
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """Um objeto JSON por linha, com os campos de contexto."""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for field in ('chat_id', 'handler'):
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt:
+            return super().formatTime(record, datefmt)
+        return datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds')
+
+
+def make_formatter(log_format=None, datefmt=None):
+    if log_format == 'json':
+        return JsonFormatter(datefmt=datefmt)
+    return logging.Formatter(log_format or DEFAULT_FORMAT, datefmt or DEFAULT_DATE_FORMAT)
+
+
+def setup(log_format=None, datefmt=None, level=logging.INFO, sample_rate=1.0, stream=None):
+    """Configura o log raiz para escrever por uma fila em segundo plano.
+
+    Retorna o `QueueListener` já iniciado; `listener.stop()` descarrega a fila.
+    """
+    output = logging.StreamHandler(stream)
+    output.setFormatter(make_formatter(log_format, datefmt))
+
+    records = queue.Queue()
+    handler = QueueHandler(records)
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    for old in per_message.filters[:]:
+        per_message.removeFilter(old)
+    if sample_rate < 1:
+        per_message.addFilter(SampleFilter(sample_rate))
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+metrics.registry.describe('log_records_sampled_out_total', 'Registros de log descartados pela amostragem')
@@ -0,0 +1,161 @@
+"""Inspeção da memória ocupada pelas estruturas do bot.
+
+Conta as entradas e estima os bytes dos estados por chat, das chaves
+`__memory__`, das agendas e índices, do registro de chats e de cada
+namespace do cache em memória do beaker. Opcionalmente, compara dois
+instantâneos do `tracemalloc` para achar as linhas que mais alocaram.
+"""
+import collections
+import os
+import sys
+import tracemalloc
+import types
+
+from beaker.container import MemoryNamespaceManager
+
+from gdgajubot import metrics
+
+# tipos contados pelo tamanho próprio, sem seguir as referências
+OPAQUE_TYPES = (
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+    types.CodeType, types.FrameType,
+)
+
+CONTAINER_TYPES = (list, tuple, set, frozenset, collections.deque)
+
+
+def deep_sizeof(obj, seen=None):
+    """Estimativa dos bytes de `obj` e de tudo o que ele alcança.
+
+    Objetos já visitados (ou pré-incluídos em `seen`) não são contados de novo.
+    Funções, classes e módulos contam apenas o próprio tamanho.
+    """
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, OPAQUE_TYPES):
+            continue
+        if isinstance(obj, dict):
+            for key, value in _snapshot(obj.items, ()):
+                stack.append(key)
+                stack.append(value)
+        elif isinstance(obj, CONTAINER_TYPES):
+            stack.extend(_snapshot(lambda: obj, ()))
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return size
+
+
+def _snapshot(iterable, default):
+    # the structures are shared with the dispatcher threads
+    for _ in range(3):
+        try:
+            return list(iterable())
+        except RuntimeError:
+            continue
+    return default
+
+
+def cache_namespaces():
+    """Namespaces do cache em memória do beaker, com os respectivos dicionários."""
+    return dict(_snapshot(MemoryNamespaceManager.namespaces.dict.items, ()))
+
+
+def process_rss():
+    """Memória residente do processo em bytes, se disponível."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def report(g_bot):
+    """Lista de (estrutura, entradas, bytes estimados) das estruturas do bot."""
+    # shared objects must not be attributed to each structure
+    excluded = {id(g_bot), id(g_bot.resources), id(g_bot.config), id(getattr(g_bot, 'bot', None))}
+
+    def measure(obj):
+        return deep_sizeof(obj, set(excluded))
+
+    rows = []
+    memory = []
+    for state_id, data in _snapshot(g_bot.states.items, ()):
+        rows.append(('states.%s' % state_id, len(data), measure(data)))
+        memory.extend(state.get('__memory__') or {} for state in _snapshot(data.values, ()))
+    rows.append(('states.__memory__', sum(len(m) for m in memory), measure(memory)))
+
+    rows.append(('book_schedule', len(g_bot.book_schedule), measure(g_bot.book_schedule)))
+    rows.append(('activity', len(g_bot.activity), measure(g_bot.activity)))
+    rows.append(('chats', len(g_bot.chats), measure(g_bot.chats)))
+
+    for namespace, data in sorted(cache_namespaces().items()):
+        # namespaces of cached functions are named "<file>|<function>"
+        rows.append(('cache.%s' % namespace.rsplit('|', 1)[-1], len(data), measure(data)))
+
+    return rows
+
+
+def publish(rows, registry=metrics.registry):
+    """Atualiza os medidores de memória a partir de um relatório."""
+    for name, entries, size in rows:
+        registry.set('memory_entries', entries, structure=name)
+        registry.set('memory_bytes', size, structure=name)
+    rss = process_rss()
+    if rss is not None:
+        registry.set('process_resident_memory_bytes', rss)
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '%.0f %s' % (size, unit) if unit == 'B' else '%.1f %s' % (size, unit)
+        size /= 1024
+    return '%.1f GiB' % size
+
+
+class AllocationTracker:
+    """Compara instantâneos do `tracemalloc` entre dois momentos."""
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.baseline = None
+
+    @property
+    def active(self):
+        return tracemalloc.is_tracing() and self.baseline is not None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.baseline = tracemalloc.take_snapshot()
+
+    def diff(self, limit=10):
+        """Linhas com maior crescimento desde o instantâneo anterior, que passa a ser o atual."""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        stats = snapshot.compare_to(self.baseline, 'lineno')
+        self.baseline = snapshot
+        return stats[:limit]
+
+    def stop(self):
+        self.baseline = None
+        tracemalloc.stop()
+
+
+metrics.registry.describe('memory_entries', 'Entradas em cada estrutura mantida pelo bot')
+metrics.registry.describe('memory_bytes', 'Bytes estimados de cada estrutura mantida pelo bot')
+metrics.registry.describe('process_resident_memory_bytes', 'Memória residente do processo')
+
+tracker = AllocationTracker()
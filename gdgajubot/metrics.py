@@ -0,0 +1,268 @@
+"""Métricas de contagem e latência no formato de exposição do Prometheus."""
+import contextlib
+import functools
+import logging
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import RLock, Thread, local
+
+# limites (em segundos) dos baldes dos histogramas de latência
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estima o quantil `q` por interpolação linear dentro do balde."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen, lower = 0, 0.0
+        for bound, n in zip(self.buckets, self.counts):
+            if seen + n >= rank and n:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return lower
+
+
+class Registry:
+    """Conjunto de contadores, medidores e histogramas, identificados por nome e rótulos."""
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        self._lock = RLock()
+        self._context = local()
+
+    def _key(self, name, labels):
+        context = getattr(self._context, 'labels', None)
+        if context:
+            labels = dict(context, **labels)
+        return name, tuple(sorted(labels.items()))
+
+    @contextlib.contextmanager
+    def labels(self, **labels):
+        """Acrescenta `labels` a tudo o que a thread atual registrar dentro do bloco."""
+        outer = getattr(self._context, 'labels', None)
+        self._context.labels = dict(outer or {}, **labels)
+        try:
+            yield
+        finally:
+            self._context.labels = outer
+
+    def inc(self, name, n=1, **labels):
+        with self._lock:
+            self.counters[self._key(name, labels)] += n
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def timed(self, name, **labels):
+        """Decorator que registra a duração de cada chamada no histograma `name`."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def render(self):
+        """Exporta as métricas no formato texto do Prometheus."""
+        lines = []
+
+        def fmt_labels(labels, **extra):
+            pairs = list(labels) + sorted(extra.items())
+            if not pairs:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                                     for k, v in pairs)
+
+        seen = set()
+
+        def header(name, kind):
+            if (name, kind) not in seen:
+                seen.add((name, kind))
+                if name in self.help:
+                    lines.append('# HELP %s %s' % (name, self.help[name]))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name, 'counter')
+                lines.append('%s%s %s' % (name, fmt_labels(labels), _number(value)))
+
+            for (name, labels), value in sorted(self.gauges.items()):
+                header(name, 'gauge')
+                lines.append('%s%s %s' % (name, fmt_labels(labels), _number(value)))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                header(name, 'histogram')
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else _number(bound)
+                    lines.append('%s_bucket%s %d' % (name, fmt_labels(labels, le=le), cumulative))
+                lines.append('%s_sum%s %s' % (name, fmt_labels(labels), _number(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, fmt_labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def handler_summary(self, **only):
+        """Resumo por handler: chamadas, erros, latência média e p95.
+
+        Com `only`, considera apenas as séries com esses rótulos (por exemplo, `tenant`).
+        """
+        summary = {}
+        with self._lock:
+            for (name, labels), histogram in self.histograms.items():
+                if name != 'handler_latency_seconds':
+                    continue
+                info = dict(labels)
+                if any(info.get(k) != v for k, v in only.items()):
+                    continue
+                errors = self.counters.get(('handler_errors_total', labels), 0)
+                summary[info['kind'], info['handler']] = dict(
+                    info, calls=histogram.count, errors=int(errors), total=histogram.sum,
+                    avg=histogram.sum / histogram.count if histogram.count else 0.0,
+                    p95=histogram.quantile(0.95),
+                )
+        return summary
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+
+class _Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.perf_counter() - self.start
+        self.registry.observe(self.name, self.elapsed, **self.labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else '%d' % value
+
+
+# registro padrão do processo
+registry = Registry()
+registry.describe('handler_calls_total', 'Chamadas de handlers do bot')
+registry.describe('handler_errors_total', 'Chamadas de handlers que terminaram em exceção')
+registry.describe('handler_latency_seconds', 'Duração das chamadas de handlers do bot')
+registry.describe('db_session_seconds', 'Duração das sessões de banco de dados')
+registry.describe('upstream_request_seconds', 'Duração das requisições aos serviços externos')
+registry.describe('telegram_send_seconds', 'Duração dos envios ao Telegram')
+registry.describe('catch_up_updates_total', 'Atualizações pendentes tratadas na inicialização')
+
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+timed = registry.timed
+
+
+def instrument(kind, name, func, **context):
+    """Envolve um handler para contar chamadas, erros e registrar a latência.
+
+    Os rótulos de `context` (por exemplo, `tenant`) valem também para as
+    métricas registradas durante a chamada.
+    """
+    labels = dict(kind=kind, handler=name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        registry.inc('handler_calls_total', **labels)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            registry.inc('handler_errors_total', **labels)
+            raise
+        finally:
+            registry.observe('handler_latency_seconds', time.perf_counter() - start, **labels)
+
+    if not context:
+        return wrapper
+
+    @functools.wraps(func)
+    def labeled(*args, **kwargs):
+        with registry.labels(**context):
+            return wrapper(*args, **kwargs)
+
+    return labeled
+
+
+class MetricsServer:
+    """Servidor HTTP opcional que expõe `/metrics`."""
+
+    def __init__(self, port, host='0.0.0.0', registry=registry):
+        metrics_registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = metrics_registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logging.debug("MetricsServer: " + format, *args)
+
+        self.httpd = HTTPServer((host, port), Handler)
+
+    def start(self):
+        Thread(target=self.httpd.serve_forever, name='MetricsServer', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
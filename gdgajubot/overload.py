@@ -0,0 +1,152 @@
+"""Controle de enxurradas por chat e descarte de trabalho opcional sob sobrecarga.
+
+Com o limite ativado, cada chat tem um balde de fichas para os comandos: um
+comando gasta uma ficha, e as fichas voltam a uma taxa fixa. Comandos
+essenciais (e os de admin) não passam pelo balde.
+
+O bot está sobrecarregado quando a fila do dispatcher passa de um tamanho ou
+a espera média nela passa de um limite. A média decai com o tempo, mesmo sem
+novas atualizações, para o estado não ficar preso depois de um pico. Nesse estado, o trabalho opcional
+(easter eggs e os registros de log de cada mensagem) é descartado. Todo
+descarte é contado em `overload_shed_total`.
+
+O log é do processo inteiro: no modo multi-tenant, os registros de cada
+mensagem são descartados enquanto qualquer um dos tenants estiver
+sobrecarregado.
+"""
+import logging
+import time
+import weakref
+from threading import Lock
+
+from gdgajubot import metrics
+
+# peso da última espera na média móvel exponencial
+EWMA_ALPHA = 0.2
+
+# segundos sem atualizações em que a espera média cai pela metade
+EWMA_HALF_LIFE = 5.0
+
+# limite de baldes antes de descartar os ociosos
+MAX_BUCKETS = 10000
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class OverloadController:
+    """
+    :param command_rate: comandos por segundo liberados para cada chat (0 desativa o limite)
+    :param command_burst: comandos seguidos aceitos de um chat antes do limite
+    :param queue_threshold: atualizações na fila a partir das quais o bot está sobrecarregado
+    :param latency_threshold: espera média na fila, em segundos, a partir da qual o bot está sobrecarregado
+    """
+
+    def __init__(self, command_rate=0, command_burst=5, queue_threshold=100, latency_threshold=2.0):
+        self.command_rate = command_rate
+        self.command_burst = command_burst
+        self.queue_threshold = queue_threshold
+        self.latency_threshold = latency_threshold
+        self.update_queue = None
+        self.wait = 0.0
+        self._wait_at = time.monotonic()
+        self._buckets = {}
+        self._lock = Lock()
+
+    def watch(self, update_queue):
+        """Acompanha o tamanho da fila e, se ela medir a espera, a espera média."""
+        self.update_queue = update_queue
+        if hasattr(update_queue, 'on_wait'):
+            update_queue.on_wait = self.record_wait
+
+    def filter_log(self, logger):
+        """Passa a descartar os registros informativos de `logger` durante a sobrecarga."""
+        # the tenants share the logger, so they share its filter too
+        for current in logger.filters:
+            if isinstance(current, OptionalLogFilter):
+                current.controllers.add(self)
+                return
+        logger.addFilter(OptionalLogFilter(self))
+
+    def record_wait(self, seconds, now=None):
+        now = now or time.monotonic()
+        wait = self.average_wait(now)
+        self.wait, self._wait_at = wait + EWMA_ALPHA * (seconds - wait), now
+
+    def average_wait(self, now=None):
+        """Espera média na fila, decaída pelo tempo desde a última atualização."""
+        elapsed = max(0.0, (now or time.monotonic()) - self._wait_at)
+        return self.wait * 0.5 ** (elapsed / EWMA_HALF_LIFE)
+
+    def overloaded(self):
+        if self.latency_threshold and self.average_wait() > self.latency_threshold:
+            return True
+        queue = self.update_queue
+        return bool(queue is not None and self.queue_threshold and queue.qsize() > self.queue_threshold)
+
+    def allow_command(self, chat_id, name, now=None):
+        """Gasta uma ficha do chat; retorna False se o comando deve ser descartado."""
+        if not self.command_rate:
+            return True
+
+        now = now or time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                if len(self._buckets) >= MAX_BUCKETS:
+                    self._prune(now)
+                bucket = self._buckets[chat_id] = TokenBucket(self.command_burst, now)
+            allowed = bucket.take(self.command_rate, self.command_burst, now)
+
+        if not allowed:
+            self.shed('command', name)
+            logging.debug("Comando %s descartado no chat %s: limite de comandos", name, chat_id)
+        return allowed
+
+    def _prune(self, now):
+        # a bucket idle long enough to be full again is the same as a new one
+        idle = self.command_burst / self.command_rate
+        for chat_id, bucket in list(self._buckets.items()):
+            if now - bucket.updated >= idle:
+                del self._buckets[chat_id]
+
+    def allow_optional(self, kind, name):
+        """Indica se um trabalho opcional pode ser feito agora."""
+        if self.overloaded():
+            self.shed(kind, name)
+            return False
+        return True
+
+    @staticmethod
+    def shed(kind, name):
+        metrics.inc('overload_shed_total', kind=kind, handler=name)
+
+
+class OptionalLogFilter(logging.Filter):
+    """Descarta os registros informativos de cada mensagem durante a sobrecarga de algum dos controles."""
+
+    def __init__(self, controller):
+        super().__init__()
+        # bots that are gone leave the set by themselves
+        self.controllers = weakref.WeakSet([controller])
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        return all(controller.allow_optional('log', record.name) for controller in list(self.controllers))
+
+
+metrics.registry.describe('overload_shed_total', 'Trabalho descartado pelo controle de sobrecarga')
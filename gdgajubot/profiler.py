@@ -0,0 +1,131 @@
+"""Profiler por amostragem, acionado sob demanda com o bot em produção.
+
+Enquanto ativo, uma thread amostra periodicamente a pilha das threads que
+estão executando um handler (segundo o `watchdog`), sem instrumentar o
+interpretador. Desligado, não tem custo algum.
+
+O resultado é um ranking das funções pelo tempo cumulativo e um arquivo com
+as pilhas no formato "collapsed" (uma pilha por linha, seguida da contagem),
+aceito por ferramentas de flame graph::
+
+    $ flamegraph.pl profile-20240101-120000.txt > profile.svg
+"""
+import os
+import sys
+import time
+from collections import Counter
+from threading import Lock, Thread, get_ident
+
+from gdgajubot import watchdog
+
+# intervalo padrão (em segundos) entre as amostras
+DEFAULT_INTERVAL = 0.005
+
+# duração máxima (em segundos) de uma sessão de profiling
+MAX_SECONDS = 300
+
+
+def frame_label(code):
+    return '%s:%d(%s)' % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+
+class SamplingProfiler:
+    """Amostra a pilha das threads de `threads()` a cada `interval` segundos.
+
+    :param threads: função que retorna os ids das threads a amostrar;
+        por padrão, as que executam handlers
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, threads=None):
+        self.interval = interval
+        self.threads = threads or watchdog.monitor.threads
+        self.stacks = Counter()
+        self.samples = 0
+        self.duration = 0.0
+
+    def sample(self, frames=None):
+        frames = sys._current_frames() if frames is None else frames
+        own = get_ident()
+        for thread_id in self.threads():
+            frame = frames.get(thread_id)
+            if frame is None or thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def run(self, seconds):
+        """Amostra durante `seconds` segundos, bloqueando a thread atual."""
+        start = time.monotonic()
+        deadline = start + seconds
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            self.sample()
+            time.sleep(min(self.interval, max(0.0, deadline - now)))
+        self.duration += time.monotonic() - start
+        return self
+
+    def top(self, n=15):
+        """Funções ordenadas pelo número de amostras em que aparecem (cumulativo).
+
+        Retorna tuplas (função, amostras cumulativas, amostras no topo da pilha).
+        """
+        cumulative, own = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            for label in set(stack):
+                cumulative[label] += count
+            own[stack[-1]] += count
+        ranking = sorted(cumulative.items(), key=lambda item: (-item[1], item[0]))
+        return [(label, count, own[label]) for label, count in ranking[:n]]
+
+    def format_top(self, n=15):
+        if not self.samples:
+            return 'Nenhuma amostra: nenhum handler executou durante o profiling.'
+        lines = ['%6s %6s  %s' % ('cum%', 'self%', 'função')]
+        for label, cumulative, own in self.top(n):
+            lines.append('%6.1f %6.1f  %s' % (100 * cumulative / self.samples, 100 * own / self.samples, label))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """Grava as pilhas no formato "collapsed"."""
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (';'.join(stack), count))
+        return path
+
+
+class ProfileSession:
+    """Executa uma sessão de profiling por vez, em segundo plano."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.running = False
+
+    def start(self, seconds, directory, callback, interval=DEFAULT_INTERVAL):
+        """Inicia o profiling e chama `callback(profiler, path)` ao final.
+
+        Retorna False se já houver uma sessão em andamento.
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+
+        def run():
+            try:
+                profiler = SamplingProfiler(interval).run(seconds)
+                path = os.path.join(directory, time.strftime('profile-%Y%m%d-%H%M%S.txt'))
+                callback(profiler, profiler.save(path))
+            finally:
+                self.running = False
+
+        Thread(target=run, name='Profiler', daemon=True).start()
+        return True
+
+
+session = ProfileSession()
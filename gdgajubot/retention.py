@@ -0,0 +1,183 @@
+"""Retenção das mensagens registradas: arquivamento e remoção das antigas.
+
+Cada chat guarda as mensagens por `retention_days` dias, ou pelo prazo dado
+a ele em `retention_chats`; 0 mantém as mensagens para sempre. As mensagens
+vencidas são gravadas em arquivos JSONL comprimidos, um por dia (UTC) de
+envio, em ``<archive_dir>/AAAA/MM/messages-AAAA-MM-DD.jsonl.gz``, e só
+então removidas do banco, em lotes, junto com as entradas delas no índice de
+busca. Os contadores de atividade são mantidos. No fim, os usuários sem
+mensagens (exceto os admins) são removidos. No SQLite, o espaço livre só é
+devolvido ao sistema com VACUUM, que reescreve o banco inteiro, depois de
+`compact_after` mensagens removidas desde o último.
+
+O chat de cada mensagem vem da própria mensagem; as registradas antes de o
+chat ser guardado seguem o prazo padrão.
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from threading import Lock, Thread
+
+from gdgajubot import metrics, util
+
+
+class RetentionPolicy:
+    """Prazo, em dias, das mensagens de cada chat; 0 mantém para sempre."""
+
+    def __init__(self, default_days=0, chats=None):
+        self.default_days = default_days
+        self.chats = dict(chats or {})
+
+    @property
+    def enabled(self):
+        return bool(self.default_days or any(self.chats.values()))
+
+    def days(self, chat_id):
+        return self.chats.get(chat_id, self.default_days)
+
+    def cutoff(self, chat_id, now):
+        """Mensagens do chat enviadas antes deste momento (UTC) estão vencidas; None se não vencem."""
+        days = self.days(chat_id)
+        return now - datetime.timedelta(days=days) if days else None
+
+    def latest_cutoff(self, now):
+        """O mais recente dos limites: nenhuma mensagem enviada depois dele está vencida."""
+        days = [d for d in [self.default_days] + list(self.chats.values()) if d]
+        return now - datetime.timedelta(days=min(days)) if days else None
+
+
+class Archive:
+    """Arquivos JSONL comprimidos com as mensagens removidas, um por dia de envio."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, day):
+        return os.path.join(self.directory, '%04d' % day.year, '%02d' % day.month,
+                            'messages-%s.jsonl.gz' % day.isoformat())
+
+    def write(self, messages):
+        """Acrescenta as mensagens aos arquivos dos seus dias, com os dados já no disco ao retornar."""
+        by_day = defaultdict(list)
+        for message in messages:
+            by_day[message.sent_at.date()].append(message)
+
+        for day, day_messages in sorted(by_day.items()):
+            path = self.path(day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # each call appends a gzip member; readers see a single stream
+            with open(path, 'ab') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as archive:
+                    for message in day_messages:
+                        archive.write(json.dumps(self.encode(message), ensure_ascii=False).encode('utf-8'))
+                        archive.write(b'\n')
+                raw.flush()
+                os.fsync(raw.fileno())
+        return sorted(by_day)
+
+    @staticmethod
+    def encode(message):
+        return dict(
+            id=message.id, chat_id=message.chat_id, user_id=message.user_id, username=message.username,
+            sent_at=message.sent_at.replace(tzinfo=datetime.timezone.utc).isoformat(), text=message.text,
+        )
+
+
+class Retention:
+    """
+    :param batch_size: mensagens lidas (e removidas) por transação
+    :param pause: espera, em segundos, entre os lotes, para não disputar o banco com o bot
+    :param compact_after: mensagens removidas, desde o último VACUUM, que disparam o próximo; 0 não compacta
+    """
+
+    def __init__(self, resources, policy, archive, batch_size=500, pause=0.5, compact_after=0):
+        self.resources = resources
+        self.policy = policy
+        self.archive = archive
+        self.batch_size = batch_size
+        self.pause = pause
+        self.compact_after = compact_after
+        # messages removed since the last VACUUM, counted from the start of the process
+        self.uncompacted = 0
+        self._lock = Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    def start(self, should_wait=None):
+        """Executa a retenção em segundo plano; False se já está em andamento ou desativada."""
+        if not self.policy.enabled or not self._lock.acquire(blocking=False):
+            return False
+
+        def run():
+            try:
+                self.run(should_wait=should_wait)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                self._lock.release()
+
+        Thread(target=run, name='Retention', daemon=True).start()
+        return True
+
+    def run(self, now=None, should_wait=None):
+        """Arquiva e remove as mensagens vencidas; `should_wait` adia os lotes enquanto retornar True.
+
+        Só as mensagens enviadas antes do mais recente dos limites são lidas,
+        e as que ainda estão no prazo do seu chat são relidas a cada execução.
+        """
+        now = now or datetime.datetime.utcnow()
+        report = util.AttributeDict(scanned=0, archived=0, users=0, compacted=False, elapsed=0.0)
+        latest = self.policy.latest_cutoff(now)
+        if latest is None:
+            return report
+
+        start, after = time.perf_counter(), 0
+        while True:
+            while should_wait is not None and should_wait():
+                time.sleep(self.pause)
+
+            batch = self.resources.retention_candidates(latest, after, self.batch_size)
+            if not batch:
+                break
+            after = batch[-1].id
+            expired = [m for m in batch if self.is_expired(m, now)]
+            if expired:
+                self.archive.write(expired)
+                self.resources.delete_messages([m.id for m in expired])
+
+            report.scanned += len(batch)
+            report.archived += len(expired)
+            metrics.inc('retention_messages_total', len(batch), result='scanned')
+            metrics.inc('retention_messages_total', len(expired), result='archived')
+            metrics.registry.set('retention_last_message_id', after)
+            time.sleep(self.pause)
+
+        if report.archived:
+            report.users = self.resources.prune_users()
+            metrics.inc('retention_users_deleted_total', report.users)
+            self.uncompacted += report.archived
+            if self.compact_after and self.uncompacted >= self.compact_after:
+                report.compacted = self.resources.compact()
+                self.uncompacted = 0
+
+        report.elapsed = time.perf_counter() - start
+        metrics.observe('retention_run_seconds', report.elapsed)
+        logging.info("Retenção: %(archived)d de %(scanned)d mensagens arquivadas, %(users)d usuários removidos "
+                     "em %(elapsed).1fs", report)
+        return report
+
+    def is_expired(self, message, now):
+        cutoff = self.policy.cutoff(message.chat_id, now)
+        return cutoff is not None and message.sent_at < cutoff
+
+
+metrics.registry.describe('retention_messages_total', 'Mensagens verificadas e arquivadas pela retenção')
+metrics.registry.describe('retention_users_deleted_total', 'Usuários sem mensagens removidos pela retenção')
+metrics.registry.describe('retention_last_message_id', 'Última mensagem verificada pela retenção em andamento')
+metrics.registry.describe('retention_run_seconds', 'Duração das execuções da retenção')
@@ -0,0 +1,53 @@
+"""Medição das fases da inicialização do bot.
+
+As fases são marcadas com `phase(nome)` ao longo da inicialização, com custo
+desprezível. Com `--startup_profile`, o tempo de cada fase é informado no log
+assim que o polling começa, e em todos os casos fica nas métricas como
+`startup_phase_seconds`.
+"""
+import contextlib
+import importlib
+import time
+
+from gdgajubot import metrics
+
+# dependências pesadas medidas uma a uma no modo de profiling
+HEAVY_MODULES = ('telegram', 'telegram.ext', 'pony.orm', 'beaker.cache')
+
+
+class StartupProfile:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases.append((name, elapsed))
+            metrics.registry.set('startup_phase_seconds', elapsed, phase=name)
+
+    def import_heavy_modules(self, modules=HEAVY_MODULES):
+        """Importa cada dependência pesada em uma fase própria."""
+        for name in modules:
+            with self.phase('import ' + name):
+                importlib.import_module(name)
+
+    def total(self):
+        return time.perf_counter() - self.origin
+
+    def report(self):
+        lines = ['%-28s %9s' % ('fase', 'ms')]
+        for name, elapsed in self.phases:
+            lines.append('%-28s %9.1f' % (name, elapsed * 1000))
+        lines.append('%-28s %9.1f' % ('total', self.total() * 1000))
+        return '\n'.join(lines)
+
+
+metrics.registry.describe('startup_phase_seconds', 'Duração de cada fase da inicialização')
+
+profile = StartupProfile()
+phase = profile.phase
@@ -0,0 +1,132 @@
+"""Vários bots (um por comunidade) em um único processo.
+
+O arquivo de tenants tem as configurações comuns na raiz e um bloco por
+comunidade em `tenants`; cada bloco aceita as mesmas chaves do arquivo de
+configuração (e pode apontar para um com `config_file`)::
+
+    database_url: postgres://...
+    metrics_port: 9100
+    tenants:
+      aracaju:
+        group_name: GDG-Aracaju
+        events_source: meetup
+        tokens: {telegram: '123:ABC', meetup: '...'}
+      maceio:
+        config_file: maceio.yml
+
+O banco de dados (e o pool de conexões), os caches dos serviços externos,
+o servidor de métricas, o watchdog e a retenção das mensagens são do processo. Os estados de cada
+comunidade ficam separados no banco, e as métricas dos handlers recebem o
+rótulo `tenant`. Cada comunidade tem o próprio journal de estados e, no modo
+webhook, a própria porta.
+"""
+import logging
+from collections import OrderedDict
+
+from gdgajubot import metrics, startup, util
+
+# chaves que valem para o processo inteiro, e não para cada comunidade
+PROCESS_KEYS = (
+    'database', 'database_url', 'metrics_port', 'retention_days', 'retention_chats', 'archive_dir', 'compact_after',
+)
+
+
+def load_tenants(tenants_file):
+    """Lê o arquivo de tenants e retorna (configuração do processo, configurações dos tenants)."""
+    reader = util.BotConfig(dev=False)
+    return parse_tenants(reader.read_config_file(tenants_file), reader)
+
+
+def parse_tenants(contents, reader=None):
+    reader = reader or util.BotConfig(dev=False)
+    contents = dict(contents)
+    tenants = contents.pop('tenants', None)
+    if not tenants:
+        raise ValueError("nenhum tenant configurado")
+
+    process = util.BotConfig(dev=False)
+    process.load_config(contents)
+
+    configs = []
+    for name, block in tenants.items():
+        block = dict(block or {})
+        shared = [key for key in PROCESS_KEYS if key in block]
+        if shared:
+            raise ValueError("tenant %s: %s vale para todo o processo" % (name, ', '.join(shared)))
+
+        tenant_contents = {k: v for k, v in contents.items() if k not in PROCESS_KEYS}
+        if 'config_file' in block:
+            tenant_contents.update(reader.read_config_file(block.pop('config_file')))
+        tenant_contents.update(block)
+
+        config = util.BotConfig(tenant=str(name), dev=False)
+        config.load_config(tenant_contents)
+        config.database = process.database
+        config.metrics_port = None
+        # the journal records don't say whose state they are, so a shared path gets one file per tenant
+        if config.state_journal and config.state_journal == contents.get('state_journal'):
+            config.state_journal = '%s.%s' % (config.state_journal, name)
+        if not config.telegram_token:
+            raise ValueError("tenant %s: falta o token do Telegram" % name)
+        if not config.events_source:
+            config.events_source = ['meetup'] if config.meetup_key else ['facebook']
+        configs.append(config)
+
+    # the tables are shared, so the retention runs once, in the first tenant
+    first = configs[0]
+    first.retention_days, first.retention_chats = process.retention_days, process.retention_chats
+    first.archive_dir, first.compact_after = process.archive_dir, process.compact_after
+
+    names = [config.tenant for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError("nomes de tenants repetidos: %s" % names)
+    check_unique(configs, 'state_journal', [c.state_journal for c in configs])
+    # port 0 picks a free port for each server
+    check_unique(configs, 'webhook_listen', [
+        c.webhook_listen if (c.webhook_url or c.cluster_id) and not c.webhook_listen.endswith(':0') else None
+        for c in configs
+    ])
+    return process, configs
+
+
+def check_unique(configs, key, values):
+    """Recusa dois tenants com o mesmo valor (exceto None) em `key`."""
+    seen = {}
+    for config, value in zip(configs, values):
+        if value is None:
+            continue
+        if value in seen:
+            raise ValueError("tenants %s e %s: o mesmo %s %s" % (seen[value], config.tenant, key, value))
+        seen[value] = config.tenant
+
+
+class TenantRuntime:
+    """Executa um `GDGAjuBot` por tenant, compartilhando os recursos do processo."""
+
+    def __init__(self, configs, metrics_port=None, bot_class=None):
+        if bot_class is None:
+            from gdgajubot.bot import GDGAjuBot as bot_class
+
+        self.metrics_port = metrics_port
+        self.bots = OrderedDict()
+        for config in configs:
+            with startup.phase('tenant ' + config.tenant):
+                self.bots[config.tenant] = bot_class(config)
+
+    @classmethod
+    def from_file(cls, tenants_file):
+        process, configs = load_tenants(tenants_file)
+        return cls(configs, metrics_port=process.metrics_port)
+
+    def start(self):
+        for name, g_bot in self.bots.items():
+            g_bot.start()
+            logging.info("Tenant %s iniciado", name)
+        if self.metrics_port:
+            metrics.MetricsServer(self.metrics_port).start()
+            logging.info("Métricas disponíveis em :%d/metrics", self.metrics_port)
+        logging.info("%d tenants em execução", len(self.bots))
+
+    def stop(self):
+        for g_bot in self.bots.values():
+            g_bot.updater.stop()
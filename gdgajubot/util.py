@@ -1,15 +1,14 @@
 import argparse
 import datetime
+import heapq
 import inspect
 import os
 import re
+import tempfile
 from collections import defaultdict
+from threading import RLock
 
-import requests
 from urllib import parse
-import yaml
-
-import dj_database_url
 
 DEFAULT_DATABASE = {
     'provider': 'sqlite',
@@ -17,6 +16,51 @@ DEFAULT_DATABASE = {
     'create_db': True,
 }
 
+# tempo limite (em segundos) das requisições aos serviços externos
+DEFAULT_UPSTREAM_TIMEOUT = 10
+
+# duração (em segundos) a partir da qual uma chamada de handler é denunciada como lenta
+DEFAULT_WATCHDOG_THRESHOLD = 10
+
+# recebimento por webhook: porta padrão (ou a variável PORT), threads e tamanho máximo das requisições
+DEFAULT_WEBHOOK_PORT = 8443
+DEFAULT_WEBHOOK_WORKERS = 4
+DEFAULT_WEBHOOK_MAX_BODY = 1024 * 1024
+
+# idade máxima (em segundos) de um comando pendente para ainda ser respondido na retomada
+DEFAULT_CATCH_UP_MAX_AGE = 120
+
+# limite de comandos por chat: fichas devolvidas por segundo e comandos seguidos aceitos
+DEFAULT_FLOOD_RATE = 0
+DEFAULT_FLOOD_BURST = 5
+
+# sobrecarga: atualizações na fila do dispatcher e espera média (em segundos) nela
+DEFAULT_OVERLOAD_QUEUE = 100
+DEFAULT_OVERLOAD_LATENCY = 2
+
+# avisos (/broadcast): mensagens por segundo, no total, e envios simultâneos
+DEFAULT_BROADCAST_RATE = 25
+DEFAULT_BROADCAST_CONCURRENCY = 8
+
+# tempo máximo (em segundos) de uma busca com /search antes de responder com resultados parciais
+DEFAULT_SEARCH_BUDGET = 1
+
+# retenção: dias que as mensagens ficam no banco (0 mantém para sempre) e diretório dos arquivos
+DEFAULT_RETENTION_DAYS = 0
+DEFAULT_ARCHIVE_DIR = 'archive'
+# mensagens removidas pela retenção antes de um VACUUM no SQLite (0 não compacta)
+DEFAULT_COMPACT_AFTER = 0
+
+# validade (em segundos) das concessões dos workers no cluster
+DEFAULT_CLUSTER_LEASE = 30
+
+# janela (em segundos) para distribuir as verificações pendentes na inicialização
+DEFAULT_WARMUP_WINDOW = 300
+
+# dias sem atividade para os estados de um chat saírem da memória,
+# por tipo de estado ('default' vale para os tipos não listados)
+DEFAULT_STALE_DAYS = {'default': 1}
+
 
 class BotConfig:
     def __init__(
@@ -30,6 +74,42 @@ class BotConfig:
         events_source=None,
         dev=True,
         config_file=None,
+        warmup_window=None,
+        stale_days=None,
+        state_journal=None,
+        journal_fsync=None,
+        capture=None,
+        capture_anonymize=False,
+        telegram_base_url=None,
+        upstream_base_url=None,
+        upstream_timeout=None,
+        metrics_port=None,
+        watchdog_threshold=None,
+        profile_dir=None,
+        startup_profile=False,
+        webhook_url=None,
+        webhook_listen=None,
+        webhook_secret=None,
+        webhook_workers=None,
+        webhook_max_body=None,
+        catch_up=False,
+        catch_up_max_age=None,
+        flood_rate=None,
+        flood_burst=None,
+        overload_queue=None,
+        overload_latency=None,
+        tenant=None,
+        tenants=None,
+        cluster_id=None,
+        cluster_url=None,
+        cluster_lease=None,
+        broadcast_rate=None,
+        broadcast_concurrency=None,
+        search_budget=None,
+        retention_days=None,
+        retention_chats=None,
+        archive_dir=None,
+        compact_after=None,
     ):
         self.telegram_token = telegram_token
         self.meetup_key = meetup_key
@@ -41,6 +121,49 @@ class BotConfig:
         self.debug_mode = dev
         self.links = None
         self.custom_responses = None
+        self.warmup_window = int(warmup_window) if warmup_window else DEFAULT_WARMUP_WINDOW
+        self.state_journal = state_journal or None
+        self.journal_fsync = journal_fsync or 'interval'
+        self.telegram_base_url = telegram_base_url or None
+        self.upstream_base_url = upstream_base_url or None
+        self.upstream_timeout = float(upstream_timeout) if upstream_timeout else DEFAULT_UPSTREAM_TIMEOUT
+        self.upstreams = None
+        self.metrics_port = int(metrics_port) if metrics_port else None
+        # 0 disables the watchdog, so only a missing value takes the default
+        self.watchdog_threshold = (float(watchdog_threshold) if watchdog_threshold not in (None, '')
+                                   else DEFAULT_WATCHDOG_THRESHOLD)
+        self.profile_dir = profile_dir or tempfile.gettempdir()
+        self.startup_profile = bool(startup_profile)
+        self.webhook_url = webhook_url or None
+        self.webhook_listen = webhook_listen or '0.0.0.0:%s' % os.environ.get('PORT', DEFAULT_WEBHOOK_PORT)
+        self.webhook_secret = webhook_secret or None
+        self.webhook_workers = int(webhook_workers) if webhook_workers else DEFAULT_WEBHOOK_WORKERS
+        self.webhook_max_body = int(webhook_max_body) if webhook_max_body else DEFAULT_WEBHOOK_MAX_BODY
+        self.catch_up = bool(catch_up)
+        self.catch_up_max_age = int(catch_up_max_age) if catch_up_max_age else DEFAULT_CATCH_UP_MAX_AGE
+        # 0 disables each of these limits
+        self.flood_rate = float(flood_rate) if flood_rate not in (None, '') else DEFAULT_FLOOD_RATE
+        self.flood_burst = int(flood_burst) if flood_burst else DEFAULT_FLOOD_BURST
+        self.overload_queue = int(overload_queue) if overload_queue not in (None, '') else DEFAULT_OVERLOAD_QUEUE
+        self.overload_latency = (float(overload_latency) if overload_latency not in (None, '')
+                                 else DEFAULT_OVERLOAD_LATENCY)
+        # name of the community in multi-tenant mode, and the file with all of them
+        self.tenant = tenant or None
+        self.tenants_file = tenants or None
+        self.cluster_id = cluster_id or None
+        self.cluster_url = cluster_url or None
+        self.cluster_lease = float(cluster_lease) if cluster_lease else DEFAULT_CLUSTER_LEASE
+        self.broadcast_rate = float(broadcast_rate) if broadcast_rate else DEFAULT_BROADCAST_RATE
+        self.broadcast_concurrency = (int(broadcast_concurrency) if broadcast_concurrency
+                                      else DEFAULT_BROADCAST_CONCURRENCY)
+        self.search_budget = float(search_budget) if search_budget else DEFAULT_SEARCH_BUDGET
+        self.retention_days = float(retention_days) if retention_days else DEFAULT_RETENTION_DAYS
+        self.retention_chats = self.parse_retention_chats(retention_chats) if retention_chats else {}
+        self.archive_dir = archive_dir or DEFAULT_ARCHIVE_DIR
+        self.compact_after = int(compact_after) if compact_after else DEFAULT_COMPACT_AFTER
+        self.capture_file = capture or None
+        self.capture_anonymize = bool(capture_anonymize)
+        self.stale_days = dict(DEFAULT_STALE_DAYS, default=float(stale_days)) if stale_days else DEFAULT_STALE_DAYS
         self.database = (
             self.parse_database_url(database_url)
             if database_url else DEFAULT_DATABASE
@@ -49,23 +172,98 @@ class BotConfig:
             self.load_config_file(config_file)
 
     def load_config_file(self, config_file):
+        self.load_config(self.read_config_file(config_file))
+
+    def read_config_file(self, config_file):
+        import yaml
+
         stream = self.open_file_or_url(config_file)
-        contents = yaml.load(stream)
+        return yaml.load(stream)
+
+    def load_config(self, contents):
         self.debug_mode = contents.get('debug_mode', None)
         self.events_source = contents.get('events_source', None)
+        if isinstance(self.events_source, str):
+            self.events_source = self.events_source.split(',')
         self.links = contents.get('links', ())
         self.custom_responses = contents.get('custom_responses', None)
+        if 'group_name' in contents:
+            group_name = contents['group_name']
+            self.group_name = group_name.split(',') if isinstance(group_name, str) else list(group_name)
+        if 'telegram_base_url' in contents:
+            self.telegram_base_url = contents['telegram_base_url']
+        if 'upstream_base_url' in contents:
+            self.upstream_base_url = contents['upstream_base_url']
+        if 'upstream_timeout' in contents:
+            self.upstream_timeout = float(contents['upstream_timeout'])
+        self.upstreams = contents.get('upstreams', None)
+        if 'metrics_port' in contents:
+            self.metrics_port = int(contents['metrics_port'])
+        if 'watchdog_threshold' in contents:
+            self.watchdog_threshold = float(contents['watchdog_threshold'])
+        for key in ('webhook_url', 'webhook_listen', 'webhook_secret'):
+            if key in contents:
+                setattr(self, key, contents[key])
+        if 'webhook_workers' in contents:
+            self.webhook_workers = int(contents['webhook_workers'])
+        if 'webhook_max_body' in contents:
+            self.webhook_max_body = int(contents['webhook_max_body'])
+        if 'catch_up' in contents:
+            self.catch_up = bool(contents['catch_up'])
+        if 'catch_up_max_age' in contents:
+            self.catch_up_max_age = int(contents['catch_up_max_age'])
+        for key, parse in (('flood_rate', float), ('flood_burst', int),
+                           ('overload_queue', int), ('overload_latency', float)):
+            if key in contents:
+                setattr(self, key, parse(contents[key]))
+        for key in ('cluster_id', 'cluster_url'):
+            if key in contents:
+                setattr(self, key, contents[key])
+        if 'cluster_lease' in contents:
+            self.cluster_lease = float(contents['cluster_lease'])
+        if 'broadcast_rate' in contents:
+            self.broadcast_rate = float(contents['broadcast_rate'])
+        if 'broadcast_concurrency' in contents:
+            self.broadcast_concurrency = int(contents['broadcast_concurrency'])
+        if 'search_budget' in contents:
+            self.search_budget = float(contents['search_budget'])
+        if 'retention_days' in contents:
+            self.retention_days = float(contents['retention_days'] or 0)
+        if 'retention_chats' in contents:
+            self.retention_chats = self.parse_retention_chats(contents['retention_chats'])
+        if 'archive_dir' in contents:
+            self.archive_dir = contents['archive_dir']
+        if 'compact_after' in contents:
+            self.compact_after = int(contents['compact_after'] or 0)
+        if 'profile_dir' in contents:
+            self.profile_dir = contents['profile_dir']
         if 'tokens' in contents:
             self.telegram_token = contents['tokens'].get('telegram', None)
             self.meetup_key = contents['tokens'].get('meetup', None)
             self.facebook_key = contents['tokens'].get('facebook', None)
+        if 'warmup_window' in contents:
+            self.warmup_window = int(contents['warmup_window'])
+        if 'stale_days' in contents:
+            self.stale_days = dict(DEFAULT_STALE_DAYS, **contents['stale_days'])
+        if 'state_journal' in contents:
+            self.state_journal = contents['state_journal']
+        if 'journal_fsync' in contents:
+            self.journal_fsync = contents['journal_fsync']
         if 'database' in contents:
             self.database = contents['database']
         if 'database_url' in contents:
             self.database = self.parse_database_url(contents['database_url'])
 
+    @staticmethod
+    def parse_retention_chats(value):
+        """Prazos por chat, de um mapeamento ou do texto `chat=dias,chat=dias`."""
+        if isinstance(value, str):
+            value = dict(item.split('=', 1) for item in value.split(',') if item.strip())
+        return {int(chat_id): float(days) for chat_id, days in value.items()}
+
     def open_file_or_url(self, file_or_url):
         if bool(parse.urlparse(file_or_url).netloc):
+            import requests
             return requests.get(file_or_url).text
         else:
             with open(file_or_url, 'r') as config_file:
@@ -89,6 +287,8 @@ class BotConfig:
                 'filename': database_dict['PATH'],
             }
 
+        import dj_database_url
+
         try:
             dj_engine_to_pony_provider = {
                 'django.db.backends.postgresql_psycopg2': parse_postgres,
@@ -165,11 +365,29 @@ class MissingDict(defaultdict):
 
 
 class StateDict(dict):
-    def __init__(self, data, dump_function):
+    def __init__(self, data, dump_function, journal_function=None):
         super().__init__()
         self.dump_function = dump_function
         self.update(data)
         self.contexts = 0
+        self.journal_function = journal_function
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if self.journal_function and key != '__memory__':
+            self.journal_function(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if self.journal_function:
+            self.journal_function(key, deleted=True)
+
+    def pop(self, key, *default):
+        has_key = key in self
+        value = super().pop(key, *default)
+        if has_key and self.journal_function:
+            self.journal_function(key, deleted=True)
+        return value
 
     def __enter__(self):
         self.contexts += 1
@@ -184,6 +402,139 @@ class StateDict(dict):
         self.dump_function(self)
 
 
+class ChatSchedule:
+    """Agenda de horários por chat mantida em um único heap.
+
+    Cada chat possui no máximo um horário válido. Ao reagendar, a entrada
+    antiga permanece no heap e é descartada quando chega ao topo.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._next = {}
+        self._lock = RLock()
+
+    def schedule(self, chat_id, when):
+        """Agenda (ou reagenda) o chat para o timestamp `when`."""
+        with self._lock:
+            self._next[chat_id] = when
+            heapq.heappush(self._heap, (when, chat_id))
+
+            # evita que entradas obsoletas se acumulem indefinidamente
+            if len(self._heap) > 2 * len(self._next) + 64:
+                self._heap = [(t, c) for c, t in self._next.items()]
+                heapq.heapify(self._heap)
+
+    def unschedule(self, chat_id):
+        with self._lock:
+            self._next.pop(chat_id, None)
+
+    def next_time(self, chat_id):
+        return self._next.get(chat_id)
+
+    def pop_due(self, now):
+        """Remove da agenda e retorna os chats com horário até `now`."""
+        due = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                when, chat_id = heapq.heappop(heap)
+                if self._next.get(chat_id) == when:
+                    del self._next[chat_id]
+                    due.append(chat_id)
+        return due
+
+    def __contains__(self, chat_id):
+        return chat_id in self._next
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._next))
+
+    def __len__(self):
+        return len(self._next)
+
+
+class ActivityIndex:
+    """Índice ordenado pelo horário da última atividade de cada chat.
+
+    Registrar uma atividade custa O(log n). Encontrar os chats inativos desde
+    um horário custa proporcionalmente à quantidade de chats encontrados, e
+    não ao total de chats.
+    """
+
+    # atividades mais próximas que isso (em segundos) não reordenam o índice
+    RESOLUTION = 60
+
+    def __init__(self):
+        # min-heap of (when, chat_id); entries that no longer match `_last` are
+        # stale and dropped lazily
+        self._heap = []
+        self._last = {}
+        self._lock = RLock()
+
+    def touch(self, chat_id, when):
+        """Registra atividade do chat no timestamp `when`."""
+        last = self._last.get(chat_id)
+        if last is not None and when - last < self.RESOLUTION:
+            return
+
+        with self._lock:
+            last = self._last.get(chat_id)
+            if last is not None:
+                if when <= last:
+                    return
+            self._last[chat_id] = when
+            heapq.heappush(self._heap, (when, chat_id))
+            self._compact()
+
+    def add(self, chat_id, when=0):
+        """Indexa o chat apenas se ainda não estiver no índice."""
+        if chat_id not in self._last:
+            self.touch(chat_id, when)
+
+    def discard(self, chat_id):
+        with self._lock:
+            if self._last.pop(chat_id, None) is not None:
+                self._compact()
+
+    def older_than(self, cutoff):
+        """Retorna os chats sem atividade após o timestamp `cutoff`, do mais antigo ao mais recente."""
+        with self._lock:
+            heap = self._heap
+            while heap and not self._current(heap[0]):
+                heapq.heappop(heap)
+
+            # walks only the subtrees whose root is old enough
+            found, pending = [], [0]
+            while pending:
+                i = pending.pop()
+                if i < len(heap) and heap[i][0] <= cutoff:
+                    if self._current(heap[i]):
+                        found.append(heap[i])
+                    pending += (2 * i + 1, 2 * i + 2)
+            return [chat_id for _, chat_id in sorted(found)]
+
+    def last_activity(self, chat_id):
+        return self._last.get(chat_id)
+
+    def _current(self, entry):
+        when, chat_id = entry
+        return self._last.get(chat_id) == when
+
+    def _compact(self):
+        # rebuilding once stale entries are the majority keeps it amortized O(1)
+        if len(self._heap) > 2 * len(self._last) + 64:
+            self._heap = [(when, chat_id) for chat_id, when in self._last.items()]
+            heapq.heapify(self._heap)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._last
+
+    def __len__(self):
+        return len(self._last)
+
+
 class AttributeDict(dict):
     __getattr__ = dict.__getitem__
     __setattr__ = dict.__setitem__
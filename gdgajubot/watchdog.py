@@ -0,0 +1,171 @@
+"""Vigia das chamadas de handlers que demoram demais.
+
+Cada chamada de comando, mensagem ou tarefa é registrada enquanto executa.
+Uma thread verifica periodicamente as chamadas em andamento e, quando uma
+passa do limite, registra no log o handler, o chat e a pilha atual da thread
+presa, sem precisar de um depurador.
+"""
+import functools
+import itertools
+import logging
+import sys
+import time
+import traceback
+from threading import Event, Lock, Thread, current_thread, local
+
+from gdgajubot import metrics
+
+# limite padrão (em segundos) para uma chamada ser considerada lenta
+DEFAULT_THRESHOLD = 10.0
+
+# quadros da pilha incluídos no log
+STACK_LIMIT = 30
+
+
+class Invocation:
+    __slots__ = ('kind', 'handler', 'chat_id', 'thread_id', 'thread_name', 'start', 'reports', 'outer')
+
+    def __init__(self, kind, handler, chat_id, thread, start):
+        self.kind = kind
+        self.handler = handler
+        self.chat_id = chat_id
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.start = start
+        self.reports = 0
+        self.outer = None
+
+    def elapsed(self, now=None):
+        return (now or time.monotonic()) - self.start
+
+
+class Watchdog:
+    """Acompanha as chamadas em andamento e denuncia as que passam de `threshold` segundos.
+
+    Uma chamada presa é denunciada de novo a cada `threshold` segundos, com uma
+    nova amostra da pilha, mas contada uma única vez em `slow_handlers_total`.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, registry=metrics.registry):
+        self.threshold = threshold
+        self.registry = registry
+        self.inflight = {}
+        self._ids = itertools.count()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+        self._local = local()
+
+    def guard(self, kind, name, func):
+        """Envolve um handler para registrá-lo enquanto estiver em execução."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = self.enter(kind, name, _chat_id(args))
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.leave(token)
+
+        return wrapper
+
+    def enter(self, kind, name, chat_id=None):
+        token = next(self._ids)
+        invocation = Invocation(kind, name, chat_id, current_thread(), time.monotonic())
+        invocation.outer = getattr(self._local, 'invocation', None)
+        self._local.invocation = invocation
+        with self._lock:
+            self.inflight[token] = invocation
+        return token
+
+    def leave(self, token):
+        with self._lock:
+            invocation = self.inflight.pop(token, None)
+        if invocation is None:
+            return
+        self._local.invocation = invocation.outer
+        if invocation.reports:
+            logging.warning("Handler %s:%s terminou após %.1fs", invocation.kind, invocation.handler,
+                            invocation.elapsed())
+
+    def current(self):
+        """Chamada em execução na thread atual, se houver."""
+        return getattr(self._local, 'invocation', None)
+
+    def threads(self):
+        """Ids das threads que estão executando algum handler."""
+        with self._lock:
+            return {invocation.thread_id for invocation in self.inflight.values()}
+
+    def check(self, now=None):
+        """Denuncia as chamadas lentas; retorna a lista de denúncias feitas."""
+        now = now or time.monotonic()
+        with self._lock:
+            slow = [
+                invocation for invocation in self.inflight.values()
+                if invocation.elapsed(now) >= self.threshold * (invocation.reports + 1)
+            ]
+            in_flight = len(self.inflight)
+        self.registry.set('handlers_in_flight', in_flight)
+
+        if not slow:
+            return []
+
+        frames = sys._current_frames()
+        reports = []
+        for invocation in slow:
+            frame = frames.get(invocation.thread_id)
+            stack = ''.join(traceback.format_stack(frame, limit=STACK_LIMIT)) if frame else '(thread terminada)\n'
+            if not invocation.reports:
+                self.registry.inc('slow_handlers_total', kind=invocation.kind, handler=invocation.handler)
+            invocation.reports += 1
+
+            report = dict(kind=invocation.kind, handler=invocation.handler, chat_id=invocation.chat_id,
+                          thread=invocation.thread_name, elapsed=invocation.elapsed(now), stack=stack)
+            logging.warning(
+                "Handler %s:%s lento no chat %s: %.1fs em execução na thread %s\n%s",
+                report['kind'], report['handler'], report['chat_id'], report['elapsed'], report['thread'],
+                stack.rstrip(),
+            )
+            reports.append(report)
+        return reports
+
+    def start(self, interval=None):
+        """Inicia a thread de verificação."""
+        if self._thread is not None:
+            return self
+        interval = interval or max(0.1, min(1.0, self.threshold / 4))
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.check()
+                except Exception as e:
+                    logging.exception(e)
+
+        self._thread = Thread(target=run, name='Watchdog', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def _chat_id(args):
+    # handlers receive a telegram.Message; tasks receive nothing
+    for arg in args:
+        chat_id = getattr(arg, 'chat_id', None)
+        if chat_id is not None:
+            return chat_id
+    return None
+
+
+# vigia padrão do processo
+monitor = Watchdog()
+metrics.registry.describe('slow_handlers_total', 'Chamadas de handlers que passaram do limite do vigia')
+metrics.registry.describe('handlers_in_flight', 'Chamadas de handlers em andamento')
+
+guard = monitor.guard
@@ -0,0 +1,180 @@
+"""Recebimento de atualizações por webhook, com um servidor HTTP próprio.
+
+O Telegram envia cada atualização por POST para a URL registrada, que termina
+com o segredo. O servidor confere o segredo (no caminho da URL ou, nas
+atualizações repassadas pelos workers do cluster, no cabeçalho
+`X-Telegram-Bot-Api-Secret-Token`), limita o tamanho do corpo e entrega a
+atualização na fila do `Dispatcher`, respondendo sem esperar os handlers.
+
+O segredo não é registrado no Telegram como `secret_token`: o
+python-telegram-bot 10 não tem esse parâmetro no `set_webhook`.
+
+A fila do dispatcher registra, nos dois modos (polling e webhook), o tempo de
+espera de cada atualização (`update_queue_wait_seconds`) e a idade dela ao
+ser processada (`update_age_seconds`), para comparar as latências.
+"""
+import hmac
+import json
+import logging
+import queue
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+import telegram
+
+from gdgajubot import metrics
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# marca as atualizações repassadas por outro worker do cluster
+FORWARDED_HEADER = 'X-GDGAjuBot-Forwarded'
+
+
+class TimedQueue(queue.Queue):
+    """Fila que mede quanto cada atualização esperou para ser processada."""
+
+    def __init__(self, maxsize=0, source='polling', **labels):
+        super().__init__(maxsize)
+        self.source = source
+        self.labels = dict(labels, source=source)
+        # called with each wait, e.g. by the overload controller
+        self.on_wait = None
+
+    def _put(self, item):
+        super()._put((time.perf_counter(), item))
+
+    def _get(self):
+        put_at, item = super()._get()
+        wait = time.perf_counter() - put_at
+        metrics.observe('update_queue_wait_seconds', wait, **self.labels)
+        if self.on_wait is not None:
+            self.on_wait(wait)
+        if isinstance(item, telegram.Update):
+            message = item.effective_message
+            if message is not None and message.date is not None:
+                metrics.observe('update_age_seconds', max(0.0, time.time() - message.date.timestamp()),
+                                **self.labels)
+        return item
+
+
+def install_timed_queue(updater, source, **labels):
+    """Substitui a fila de atualizações; deve ser chamado antes do início do updater."""
+    update_queue = TimedQueue(source=source, **labels)
+    updater.update_queue = updater.dispatcher.update_queue = update_queue
+    return update_queue
+
+
+class _PooledHTTPServer(HTTPServer):
+    """Servidor HTTP que atende as requisições em um número fixo de threads."""
+
+    def __init__(self, address, handler, workers):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='webhook')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class WebhookServer:
+    """Recebe as atualizações do Telegram e as entrega em `update_queue`.
+
+    :param secret: segredo aceito como caminho da URL (``/<secret>``) ou no
+        cabeçalho `X-Telegram-Bot-Api-Secret-Token`
+    :param workers: threads que atendem as requisições
+    :param max_body: tamanho máximo, em bytes, do corpo de uma requisição
+    :param router: se informado, recebe as atualizações vindas do Telegram no
+        lugar de `update_queue` (as repassadas por outro worker vão para a fila)
+    """
+
+    def __init__(self, bot, update_queue, secret, host='0.0.0.0', port=0, workers=4, max_body=1024 * 1024,
+                 router=None):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.router = router
+        self.secret = secret
+        self.max_body = max_body
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                status = server.receive(self)
+                metrics.inc('webhook_requests_total', status=status)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug("WebhookServer: " + format, *args)
+
+        self.httpd = _PooledHTTPServer((host, port), Handler, workers)
+        self._thread = None
+
+    @property
+    def path(self):
+        return '/' + self.secret
+
+    def authorized(self, path, headers):
+        # compare_digest refuses non-ASCII str, which any client can send
+        token = headers.get(SECRET_HEADER)
+        if token is not None:
+            return hmac.compare_digest(token.encode(), self.secret.encode())
+        return hmac.compare_digest(path.split('?')[0].encode(), self.path.encode())
+
+    def receive(self, request):
+        """Valida a requisição e enfileira a atualização; retorna o status HTTP."""
+        if not self.authorized(request.path, request.headers):
+            return 403
+
+        try:
+            length = int(request.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            return 411
+        if length > self.max_body:
+            return 413
+
+        try:
+            data = json.loads(request.rfile.read(length).decode('utf-8'))
+            update = telegram.Update.de_json(data, self.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning("Webhook: atualização inválida: %s", e)
+            return 400
+
+        if self.router is None or request.headers.get(FORWARDED_HEADER):
+            self.update_queue.put(update)
+        else:
+            self.router(update)
+        return 200
+
+    def start(self):
+        # not a daemon thread: it keeps the process alive, as the polling does
+        self._thread = Thread(target=self.httpd.serve_forever, name='WebhookServer')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def new_secret():
+    return secrets.token_urlsafe(32)
+
+
+metrics.registry.describe('update_queue_wait_seconds', 'Espera das atualizações na fila do dispatcher')
+metrics.registry.describe('update_age_seconds', 'Idade das atualizações ao serem processadas')
+metrics.registry.describe('webhook_requests_total', 'Requisições recebidas pelo webhook, por status')
@@ -31,9 +31,10 @@ setup(
     entry_points={
         'console_scripts': [
             'gdgajubot = gdgajubot.__main__:main',
+            'gdgajubot-data = gdgajubot.data.transfer:main',
         ],
     },
-    packages=['gdgajubot', 'gdgajubot.data'],
+    packages=['gdgajubot', 'gdgajubot.data', 'gdgajubot.fakes'],
     install_requires=requirements,
     classifiers=[
         "Programming Language :: Python :: 3.6",
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 import unittest
 import os
+import functools
+import tempfile
 from collections import defaultdict
 from datetime import datetime
 from unittest import mock
 
 from gdgajubot import bot, util
+from gdgajubot.data.chats import ChatRegistry
+from gdgajubot.data.journal import StateJournal
 from gdgajubot.bot import GDGAjuBot, ALREADY_ANSWERED_TEXTS
 
 AJU_TZ = util.AJU_TZ
@@ -26,6 +30,7 @@ class MockResources(mock.NonCallableMock):
             'get_events.side_effect': lambda n: self.EVENTS[:n],
             'get_packt_free_book.return_value': self.BOOK,
             'get_short_url.side_effect': lambda url: url,
+            'list_groups.return_value': (),
             'load_states.return_value': defaultdict(
                 lambda: defaultdict(
                     lambda: util.StateDict({}, mock.call)
@@ -68,6 +73,23 @@ class MockResources(mock.NonCallableMock):
     )
 
 
+@functools.lru_cache()
+def sqlite_resources():
+    """Resources real com banco em memória, único: o Pony só permite um bind por processo."""
+    from gdgajubot.data.resources import Resources
+
+    config = util.BotConfig(meetup_key='key', group_name='GDG-Aracaju', events_source='meetup')
+    config.database = {'provider': 'sqlite', 'filename': ':memory:'}
+    return Resources(config)
+
+
+def index_messages(resources):
+    """Indexa as mensagens novas; cada chamada vai só até a mais recente vista na anterior."""
+    for _ in range(2):
+        while resources.index_messages():
+            pass
+
+
 class TestGDGAjuBot(unittest.TestCase):
     config = util.BotConfig(group_name='Test-Bot')
 
@@ -217,3 +239,1090 @@ class TestGDGAjuBot(unittest.TestCase):
                                             reply_to_message_id=82)
         the_answer = bot.send_message.call_args[0][1]
         assert the_answer[2:] in ALREADY_ANSWERED_TEXTS
+
+    def test_daily_book_sweep(self):
+        bot, resources = MockTeleBot(), MockResources()
+        message = MockMessage(chat_id=-0xB00C)
+        g_bot = GDGAjuBot(self.config, bot, resources)
+        ts = resources.BOOK.expires
+        now = datetime.fromtimestamp(ts - 10*3600, tz=AJU_TZ)
+
+        # Mensagens apenas contam e agendam o chat uma única vez
+        g_bot.ensure_daily_book(message)
+        g_bot.ensure_daily_book(message)
+        state = g_bot.get_state('daily_book', message.chat_id)
+        assert state['messages_since'] == 2
+        assert len(g_bot.book_schedule) == 1
+
+        # Nada pendente antes do horário agendado
+        stats = g_bot.daily_book_sweep(now=datetime.fromtimestamp(0, tz=AJU_TZ))
+        assert stats == dict(due=0, sent=0, deferred=0)
+
+        # Primeira verificação apenas marca o horário
+        stats = g_bot.daily_book_sweep(now=now)
+        assert stats == dict(due=1, sent=0, deferred=1)
+        assert state['last_time'] == now
+        bot.send_photo.assert_not_called()
+
+        # Um dia depois o livro é enviado
+        state['last_time'] = datetime.fromtimestamp(ts - 40*3600, tz=AJU_TZ)
+        g_bot.book_schedule.schedule(message.chat_id, now.timestamp())
+        stats = g_bot.daily_book_sweep(now=now)
+        assert stats == dict(due=1, sent=1, deferred=0)
+        bot.send_photo.assert_called_with(message.chat_id, photo='//test.jpg', parse_mode="Markdown",
+                                          disable_web_page_preview=True)
+        assert state['messages_since'] == 0
+        assert message.chat_id in g_bot.book_schedule
+
+    def test_warm_up_resumes_daily_book_schedules(self):
+        bot, resources = MockTeleBot(), MockResources()
+        g_bot = GDGAjuBot(self.config, bot, resources)
+        now = datetime.now(tz=AJU_TZ)
+        later = datetime.fromtimestamp(now.timestamp() + 7200, tz=AJU_TZ)
+
+        for chat_id in range(1, 11):
+            g_bot.states['chat_stats'][chat_id]['last_activity'] = now
+            g_bot.states['daily_book'][chat_id]['messages_since'] = 0
+        g_bot.states['daily_book'][1]['next_check'] = later
+
+        g_bot.warm_up()
+
+        # O horário persistido é retomado, os pendentes são distribuídos na janela
+        assert len(g_bot.book_schedule) == 10
+        assert g_bot.book_schedule.next_time(1) == later.timestamp()
+        for chat_id in range(2, 11):
+            when = g_bot.book_schedule.next_time(chat_id)
+            assert now.timestamp() <= when <= now.timestamp() + self.config.warmup_window + 1
+            assert abs(g_bot.states['daily_book'][chat_id]['next_check'].timestamp() - when) < 1e-3
+
+    def test_chat_registry(self):
+        bot, resources = MockTeleBot(), MockResources()
+        g_bot = GDGAjuBot(self.config, bot, resources)
+        chat = MockMessage(id=-0xCAFE, username='gdgaju', title='GDG Aracaju', type='supergroup')
+
+        # Estado de um chat desconhecido não consulta o Telegram
+        state = g_bot.get_state('chat_stats', chat.id)
+        assert 'chat' not in state
+        bot.get_chat.assert_not_called()
+
+        # Chats desconhecidos são consultados em lote no segundo plano
+        bot.get_chat.return_value = chat
+        g_bot.refresh_chats()
+        bot.get_chat.assert_called_once_with(chat.id)
+        resources.update_groups.assert_called_once_with({chat.id: 'gdgaju'})
+        assert g_bot.chats.chat_type(chat.id) == 'supergroup'
+
+        # Chats observados são servidos da memória
+        registry = ChatRegistry(resources)
+        registry.observe(chat)
+        assert registry.username(chat.id) == 'gdgaju'
+        assert registry.refresh(bot.get_chat) == 0
+
+    def test_chat_registry_flush(self):
+        import telegram
+        from gdgajubot.data.database import Group
+        from pony import orm
+
+        resources = sqlite_resources()
+        registry = ChatRegistry(resources)
+        registry.observe(telegram.Chat(-0xBEEF, 'group', title='Grupo sem username'))
+        registry.observe(telegram.Chat(0xBEEF, 'private', first_name='Fulano'))
+
+        # o grupo sem username é gravado, e o chat privado fica só na memória
+        assert registry.flush() == 1
+        with orm.db_session:
+            assert Group[-0xBEEF].telegram_groupname == ''
+            assert not Group.exists(telegram_id=0xBEEF)
+        assert registry.chat_type(0xBEEF) == 'private'
+
+        # se a gravação falha, o grupo fica para a próxima vez
+        registry.observe(telegram.Chat(-0xBEEF, 'group', title='Grupo renomeado'))
+        with mock.patch.object(resources, 'update_groups', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                registry.flush()
+        assert registry.flush() == 1
+
+    def test_clear_stale_states(self):
+        bot, resources = MockTeleBot(), MockResources()
+        config = util.BotConfig(group_name='Test-Bot')
+        config.stale_days = dict(default=1, daily_book=7)
+        g_bot = GDGAjuBot(config, bot, resources)
+        now = datetime.now(tz=AJU_TZ).timestamp()
+
+        for chat_id, days in ((1, 0), (2, 3), (3, 10)):
+            last = datetime.fromtimestamp(now - days * 86400 - 1, tz=AJU_TZ)
+            g_bot.states['chat_stats'][chat_id]['last_activity'] = last
+            g_bot.states['daily_book'][chat_id]['messages_since'] = days
+            g_bot.activity.touch(chat_id, last.timestamp())
+
+        g_bot.clear_stale_states(as_task=False)
+
+        # Cada tipo de estado respeita o seu limite de inatividade
+        assert set(g_bot.states['chat_stats']) == {1}
+        assert set(g_bot.states['daily_book']) == {1, 2}
+        assert 3 not in g_bot.activity and 2 in g_bot.activity
+
+        # uma atividade nova tira o chat da posição antiga no índice
+        index = util.ActivityIndex()
+        for chat_id, when in ((1, 0), (2, 100), (3, 120), (1, 200)):
+            index.touch(chat_id, when)
+        index.discard(3)
+        assert index.older_than(150) == [2]
+        assert index.older_than(200) == [2, 1]
+
+    def test_state_journal(self):
+        import json
+
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = StateJournal(os.path.join(tmp, 'states.journal'), fsync='always')
+            state = util.StateDict({}, mock.call, journal_function=functools.partial(journal.append, 'daily_book', 42))
+            when = datetime.fromtimestamp(1459378800, AJU_TZ)
+
+            state['messages_since'] = 3
+            state['last_time'] = when
+            state['__memory__'] = {}
+
+            # Um checkpoint interrompido mantém os registros anteriores
+            journal.rotate()
+            state['messages_since'] = 4
+            state.pop('last_time')
+
+            states = util.MissingDict(lambda state_id: util.MissingDict(lambda chat_id: {}))
+            assert journal.apply(states) == 4
+            assert states['daily_book'][42] == {'messages_since': 4}
+
+            # Após o checkpoint concluído, somente as novas alterações permanecem
+            journal.rotate()
+            journal.compact()
+            state['messages_since'] = 5
+            states = util.MissingDict(lambda state_id: util.MissingDict(lambda chat_id: {}))
+            assert journal.apply(states) == 1
+            assert states['daily_book'][42] == {'messages_since': 5}
+            journal.close()
+
+            # Fora da política ``always``, as linhas ficam no buffer até o intervalo passar
+            journal = StateJournal(os.path.join(tmp, 'buffered.journal'), fsync='never', fsync_interval=3600)
+            journal.append('daily_book', 42, 'messages_since', 6)
+            with open(journal.path) as written:
+                assert written.read() == ''
+            journal.fsync_interval = 0
+            journal.flush()
+            with open(journal.path) as written:
+                assert json.loads(written.read())['v'] == 6
+            journal.close()
+
+    def test_benchmark_harness(self):
+        from gdgajubot import bench
+
+        g_bot = bench.make_bot()
+        workload = bench.Workload(messages=300, chats=5, command_ratio=0.2, seed=7)
+        report = bench.run(workload, allocations=False, g_bot=g_bot)
+
+        # Todas as mensagens passam pelo dispatcher real e pelos handlers
+        assert report['messages'] == 300 and report['errors'] == 0
+        assert g_bot.resources.logged == 300
+        assert report['bot_calls']['send_message'] > 0
+        assert report['latency_ms']['p50'] <= report['latency_ms']['p99']
+
+        # Rodar de novo com o mesmo bot não acumula handlers de erro
+        bench.run(bench.Workload(messages=10, seed=7), allocations=False, g_bot=g_bot)
+        assert len(g_bot.updater.dispatcher.error_handlers) == 1
+
+        slower = dict(report, messages_per_sec=report['messages_per_sec'] / 2)
+        assert bench.compare(report, report) == []
+        assert bench.compare(slower, report)[0].startswith('messages_per_sec')
+
+    def test_capture_and_replay(self):
+        from gdgajubot import bench, capture
+
+        source = bench.make_bot()
+        updates = list(bench.Workload(messages=50, chats=3, command_ratio=0.3, seed=3).updates(source.bot))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'capture.jsonl.gz')
+            recorder = capture.UpdateRecorder(path, anonymize=True, salt='test')
+            for update in updates:
+                recorder.record(update)
+            recorder.close()
+
+            records = list(capture.read_capture(path))
+            assert len(records) == 50
+
+            # Comandos são preservados, identificadores e textos não
+            original, (_, data) = updates[0].message, records[0]
+            assert data['message']['from']['id'] != original.from_user.id
+            assert len(data['message']['text']) == len(original.text)
+            if original.text.startswith('/'):
+                assert data['message']['text'] == original.text
+
+            report = capture.replay(path, speed=0)
+            assert report['messages'] == 50 and report['errors'] == 0
+            assert report['bot_calls']['send_message'] > 0
+
+            # Sem fechar o gravador, o gzip fica truncado: a leitura vai até o último descarregamento
+            path = os.path.join(tmp, 'unclosed.jsonl.gz')
+            recorder = capture.UpdateRecorder(path)
+            for update in updates * 3:
+                recorder.record(update)
+            assert len(list(capture.read_capture(path))) == capture.UpdateRecorder.FLUSH_EVERY
+            recorder.close()
+            assert len(list(capture.read_capture(path))) == 150
+            recorder.close()
+
+    def test_fake_bot_api(self):
+        import telegram
+        from gdgajubot.fakes.botapi import FakeBotAPI
+
+        with FakeBotAPI(enforce_limits=True) as server:
+            api = telegram.Bot('123456:FAKE', base_url=server.base_url)
+            assert api.get_me().username == 'fake_bot'
+
+            chat = {'id': -42, 'type': 'supergroup', 'username': 'gdgaju'}
+            user = {'id': 7, 'is_bot': False, 'first_name': 'Ada'}
+            message_id = server.push_message(chat, user, 'python')
+
+            updates = api.get_updates(timeout=0)
+            assert [u.message.text for u in updates] == ['python']
+            assert api.get_chat(-42).username == 'gdgaju'
+
+            # A resposta encerra a medição de latência da mensagem
+            api.send_message(-42, 'import antigravity', reply_to_message_id=message_id)
+            assert server.report()['answered'] == 1
+
+            # O limite de uma mensagem por segundo no chat gera um 429
+            with self.assertRaises(telegram.error.RetryAfter):
+                api.send_message(-42, 'de novo')
+
+    def test_fake_upstreams(self):
+        from gdgajubot.data.resources import Resources
+        from gdgajubot.fakes.server import Faults
+        from gdgajubot.fakes.upstream import FakeUpstreams, bench_paths
+
+        resources = sqlite_resources()
+        faults = {'learnviral': Faults(error_rate=1.0)}
+        with FakeUpstreams(scale=2, upstream_faults=faults) as server:
+            resources.upstreams = {name: server.address + '/' + name for name in Resources.UPSTREAMS}
+
+            report = bench_paths(resources, rounds=2)
+            assert all(report[path]['errors'] == 0 for path in ('events', 'book', 'udemy'))
+            assert server.stats['meetup'] == 2 and server.stats['packt_cdn'] == 2
+
+            # O site com falhas não impede os cupons dos outros sites
+            discounts = resources.get_discounts()
+            assert len(discounts) == 14
+            assert not any('/lv-' in url for url in discounts)
+
+    def test_handler_metrics(self):
+        from gdgajubot import bench, metrics
+
+        metrics.registry.clear()
+        g_bot = bench.make_bot()
+        bench.run(bench.Workload(messages=200, command_ratio=0.5, seed=1), allocations=False, g_bot=g_bot)
+
+        summary = metrics.registry.handler_summary()
+        assert summary['on_message', 'extract_and_save_data']['calls'] == 200
+        assert summary['command', 'help']['calls'] > 0
+        assert metrics.registry.histograms['telegram_send_seconds', (('method', 'send_message'),)].count > 0
+
+        text = metrics.registry.render()
+        assert '# TYPE handler_latency_seconds histogram' in text
+        assert 'handler_calls_total{handler="help",kind="command"}' in text
+
+        # O comando /stats lista os handlers medidos
+        message = MockMessage()
+        g_bot.bot.send_message = mock.Mock()
+        g_bot.stats(message)
+        response = g_bot.bot.send_message.call_args[0][1]
+        assert 'on_message:extract_and_save_data' in response
+
+    def test_watchdog(self):
+        import threading
+        import time
+        from gdgajubot import metrics
+        from gdgajubot.watchdog import Watchdog
+
+        registry = metrics.Registry()
+        dog = Watchdog(threshold=5, registry=registry)
+        release = threading.Event()
+
+        def stuck_in_upstream(message):
+            release.wait()
+
+        handler = dog.guard('command', 'events', stuck_in_upstream)
+        worker = threading.Thread(target=handler, args=(MockMessage(chat_id=-42),))
+        worker.start()
+        try:
+            while not dog.inflight:
+                time.sleep(0.001)
+            start = next(iter(dog.inflight.values())).start
+            assert dog.check(start + 1) == []
+
+            [report] = dog.check(start + 6)
+            assert (report['handler'], report['chat_id']) == ('events', -42)
+            assert 'stuck_in_upstream' in report['stack']
+
+            # denunciada de novo só após mais um limite, e contada uma vez
+            assert dog.check(start + 7) == []
+            assert len(dog.check(start + 11)) == 1
+            assert registry.counters['slow_handlers_total', (('handler', 'events'), ('kind', 'command'))] == 1
+        finally:
+            release.set()
+            worker.join()
+
+        assert not dog.inflight
+
+    def test_profile_command(self):
+        import threading
+        import time
+        from gdgajubot import profiler, watchdog
+
+        release = threading.Event()
+
+        def slow_upstream():
+            release.wait()
+
+        def busy_handler(message):
+            slow_upstream()
+
+        # um handler ocupado, visto pelo vigia
+        handler = watchdog.guard('command', 'busy', busy_handler)
+        worker = threading.Thread(target=handler, args=(MockMessage(chat_id=1),))
+        worker.start()
+        try:
+            while not watchdog.monitor.inflight:
+                time.sleep(0.001)
+            result = profiler.SamplingProfiler(interval=0.001).run(0.05)
+        finally:
+            release.set()
+            worker.join()
+
+        assert result.samples > 0
+        labels = [label for label, _, _ in result.top()]
+        assert any('busy_handler' in label for label in labels)
+        assert any('slow_upstream' in label for label in labels)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = result.save(os.path.join(directory, 'profile.txt'))
+            with open(path) as f:
+                stack, count = f.readline().rsplit(' ', 1)
+            assert 'busy_handler' in stack and int(count) > 0
+
+            # o comando responde ao final do profiling, sem bloquear o handler
+            config = util.BotConfig(group_name='Test-Bot', profile_dir=directory)
+            g_bot = GDGAjuBot(config, MockTeleBot(), MockResources())
+            done = threading.Event()
+            g_bot.bot.send_message.side_effect = lambda *args, **kwargs: done.set()
+            message = MockMessage(chat_id=-10)
+
+            g_bot.profile(message, ['abc'])
+            assert 'Modo de uso' in message.reply_html.call_args[0][0]
+
+            g_bot.profile(message, ['0.05'])
+            assert 'iniciado' in message.reply_html.call_args[0][0]
+            assert done.wait(5)
+            assert 'Nenhuma amostra' in g_bot.bot.send_message.call_args[0][1]
+
+    def test_memory_report(self):
+        from gdgajubot import bench, memory, metrics
+
+        g_bot = bench.make_bot()
+        bench.run(bench.Workload(messages=300, chats=7, seed=1), allocations=False, g_bot=g_bot)
+
+        rows = {name: (entries, size) for name, entries, size in memory.report(g_bot)}
+        assert rows['states.chat_stats'][0] == 7
+        assert rows['activity'][0] == 7
+        assert all(size > 0 for _, size in rows.values())
+        # o bot e os recursos compartilhados não entram nas contas
+        assert rows['chats'][1] < memory.deep_sizeof(g_bot.chats)
+
+        registry = metrics.Registry()
+        memory.publish(memory.report(g_bot), registry)
+        assert registry.gauges['memory_entries', (('structure', 'states.chat_stats'),)] == 7
+
+        g_bot.bot.send_message = mock.Mock()
+        g_bot.memory_report(MockMessage(), [])
+        assert 'states.chat_stats' in g_bot.bot.send_message.call_args[0][1]
+
+        try:
+            g_bot.memory_report(MockMessage(), ['start'])
+            leak = [bytearray(1024) for _ in range(100)]
+            g_bot.memory_report(MockMessage(), ['diff'])
+            assert 'test_gdgajubot.py' in g_bot.bot.send_message.call_args[0][1]
+        finally:
+            g_bot.memory_report(MockMessage(), ['stop'])
+        del leak
+
+        g_bot.memory_report(MockMessage(), ['diff'])
+        assert 'inativo' in g_bot.bot.send_message.call_args[0][1]
+
+    def test_structured_logging(self):
+        import io
+        import json
+        import logging
+        from gdgajubot import logs, watchdog
+
+        root = logging.getLogger()
+        saved = root.handlers[:], root.level
+        stream = io.StringIO()
+        try:
+            listener = logs.setup('json', sample_rate=0.0, stream=stream)
+
+            def handler(message):
+                items = ['antes']
+                logging.info("itens: %s", items)
+                items.append('depois')
+                logs.per_message.info("descartado pela amostragem")
+                logs.per_message.warning("aviso nunca é descartado")
+
+            watchdog.guard('on_message', 'handler', handler)(MockMessage(chat_id=-7))
+            logging.info("fora de handler")
+            listener.stop()
+        finally:
+            root.handlers[:], level = saved
+            root.setLevel(level)
+            logs.per_message.filters.clear()
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [r['message'] for r in records] == [
+            "itens: ['antes']", "aviso nunca é descartado", "fora de handler",
+        ]
+        assert records[0]['chat_id'] == -7 and records[0]['handler'] == 'on_message:handler'
+        assert records[1]['logger'] == 'gdgajubot.messages'
+        assert 'chat_id' not in records[2]
+
+    def test_schema_version_and_lazy_imports(self):
+        import subprocess
+        import sys
+        from gdgajubot.data import database
+
+        # o esquema criado fica registrado, e a próxima inicialização pula as verificações
+        sqlite_resources()
+        assert database.stored_schema_version() == database.schema_version()
+
+        # dependências usadas raramente não são importadas com o bot
+        code = 'import sys, gdgajubot.bot; print(",".join(m for m in %r if m in sys.modules))' % (
+            ('requests', 'bs4', 'yaml', 'dj_database_url'),)
+        output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True)
+        assert output.stdout.strip() == b''
+
+    def test_webhook_mode(self):
+        import json
+        import time
+        import urllib.error
+        import urllib.request
+        from gdgajubot import metrics
+        from gdgajubot.fakes.botapi import FakeBotAPI
+
+        def post(url, data, headers=None):
+            request = urllib.request.Request(url, data, dict({'Content-Type': 'application/json'}, **(headers or {})))
+            try:
+                return urllib.request.urlopen(request, timeout=5).status
+            except urllib.error.HTTPError as e:
+                return e.code
+
+        with FakeBotAPI() as server:
+            config = util.BotConfig(telegram_token='123456:FAKE', group_name='Test-Bot', dev=False,
+                                    telegram_base_url=server.base_url, webhook_url='https://bot.example/',
+                                    webhook_listen='127.0.0.1:0', webhook_secret='s3cr3t', webhook_max_body=4096)
+            g_bot = GDGAjuBot(config, resources=MockResources())
+            g_bot.start()
+            try:
+                host, port = g_bot.webhook.httpd.server_address[:2]
+                base = 'http://%s:%d' % (host, port)
+                assert server.webhook['url'] == 'https://bot.example/s3cr3t'
+                assert 'secret_token' not in server.webhook
+
+                update = json.dumps({'update_id': 1, 'message': {
+                    'message_id': 10, 'date': int(time.time()), 'text': '/help',
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+                    'chat': {'id': 5, 'type': 'private'}, 'from': {'id': 5, 'is_bot': False, 'first_name': 'Ada'},
+                }}).encode()
+
+                assert post(base + '/errado', update) == 403
+                assert post(base + '/', update, {'X-Telegram-Bot-Api-Secret-Token': 'errado'}) == 403
+                assert post(base + '/', update, {'X-Telegram-Bot-Api-Secret-Token': 's3crét'}) == 403
+                assert post(base + '/s3cr3t', b'{' + b' ' * 5000 + b'}') == 413
+                assert post(base + '/s3cr3t', b'not json') == 400
+                assert post(base + '/', update, {'X-Telegram-Bot-Api-Secret-Token': 's3cr3t'}) == 200
+
+                deadline = time.time() + 5
+                while not server.replies and time.time() < deadline:
+                    time.sleep(0.01)
+                assert server.replies and server.replies[0]['chat']['id'] == 5
+
+                wait = metrics.registry.histograms['update_queue_wait_seconds', (('source', 'webhook'),)]
+                assert wait.count == 1
+            finally:
+                g_bot.webhook.stop()
+                g_bot.updater.dispatcher.stop()
+                g_bot.updater.job_queue.stop()
+
+    def test_catch_up(self):
+        import time
+        from gdgajubot.fakes.botapi import FakeBotAPI
+
+        with FakeBotAPI() as server:
+            chat = {'id': -42, 'type': 'supergroup', 'username': 'gdgaju'}
+            user = {'id': 7, 'is_bot': False, 'first_name': 'Ada'}
+            command = [{'type': 'bot_command', 'offset': 0, 'length': 5}]
+            old = time.time() - 3600
+            for i in range(250):
+                server.push_message(chat, user, 'mensagem %d' % i, date=old + i)
+            server.push_message(chat, user, '/help', command, date=old + 300)
+            server.push_message(chat, user, '/help', command)
+
+            config = util.BotConfig(telegram_token='123456:FAKE', group_name='Test-Bot', dev=False,
+                                    telegram_base_url=server.base_url, catch_up=True)
+            resources = MockResources()
+            g_bot = GDGAjuBot(config, resources=resources)
+            totals = g_bot.catch_up()
+
+            assert totals == {'updates': 252, 'recent': 1}
+            # o trabalho passivo é aplicado em lote, sem respostas
+            assert resources.log_messages.call_count == 3
+            assert sum(len(call[0][0]) for call in resources.log_messages.call_args_list) == 251
+            assert g_bot.states['daily_book'][-42]['messages_since'] == 251
+            last_activity = g_bot.states['chat_stats'][-42]['last_activity']
+            assert int(last_activity.timestamp()) == int(old + 300)
+            assert -42 in g_bot.chats and not server.replies
+
+            # só o comando recente vai para o dispatcher, e nada fica pendente no servidor
+            assert g_bot.updater.update_queue.qsize() == 1
+            assert g_bot.bot.get_updates(offset=g_bot.updater.last_update_id, timeout=0) == []
+
+    def test_overload_control(self):
+        import logging
+        import time
+        import telegram
+        from gdgajubot import bench, logs, metrics, overload
+
+        metrics.registry.clear()
+        config = util.BotConfig(group_name='Bench', flood_rate=0.001, flood_burst=2, overload_queue=10)
+        g_bot = bench.make_bot(config)
+        dispatcher = g_bot.updater.dispatcher
+        chat = telegram.Chat(-42, telegram.Chat.SUPERGROUP, username='gdgaju')
+        user = telegram.User(7, 'Ada', is_bot=False)
+
+        def send(text, n=[0]):
+            n[0] += 1
+            entities = None
+            if text.startswith('/'):
+                entities = [telegram.MessageEntity(telegram.MessageEntity.BOT_COMMAND, 0, len(text))]
+            message = telegram.Message(n[0], user, datetime.now(), chat, text=text, entities=entities,
+                                       bot=g_bot.bot)
+            dispatcher.process_update(telegram.Update(n[0], message=message))
+
+        # o chat só tem 2 fichas para comandos; o /start é essencial
+        for _ in range(5):
+            send('/help')
+            send('/start')
+        assert g_bot.bot.calls['send_message'] == 7
+        assert metrics.registry.counters['overload_shed_total', (('handler', 'help'), ('kind', 'command'))] == 3
+
+        # com a fila cheia, os easter eggs e os logs de cada mensagem são descartados
+        with mock.patch('random.randint', return_value=0):
+            send('eu gosto de python')
+            assert g_bot.bot.calls['send_message'] == 8
+
+            for i in range(11):
+                dispatcher.update_queue.put(None)
+            assert g_bot.overload.overloaded()
+            send('eu gosto de python')
+            assert g_bot.bot.calls['send_message'] == 8
+
+            record = logging.LogRecord(logs.per_message.name, logging.INFO, __file__, 0, 'msg', (), None)
+            assert not logs.per_message.filter(record)
+            record.levelno = logging.WARNING
+            assert logs.per_message.filter(record)
+
+            # os tenants dividem o logger: um controle novo se soma aos outros, sem substituí-los
+            other = overload.OverloadController()
+            other.filter_log(logs.per_message)
+            record.levelno = logging.INFO
+            assert not logs.per_message.filter(record)
+            assert sum(isinstance(f, overload.OptionalLogFilter) for f in logs.per_message.filters) == 1
+
+        # a espera média na fila também indica a sobrecarga
+        g_bot.overload.update_queue = None
+        assert not g_bot.overload.overloaded()
+        for _ in range(20):
+            g_bot.overload.record_wait(5)
+        assert g_bot.overload.overloaded()
+
+        # ... e decai com o tempo, mesmo sem novas atualizações
+        later = time.monotonic() + 2 * overload.EWMA_HALF_LIFE
+        assert g_bot.overload.average_wait(later) < config.overload_latency
+        with mock.patch('time.monotonic', return_value=later):
+            assert not g_bot.overload.overloaded()
+
+        # sem `flood_rate`, o limite de comandos fica desativado
+        assert util.BotConfig(group_name='Test-Bot').flood_rate == 0
+        assert overload.OverloadController().allow_command(-42, 'help')
+
+        shed = metrics.registry.counters
+        assert shed['overload_shed_total', (('handler', 'easter_python'), ('kind', 'easter_egg'))] == 1
+        assert shed['overload_shed_total', (('handler', 'gdgajubot.messages'), ('kind', 'log'))] >= 1
+
+    def test_tenants(self):
+        import telegram
+        from gdgajubot import bench, metrics
+        from gdgajubot.data.resources import Resources
+        from gdgajubot.tenants import TenantRuntime, parse_tenants
+
+        default = sqlite_resources()
+        contents = {
+            'metrics_port': 9100,
+            'links': [{'name': 'Site', 'link': 'https://gdgaracaju.com.br'}],
+            'tenants': {
+                'aju': {'group_name': 'GDG-Tenants', 'tokens': {'telegram': '1:A', 'meetup': 'k1'}},
+                'mcz': {'group_name': ['GDG-Tenants'], 'events_source': 'meetup',
+                        'tokens': {'telegram': '2:B', 'meetup': 'k2'}},
+            },
+        }
+        with self.assertRaises(ValueError):
+            parse_tenants(dict(contents, tenants={'aju': {'database_url': 'sqlite://'}}))
+
+        process, configs = parse_tenants(contents)
+        assert process.metrics_port == 9100
+        assert [(c.tenant, c.telegram_token, c.metrics_port) for c in configs] == [('aju', '1:A', None),
+                                                                                   ('mcz', '2:B', None)]
+        assert configs[1].links == contents['links']
+
+        # o journal comum vira um arquivo por tenant; um webhook por porta
+        _, configs = parse_tenants(dict(contents, state_journal='/tmp/j'))
+        assert [c.state_journal for c in configs] == ['/tmp/j.aju', '/tmp/j.mcz']
+        with self.assertRaises(ValueError):
+            parse_tenants(dict(contents, webhook_url='https://bot.example/'))
+        webhooks = {name: dict(block, webhook_listen='0.0.0.0:%d' % port)
+                    for (name, block), port in zip(contents['tenants'].items(), (8443, 8444))}
+        _, configs = parse_tenants(dict(contents, webhook_url='https://bot.example/', tenants=webhooks))
+        assert [c.webhook_listen for c in configs] == ['0.0.0.0:8443', '0.0.0.0:8444']
+        process, configs = parse_tenants(contents)
+
+        runtime = TenantRuntime(configs, bot_class=lambda config: bench.make_bot(config, resources=Resources(config)))
+        aju, mcz = runtime.bots['aju'], runtime.bots['mcz']
+
+        # o banco é o mesmo, mas os estados de cada comunidade ficam separados
+        assert aju.resources.db is mcz.resources.db is default.db
+        aju.resources.set_state('daily_book', -42, {'messages_since': 7})
+        assert aju.resources.load_states()['daily_book'][-42]['messages_since'] == 7
+        assert 'messages_since' not in mcz.resources.load_states()['daily_book'][-42]
+        assert 'messages_since' not in default.load_states()['daily_book'][-42]
+
+        # os eventos dos mesmos grupos são buscados uma vez só
+        for g_bot in (aju, mcz):
+            g_bot.resources.generate_events = mock.Mock(return_value=iter(MockResources.EVENTS))
+        assert aju.resources.get_events(5) == mcz.resources.get_events(5)
+        assert aju.resources.generate_events.call_count + mcz.resources.generate_events.call_count == 1
+
+        # as métricas dos handlers são separadas por tenant
+        metrics.registry.clear()
+        chat = telegram.Chat(-42, telegram.Chat.SUPERGROUP, username='gdgaju')
+        user = telegram.User(7, 'Ada', is_bot=False)
+        for n, g_bot in enumerate((aju, mcz, mcz)):
+            message = telegram.Message(n, user, datetime.now(), chat, text='/help', bot=g_bot.bot,
+                                       entities=[telegram.MessageEntity(telegram.MessageEntity.BOT_COMMAND, 0, 5)])
+            g_bot.updater.dispatcher.process_update(telegram.Update(n, message=message))
+        assert metrics.registry.handler_summary(tenant='aju')['command', 'help']['calls'] == 1
+        assert metrics.registry.handler_summary(tenant='mcz')['command', 'help']['calls'] == 2
+        assert 'telegram_send_seconds_count{method="send_message",tenant="mcz"} 2' in metrics.registry.render()
+
+    def test_cluster(self):
+        import queue
+        import time
+        import telegram
+        from datetime import timedelta
+        from gdgajubot import bench, webhook
+        from gdgajubot.cluster import Cluster
+
+        resources = sqlite_resources()
+        now = datetime.utcnow()
+
+        # dois workers; o segundo recebe as atualizações repassadas no próprio webhook
+        queue_a, queue_b = queue.Queue(), queue.Queue()
+        server = webhook.WebhookServer(None, queue_b, 'segredo', '127.0.0.1', 0).start()
+        url_b = 'http://127.0.0.1:%d/' % server.httpd.server_address[1]
+        a = Cluster(resources, 'a', 'http://127.0.0.1:1/', 'segredo', queue_a)
+        b = Cluster(resources, 'b', url_b, 'segredo', queue_b)
+        a.on_change = mock.Mock()
+        try:
+            a.heartbeat(now)
+            b.heartbeat(now)
+            a.heartbeat(now)
+            assert sorted(a.members) == sorted(b.members) == ['a', 'b']
+            assert a.is_leader and not b.is_leader
+            a.on_change.assert_called_once_with()
+
+            # cada chat tem um único dono, e os chats se dividem entre os dois
+            owners = [a.owner(-chat_id) for chat_id in range(1, 101)]
+            assert owners == [b.owner(-chat_id) for chat_id in range(1, 101)]
+            assert 25 < owners.count('a') < 75
+
+            # a atualização de um chat do outro worker é repassada a ele
+            chat_id = next(-i for i in range(1, 101) if b.owns(-i))
+            message = telegram.Message(1, telegram.User(7, 'Ada', is_bot=False), datetime.now(),
+                                       telegram.Chat(chat_id, 'supergroup'), text='oi')
+            a.route(telegram.Update(1, message=message))
+            update = queue_b.get(timeout=5)
+            assert isinstance(update, telegram.Update) and update.effective_chat.id == chat_id
+            assert queue_a.empty()
+
+            # o livro diário de um chat só é enviado por um worker até a concessão expirar
+            assert b.claim('daily_book:%d' % chat_id, 3600)
+            assert not a.claim('daily_book:%d' % chat_id, 3600)
+
+            # sem renovar a concessão, o worker "b" sai do cluster e "a" assume os chats dele
+            later = now + timedelta(seconds=a.ttl + 1)
+            a.heartbeat(later)
+            assert list(a.members) == ['a'] and a.owns(chat_id)
+            assert a.on_change.call_count == 2
+            b.heartbeat(later)
+            assert not b.is_leader
+        finally:
+            server.stop()
+            resources.release_lease('leader', 'a')
+            for worker in 'ab':
+                resources.release_lease('worker:' + worker, worker)
+
+        # os workers deixam na memória apenas os estados dos chats que lhes cabem
+        config = util.BotConfig(group_name='Bench', cluster_id='a', cluster_url='http://a/', webhook_secret='s')
+        g_bot = bench.make_bot(config)
+        g_bot.cluster.members = {'a': 'http://a/', 'b': url_b}
+        for chat_id in range(-1, -21, -1):
+            g_bot.states['daily_book'][chat_id]['messages_since'] = 1
+            g_bot.book_schedule.schedule(chat_id, time.time() + 60)
+        g_bot.rebalance()
+        kept = set(g_bot.states['daily_book'])
+        assert kept and kept == set(g_bot.book_schedule)
+        assert all(g_bot.cluster.owns(chat_id) for chat_id in kept)
+        assert len(kept) < 20
+
+    def test_broadcast(self):
+        import telegram
+        from pony import orm
+        from gdgajubot.broadcast import Broadcaster
+        from gdgajubot.data.database import Group
+        from gdgajubot.data.resources import Resources
+
+        resources = sqlite_resources()
+        with orm.db_session:
+            for i in range(1, 26):
+                Group(telegram_id=-9000 - i, telegram_groupname='g%d' % i, has_daily_book=i % 5 != 0)
+
+        sent, throttled = [], []
+
+        def send(chat_id, text):
+            if chat_id == -9003 and not throttled:
+                throttled.append(chat_id)
+                raise telegram.error.RetryAfter(0.01)
+            if chat_id == -9007:
+                raise telegram.error.Unauthorized('Forbidden: bot was kicked')
+            sent.append(chat_id)
+
+        # 20 grupos com livro diário, um deles bloqueou o bot; o pedido de espera é respeitado
+        broadcaster = Broadcaster(send, resources, concurrency=4, rate=1000, page_size=6)
+        report = broadcaster.run(resources.create_broadcast('Olá', 'daily_book'))
+        assert (report.delivered, report.failed) == (19, 1)
+        assert throttled and -9003 in sent
+
+        # um aviso interrompido continua do último progresso gravado
+        broadcast_id = resources.create_broadcast('Todos', 'all', report_to=-42)
+        resources.checkpoint_broadcast(broadcast_id, -9014, 12, 0, 1.0)
+        del sent[:]
+        # the in-memory database is per connection, so the resumed run happens here
+        broadcaster.spawn = mock.Mock(return_value=True)
+        assert broadcaster.resume() == [broadcast_id]
+        report = broadcaster.run(broadcast_id)
+        assert (report.delivered, report.failed, report.report_to) == (24, 1, -42)
+        assert sorted(sent) == [-9000 - i for i in range(13, 0, -1) if i != 7]
+        assert resources.pending_broadcasts() == ()
+
+        # um aviso com a concessão de outro processo não é retomado
+        broadcast_id = resources.create_broadcast('Outro', 'all')
+        resources.acquire_lease('broadcast:%d' % broadcast_id, 'outro-processo', 60)
+        del broadcaster.spawn
+        assert broadcaster.resume() == []
+        report = broadcaster.run(broadcast_id)
+        assert not report.finished and resources.pending_broadcasts() == (broadcast_id,)
+        resources.release_lease('broadcast:%d' % broadcast_id, 'outro-processo')
+        assert broadcaster.run(broadcast_id).finished
+
+        # no modo multi-tenant, cada aviso vai só para os grupos do tenant e só ele o retoma
+        tenants = {}
+        for name in ('aju', 'mcz'):
+            config = util.BotConfig(tenant=name, dev=False)
+            config.database = resources.config.database
+            tenants[name] = Resources(config)
+        tenants['aju'].get_group(-9001, 'g1')
+        tenants['aju'].set_group(-9002, 'g2', has_daily_book=True)
+        tenants['mcz'].update_groups({-9003: 'g3'})
+        broadcast_id = tenants['aju'].create_broadcast('Só aju', 'all')
+        assert tenants['aju'].broadcast_recipients('all') == [-9002, -9001]
+        assert tenants['mcz'].broadcast_recipients('all') == [-9003]
+        assert tenants['aju'].pending_broadcasts() == (broadcast_id,)
+        assert tenants['mcz'].pending_broadcasts() == () and resources.pending_broadcasts() == ()
+        tenants['aju'].checkpoint_broadcast(broadcast_id, None, 0, 0, 0, finished=True)
+
+        # o comando mantém as quebras de linha do texto
+        g_bot = GDGAjuBot(self.config, MockTeleBot(), MockResources())
+        g_bot.broadcaster.start = mock.Mock(return_value=7)
+        message = MockMessage(text='/broadcast --todos Olá\nmundo', chat_id=-42)
+        g_bot.send_broadcast(message)
+        assert g_bot.broadcaster.start.call_args[0] == ('Olá\nmundo', 'all')
+        assert '#7' in message.reply_html.call_args[0][0]
+
+    def test_activity_rollups(self):
+        import telegram
+        from datetime import date, timedelta, timezone
+        from pony import orm
+        from gdgajubot.data import analytics
+        from gdgajubot.data.database import Message, State, User
+        from gdgajubot.data.resources import json_encode
+
+        resources = sqlite_resources()
+        sent_at = datetime(2030, 5, 10, 12, 30, tzinfo=timezone.utc)  # 9h30 em Aracaju
+        since = date(2030, 5, 1)
+
+        def message(user_id, name, chat_id, minutes=0):
+            user = mock.Mock(id=user_id)
+            user.name = name
+            return MockMessage(from_user=user, chat_id=chat_id, text='oi', date=sent_at + timedelta(minutes=minutes))
+
+        # os contadores são atualizados junto com o registro das mensagens
+        resources.log_message(message(7001, '@ana', -7001))
+        resources.log_messages([message(7001, '@ana', -7001, 10), message(7002, '@bia', -7001, 20),
+                                message(7001, '@ana', -7001, 60)])
+        resources.log_message(message(7002, '@bia', -7002, 24 * 60))
+        assert resources.top_users(-7001, since) == [('@ana', 3), ('@bia', 1)]
+        per_day, per_hour = resources.chat_activity(-7001, since)
+        assert per_day == [(date(2030, 5, 10), 4)]
+        assert (per_hour[9], per_hour[10], sum(per_hour)) == (3, 1, 4)
+        assert resources.chat_activity(-7002, since)[0] == [(date(2030, 5, 11), 1)]
+
+        # mensagens antigas, sem contadores, são somadas em lotes pelo backfill
+        with orm.db_session:
+            caio = User(telegram_id=7003, telegram_username='@caio')
+            old = [Message(sent_by=caio, text='oi', sent_at=datetime(2030, 5, 11, 2, i), chat_id=-7003)
+                   for i in range(3)]
+            # logged before the messages had a chat
+            old.append(Message(sent_by=caio, text='oi', sent_at=datetime(2030, 5, 11, 2, 3)))
+            orm.flush()
+            state = State.get(telegram_id=analytics.HISTORY_CHAT, description=analytics.BACKFILL_STATE)
+            state.info = json_encode({'after': old[0].id - 1, 'until': old[-1].id})
+        assert [resources.backfill_rollups(2) for _ in range(3)] == [2, 2, 0]
+        assert resources.top_users(-7003, since) == [('@caio', 3)]
+        assert resources.chat_activity(-7003, since)[0] == [(date(2030, 5, 10), 3)]
+        assert resources.top_users(analytics.HISTORY_CHAT, since) == [('@caio', 1)]
+        with orm.db_session:
+            assert Message.select(lambda m: m.chat_id == -7001).count() == 4
+
+        # os comandos leem o período do chat; em conversa privada, de todos os chats
+        telebot, resources = MockTeleBot(), MockResources()
+        resources.top_users.return_value = [('@ana', 3), ('@bia', 1)]
+        resources.chat_activity.return_value = ([(date(2030, 5, 10), 4)], [0] * 9 + [3, 1] + [0] * 13)
+        g_bot = GDGAjuBot(self.config, telebot, resources)
+        today = datetime.now(AJU_TZ).date()
+
+        g_bot.top_users(MockMessage(chat=mock.Mock(id=-7001, type=telegram.Chat.GROUP), chat_id=-7001), ['30'])
+        assert resources.top_users.call_args[0] == (-7001, today - timedelta(days=29))
+        assert '@ana' in telebot.send_message.call_args[0][1]
+
+        g_bot.chat_activity(MockMessage(chat=mock.Mock(id=7001, type=telegram.Chat.PRIVATE), chat_id=7001), [])
+        assert resources.chat_activity.call_args[0] == (None, today - timedelta(days=bot.ACTIVITY_DAYS - 1))
+        assert '4 mensagens' in telebot.send_message.call_args[0][1]
+        assert '09h       3' in telebot.send_message.call_args[0][1]
+
+    def test_naive_utc(self):
+        from gdgajubot.data.resources import naive_utc
+
+        # o texto que o SQLite devolve, sem depender do `fromisoformat` do Python 3.7
+        assert naive_utc('2030-01-01 10:00:00+00:00') == datetime(2030, 1, 1, 10)
+        assert naive_utc('2030-01-01T07:00:00.250000-03:00') == datetime(2030, 1, 1, 10, 0, 0, 250000)
+        assert naive_utc('2030-01-01T10:00:00') == datetime(2030, 1, 1, 10)
+        assert naive_utc(datetime(2030, 1, 1, 10)) == datetime(2030, 1, 1, 10)
+
+    def test_message_search(self):
+        import telegram
+        from datetime import timezone
+        from gdgajubot.data import search
+
+        resources = sqlite_resources()
+        sent_at = datetime(2030, 6, 24, 20, 0, tzinfo=timezone.utc)
+
+        def message(chat_id, text):
+            user = mock.Mock(id=8001)
+            user.name = '@forrozeiro'
+            return MockMessage(from_user=user, chat_id=chat_id, text=text, date=sent_at)
+
+        resources.log_messages([
+            message(-8001, 'Zabumba e triângulo no forró'), message(-8001, 'zabumba, zabumba, zabumba!'),
+            message(-8001, 'Xaxado com zabumba'), message(-8002, 'zabumba de outro chat'),
+        ])
+
+        # as mensagens são indexadas depois, em lotes, fora do registro
+        assert resources.search_messages('zabumba', -8001).total == 0
+        index_messages(resources)
+
+        # todos os termos, sem diferenciar acentos e maiúsculas, do mais relevante ao menos
+        found = resources.search_messages('zabumba', -8001)
+        assert (found.total, found.partial) == (3, False)
+        assert found.results[0].text == 'zabumba, zabumba, zabumba!'
+        assert [r.text for r in resources.search_messages('ZABUMBÁ xaxado', -8001).results] == ['Xaxado com zabumba']
+        assert resources.search_messages('zabumba', None).total == 4
+        assert len(resources.search_messages('zabumba', -8001, page=2, page_size=2).results) == 1
+        assert resources.search_messages('zabumba pandeiro', -8001).total == 0
+        with mock.patch.object(search, 'MAX_CANDIDATES', 1):
+            assert resources.search_messages('zabumba', -8001).partial
+
+        # a reconstrução reindexa as mensagens em lotes, mantendo o chat de cada uma
+        assert resources.start_search_rebuild() > 0
+        while resources.rebuild_search_index(2):
+            pass
+        assert resources.search_messages('zabumba', -8001).total == 3
+
+        # sem /search_mode on, só os admins buscam
+        bot, resources = MockTeleBot(), MockResources()
+        resources.is_user_admin.return_value = False
+        resources.search_messages.return_value = util.AttributeDict(total=6, partial=False, results=[
+            util.AttributeDict(text='Xaxado com <zabumba>', sent_at=sent_at, sent_by='@forrozeiro')])
+        g_bot = GDGAjuBot(self.config, bot, resources)
+        chat = mock.Mock(id=-8001, type=telegram.Chat.GROUP)
+
+        message = MockMessage(text='/search zabumba', chat=chat, chat_id=-8001)
+        g_bot.search_messages(message)
+        assert 'restrita' in message.reply_text.call_args[0][0]
+
+        g_bot.search_mode(MockMessage(chat=chat, chat_id=-8001), ['on'])
+        message = MockMessage(text='/search --pagina 1 zabumba', chat=chat, chat_id=-8001)
+        g_bot.search_messages(message)
+        assert resources.search_messages.call_args[0] == ('zabumba', -8001)
+        response = message.reply_html.call_args[0][0]
+        assert '&lt;zabumba&gt;' in response and '24/06/2030 17h00' in response
+        assert '/search --pagina 2 zabumba' in response
+
+    def test_retention(self):
+        import gzip
+        import json
+        from datetime import timezone
+        from gdgajubot import retention
+        from gdgajubot.data.database import User
+        from pony import orm
+
+        resources = sqlite_resources()
+
+        def message(user_id, chat_id, text, sent_at):
+            user = mock.Mock(id=user_id)
+            user.name = '@user%d' % user_id
+            return MockMessage(from_user=user, chat_id=chat_id, text=text, date=sent_at.replace(tzinfo=timezone.utc))
+
+        resources.log_messages([
+            message(9101, -9101, 'maracatu antigo', datetime(2030, 1, 1, 10)),
+            message(9102, -9101, 'maracatu de ontem', datetime(2030, 1, 2, 10)),
+            message(9101, -9101, 'maracatu recente', datetime(2030, 3, 1, 10)),
+            message(9103, -9102, 'maracatu guardado', datetime(2030, 1, 1, 10)),
+        ])
+        index_messages(resources)
+
+        # só o chat -9101 tem prazo: as mensagens dele com mais de 30 dias saem do banco para o arquivo
+        policy = retention.RetentionPolicy(0, util.BotConfig.parse_retention_chats('-9101=30'))
+        with tempfile.TemporaryDirectory() as archive_dir:
+            archive = retention.Archive(archive_dir)
+            # o VACUUM só roda depois de `compact_after` mensagens removidas; por padrão, nunca
+            assert retention.Retention(resources, policy, archive).compact_after == 0
+            worker = retention.Retention(resources, policy, archive, batch_size=1, pause=0, compact_after=3)
+            report = worker.run(now=datetime(2030, 3, 10))
+            assert (report.archived, report.users, report.compacted, worker.uncompacted) == (2, 1, False, 2)
+
+            with gzip.open(archive.path(datetime(2030, 1, 1).date()), 'rt') as lines:
+                archived = [json.loads(line) for line in lines]
+            assert [(m['chat_id'], m['username'], m['text']) for m in archived] == [
+                (-9101, '@user9101', 'maracatu antigo')]
+            assert archived[0]['sent_at'] == '2030-01-01T10:00:00+00:00'
+            assert os.path.exists(archive.path(datetime(2030, 1, 2).date()))
+
+            # nada mais a remover; as mensagens ficam fora da busca, e os usuários sem mensagens, do banco
+            assert worker.run(now=datetime(2030, 3, 10)).archived == 0
+
+            # a mensagem de -9101 entra no prazo e completa as 3 remoções desde o último VACUUM
+            report = worker.run(now=datetime(2030, 4, 10))
+            assert (report.archived, report.compacted, worker.uncompacted) == (1, True, 0)
+        texts = [r.text for r in resources.search_messages('maracatu', None).results]
+        assert texts == ['maracatu guardado']
+        with orm.db_session:
+            assert User.get(telegram_id=9102) is None and User.get(telegram_id=9101) is None
+
+        # no modo multi-tenant, a retenção é do processo e roda no primeiro tenant
+        from gdgajubot import tenants
+        process, configs = tenants.parse_tenants({
+            'retention_days': 365, 'compact_after': 10000,
+            'tenants': {'a': {'tokens': {'telegram': '1:A'}}, 'b': {'tokens': {'telegram': '2:B'}}},
+        })
+        assert [(config.retention_days, config.compact_after) for config in configs] == [(365, 10000), (0, 0)]
+
+    def test_data_transfer(self):
+        import gzip
+        import json
+        from datetime import timezone
+        from gdgajubot.data import analytics, search, transfer
+        from gdgajubot.data.database import Message, State
+        from pony import orm
+
+        resources = sqlite_resources()
+
+        def message(user_id, text, sent_at):
+            user = mock.Mock(id=user_id)
+            user.name = '@user%d' % user_id
+            return MockMessage(from_user=user, chat_id=-9201, text=text, date=sent_at.replace(tzinfo=timezone.utc))
+
+        resources.log_messages([
+            message(9201, 'frevo exportado', datetime(2031, 5, 1, 10)),
+            message(9202, 'ciranda exportada', datetime(2031, 5, 2, 11)),
+        ])
+        resources.start_search_rebuild()
+        with orm.db_session:
+            State(telegram_id=-9201, description='transfer', info='{"ok": true}')
+        with orm.db_session:
+            total = Message.select().count()
+            exported = {m.id: (m.chat_id, m.text, m.sent_by.telegram_id)
+                        for m in Message.select(lambda m: m.text in ('frevo exportado', 'ciranda exportada'))}
+
+        with tempfile.TemporaryDirectory() as directory:
+            report = transfer.export_data(directory, batch_size=1)
+            assert {item.table: item.rows for item in report}['Message'] == total
+
+            with gzip.open(os.path.join(directory, 'Message.jsonl.gz'), 'rt') as lines:
+                rows = {row['id']: row for row in map(json.loads, lines)}
+            assert {i: (rows[i]['chat_id'], rows[i]['text'], rows[i]['sent_by']) for i in exported} == exported
+            assert rows[min(exported)]['sent_at'] == '2031-05-01T10:00:00'
+            with gzip.open(os.path.join(directory, 'State.jsonl.gz'), 'rt') as lines:
+                states = [json.loads(line) for line in lines]
+            assert {'telegram_id': -9201, 'description': 'transfer', 'info': '{"ok": true}'} in states
+            assert not {s['description'] for s in states} & {search.REBUILD_STATE, search.INDEX_STATE}
+
+            # a importação no mesmo banco pula tudo; o que foi removido volta com o mesmo id
+            resources.delete_messages([min(exported)])
+            while resources.backfill_rollups():
+                pass
+            report = transfer.import_data(directory, batch_size=1)
+            assert {item.table: item.rows for item in report} == {'User': 0, 'Message': 1, 'Group': 0, 'State': 0}
+            assert {item.table: item.skipped for item in report}['Message'] == total - 1
+
+        with orm.db_session:
+            restored = Message[min(exported)]
+            assert (restored.chat_id, restored.text, restored.sent_by.telegram_id) == exported[min(exported)]
+            assert restored.chat_id == -9201
+            assert State.get(telegram_id=-9201, description='transfer').info == '{"ok": true}'
+            # só a mensagem importada volta a ser contada
+            backfill = State.get(telegram_id=analytics.HISTORY_CHAT, description=analytics.BACKFILL_STATE)
+            assert json.loads(backfill.info) == {'after': min(exported) - 1, 'until': min(exported)}
+
+        # uma tabela nova precisa implementar a leitura em lotes
+        class Incomplete(transfer.Table):
+            entity = State
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+        lines = transfer.format_report(report).splitlines()
+        assert lines[0].split() == ['tabela', 'registros', 'segundos', 'registros/s']
+        assert [line.split()[:2] for line in lines if line.startswith('Message')] == [['Message', '1']]